@@ -1,3 +1,4 @@
+import json
 from pathlib import Path
 
 import fire
@@ -5,23 +6,32 @@ import mlflow
 import pandas as pd
 import torch
 from rich.console import Console
-from torch.utils.data import DataLoader
+from rich.table import Table
 from torchvision.transforms.functional import to_pil_image
 from torchvision.utils import make_grid
 from PIL import Image
 import torch.nn.functional as F
 
 from htr_ocr.config_loader import load_cfg
-from htr_ocr.data.collate import collate_line_batch
+from htr_ocr.data.augment_profile import profile_augmentations
+from htr_ocr.data.collate import LineBatchCollator
+from htr_ocr.data.loader import build_dataloader
 from htr_ocr.data.dataset import IamLineDataset
 from htr_ocr.data.iam import build_manifest
-from htr_ocr.data.samplers import BucketBatchSampler
+from htr_ocr.data.packed import pack_split, resolve_packed_dir
+from htr_ocr.data.prefetch import device_prefetch
+from htr_ocr.data.pregenerated import pregenerate_split
+from htr_ocr.data.preprocess_cache import make_preprocess_cache
+from htr_ocr.data.samplers import make_bucket_sampler
+from htr_ocr.data.split_store import SplitTable, resolve_split_path, write_split_table
 from htr_ocr.data.splits import make_group_split
 from htr_ocr.data.transforms import make_image_transform
+from htr_ocr.train.chunked_infer import chunk_options
 from htr_ocr.train.ctc_infer import infer_one, load_checkpoint
 from htr_ocr.train.ctc_trainer import evaluate, make_dataloader, train_crnn_ctc
 from htr_ocr.train.vt_trainer import evaluate as vt_evaluate, make_dataloader as vt_make_dataloader, train_htr_vt_ctc
 from htr_ocr.train.vt_infer import infer_one as vt_infer_one, load_checkpoint as vt_load_checkpoint
+from htr_ocr.utils.eval_pipeline import metric_workers
 from htr_ocr.utils.io import ensure_dir
 from htr_ocr.utils.repro import seed_everything
 from htr_ocr.utils.mlflow_utils import mlflow_run
@@ -39,6 +49,8 @@ class HTRCLI:
 
         ensure_dir(cfg.data.processed_dir)
 
+        manifest_cfg = getattr(cfg, "manifest", None)
+
         with mlflow_run("make_manifest", cfg):
             df = build_manifest(
                 images_root=cfg.data.images_root,
@@ -46,6 +58,11 @@ class HTRCLI:
                 forms_path=getattr(cfg.data, "forms_path", None),
                 keep_status=list(cfg.data.keep_status),
                 limit=int(cfg.data.limit),
+                num_workers=int(getattr(manifest_cfg, "num_workers", 0)),
+                executor=str(getattr(manifest_cfg, "executor", "thread")),
+                chunksize=int(getattr(manifest_cfg, "chunksize", 64)),
+                index_cache_path=getattr(manifest_cfg, "index_cache", None) or None,
+                verify_files=bool(getattr(manifest_cfg, "verify_files", True)),
             )
 
             manifest_path = Path(cfg.data.manifest_path)
@@ -82,23 +99,68 @@ class HTRCLI:
                 test=float(cfg.split.test),
             )
 
-            (processed_dir / "train.csv").write_text(train_df.to_csv(index=False), encoding="utf-8")
-            (processed_dir / "val.csv").write_text(val_df.to_csv(index=False), encoding="utf-8")
-            (processed_dir / "test.csv").write_text(test_df.to_csv(index=False), encoding="utf-8")
+            for name, split_df in (("train", train_df), ("val", val_df), ("test", test_df)):
+                (processed_dir / f"{name}.csv").write_text(split_df.to_csv(index=False), encoding="utf-8")
+                # колоночная копия для датасетов: читается через mmap, id-колонки как dictionary
+                write_split_table(split_df, processed_dir / f"{name}.arrow")
 
             console.print(
                 "Saved splits to data/processed: "
                 f"train={len(train_df)}, val={len(val_df)}, test={len(test_df)} (group={group_col})"
             )
 
+    def pack_dataset(self, *overrides: str) -> None:
+        cfg = load_cfg("pack_dataset", overrides=list(overrides))
+
+        processed_dir = Path(cfg.data.processed_dir)
+        packed_root = Path(cfg.data.packed_dir)
+
+        with mlflow_run("pack_dataset", cfg):
+            for split_name in [str(x) for x in cfg.pack.splits]:
+                split_path = resolve_split_path(processed_dir, split_name)
+
+                out_dir = ensure_dir(packed_root / split_name)
+                index = pack_split(
+                    csv_path=split_path,
+                    out_dir=out_dir,
+                    shard_mb=int(cfg.pack.shard_mb),
+                    num_workers=int(cfg.pack.num_workers),
+                )
+
+                n_shards = int(index["shard"].max()) + 1 if len(index) else 0
+                console.print(f"Packed split={split_name}: {out_dir} (rows={len(index)}, shards={n_shards})")
+
+    def pregenerate_augment(self, *overrides: str) -> None:
+        cfg = load_cfg("pregenerate_augment", overrides=list(overrides))
+
+        augmented_root = Path(cfg.data.augmented_dir)
+        part, num_parts = int(cfg.pregen.part), int(cfg.pregen.num_parts)
+
+        with mlflow_run("pregenerate_augment", cfg, extra_tags={"part": f"{part}/{num_parts}"}):
+            for split_name in [str(x) for x in cfg.pregen.splits]:
+                out_dir = ensure_dir(augmented_root / split_name)
+                index = pregenerate_split(
+                    cfg,
+                    split_name,
+                    out_dir=out_dir,
+                    variants=int(cfg.pregen.variants),
+                    seed=int(cfg.pregen.seed),
+                    part=part,
+                    num_parts=num_parts,
+                    shard_mb=int(cfg.pregen.shard_mb),
+                    num_workers=int(cfg.pregen.num_workers),
+                )
+                console.print(
+                    f"Augmented split={split_name} part={part}/{num_parts}: {out_dir} "
+                    f"(images={len(index)}, variants={int(cfg.pregen.variants)})"
+                )
+
     def inspect_data(self, *overrides: str) -> None:
         cfg = load_cfg("inspect_data", overrides=list(overrides))
 
         processed_dir = Path(cfg.data.processed_dir)
         split_name = str(cfg.loader.split)
-        csv_path = processed_dir / f"{split_name}.csv"
-        if not csv_path.exists():
-            raise FileNotFoundError(f"Split CSV not found: {csv_path}")
+        csv_path = resolve_split_path(processed_dir, split_name)
 
         transform = make_image_transform(
             height=int(cfg.preprocess.height),
@@ -109,45 +171,27 @@ class HTRCLI:
             augment_cfg=None,
             is_train=False,
             fill=int(cfg.preprocess.pad_value),
+            backend=str(getattr(cfg.preprocess, "backend", "pil")),
             to_float_tensor=True,
         )
 
-        ds = IamLineDataset(csv_path=csv_path, transform=transform, target_height=int(cfg.preprocess.height))
+        ds = IamLineDataset(
+            csv_path=csv_path,
+            transform=transform,
+            target_height=int(cfg.preprocess.height),
+            packed_dir=resolve_packed_dir(cfg, split_name),
+            preprocess_cache=make_preprocess_cache(cfg),
+        )
 
         bucket_enabled = bool(cfg.loader.bucket.enabled)
         batch_size = int(cfg.loader.batch_size)
+        collate_fn = LineBatchCollator(pad_value=float(cfg.preprocess.pad_value) / 255.0)
 
         if bucket_enabled:
-            lengths = [ds.approx_resized_width(i) for i in range(len(ds))]
-            if any(v is None for v in lengths):
-                console.print("No requested columns")
-                bucket_enabled = False
-            else:
-                lengths_i = [int(v) for v in lengths if v is not None]
-                sampler = BucketBatchSampler(
-                    lengths=lengths_i,
-                    batch_size=batch_size,
-                    shuffle_batches=bool(cfg.loader.shuffle),
-                    seed=int(cfg.loader.bucket.seed),
-                    drop_last=bool(cfg.loader.bucket.drop_last),
-                )
-                dl = DataLoader(
-                    ds,
-                    batch_sampler=sampler,
-                    num_workers=int(cfg.loader.num_workers),
-                    pin_memory=bool(cfg.loader.pin_memory),
-                    collate_fn=lambda b: collate_line_batch(b, pad_value=float(cfg.preprocess.pad_value) / 255.0),
-                )
-
-        if not bucket_enabled:
-            dl = DataLoader(
-                ds,
-                batch_size=batch_size,
-                shuffle=bool(cfg.loader.shuffle),
-                num_workers=int(cfg.loader.num_workers),
-                pin_memory=bool(cfg.loader.pin_memory),
-                collate_fn=lambda b: collate_line_batch(b, pad_value=float(cfg.preprocess.pad_value) / 255.0),
-            )
+            sampler = make_bucket_sampler(cfg, ds.approx_resized_widths(), distributed=False)
+            dl = build_dataloader(cfg, ds, collate_fn, batch_sampler=sampler)
+        else:
+            dl = build_dataloader(cfg, ds, collate_fn, shuffle=bool(cfg.loader.shuffle))
 
         with mlflow_run("inspect_data", cfg, extra_tags={"split": split_name}):
             n_batches = int(cfg.loader.n_batches)
@@ -176,6 +220,10 @@ class HTRCLI:
                 console.print(f"  sample text[0]: {t0[:120]}")
 
     def inspect_augmentations(self, image_path: str | None = None, *overrides: str) -> None:
+        # fire кладёт первый аргумент в image_path, даже если это override вида key=value
+        if image_path is not None and "=" in str(image_path) and not Path(str(image_path)).exists():
+            overrides = (str(image_path), *overrides)
+            image_path = None
         cfg = load_cfg("inspect_augmentations", overrides=list(overrides))
         seed_everything(
             int(getattr(cfg.inspect_aug, "seed", 42)),
@@ -185,14 +233,18 @@ class HTRCLI:
         processed_dir = Path(cfg.data.processed_dir)
         split_name = str(cfg.loader.split)
 
+        mode = str(getattr(cfg.inspect_aug, "mode", "grid")).lower()
+        if mode == "profile":
+            self._profile_augmentations(cfg)
+            return
+        if mode != "grid":
+            raise ValueError(f"Unknown inspect_aug.mode={mode!r}. Expected one of: grid, profile")
+
         if image_path is None:
-            csv_path = processed_dir / f"{split_name}.csv"
-            if not csv_path.exists():
-                raise FileNotFoundError(f"Split CSV not found: {csv_path}")
-            df = pd.read_csv(csv_path)
+            table = SplitTable(resolve_split_path(processed_dir, split_name))
             idx = int(cfg.inspect_aug.index)
-            idx = max(0, min(idx, len(df) - 1))
-            image_path = str(df.iloc[idx]["image_path"])
+            idx = max(0, min(idx, len(table) - 1))
+            image_path = str(table.value("image_path", idx))
 
         img_path = Path(image_path)
         if not img_path.exists():
@@ -207,6 +259,7 @@ class HTRCLI:
             augment_cfg=None,
             is_train=False,
             fill=int(cfg.preprocess.pad_value),
+            backend=str(getattr(cfg.preprocess, "backend", "pil")),
             to_float_tensor=True,
         )
 
@@ -219,6 +272,7 @@ class HTRCLI:
             augment_cfg=cfg.augment,
             is_train=True,
             fill=int(cfg.preprocess.pad_value),
+            backend=str(getattr(cfg.preprocess, "backend", "pil")),
             to_float_tensor=True,
         )
 
@@ -252,6 +306,47 @@ class HTRCLI:
 
         console.print(f"Saved augmentation grid: {out_path}")
 
+    def _profile_augmentations(self, cfg) -> None:
+        report = profile_augmentations(cfg)
+
+        ops_table = Table(title=f"Augmentation latency, ms (p=1, {report['n_lines']} lines x {report['repeats']})")
+        for col in ("op", "group", "mean", "p50", "p90", "p99"):
+            ops_table.add_column(col, justify="left" if col in ("op", "group") else "right")
+        for row in report["ops"]:
+            ops_table.add_row(
+                row["name"],
+                row["group"],
+                *(f"{row[k]:.2f}" for k in ("mean_ms", "p50_ms", "p90_ms", "p99_ms")),
+            )
+        console.print(ops_table)
+
+        cfg_table = Table(title="Per-worker throughput (__getitem__ + collate)")
+        for col in ("augment", "samples/s", "p50, ms", "p99, ms", "workers/GPU"):
+            cfg_table.add_column(col, justify="left" if col == "augment" else "right")
+        for row in report["configs"]:
+            cfg_table.add_row(
+                row["config"],
+                f"{row['samples_per_sec']:.1f}",
+                f"{row['p50_ms']:.2f}",
+                f"{row['p99_ms']:.2f}",
+                str(row.get("workers_per_gpu", "-")),
+            )
+        console.print(cfg_table)
+
+        out_dir = Path(cfg.inspect_aug.out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        out_path = out_dir / "aug_profile.json"
+        out_path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+        with mlflow_run("inspect_augmentations_profile", cfg, extra_tags={"split": report["split"]}):
+            for row in report["configs"]:
+                mlflow.log_metric(f"{row['config']}_samples_per_sec", row["samples_per_sec"])
+            for row in report["ops"]:
+                mlflow.log_metric(f"op_{row['name']}_p50_ms", row["p50_ms"])
+            mlflow.log_artifact(str(out_path), artifact_path="augmentations")
+
+        console.print(f"Saved augmentation profile: {out_path}")
+
     def train_crnn_ctc(self, *overrides: str) -> None:
         cfg = load_cfg("train_crnn_ctc", overrides=list(overrides))
 
@@ -260,8 +355,16 @@ class HTRCLI:
 
             device = torch.device(cfg.train.device if torch.cuda.is_available() else "cpu")
             model, tok = load_checkpoint(result.best_checkpoint, device)
-            test_dl = make_dataloader(cfg, "test")
-            metrics = evaluate(model, test_dl, tok, device, decode_cfg=cfg.decode)
+            test_dl = make_dataloader(cfg, "test", tok)
+            metrics = evaluate(
+                model,
+                test_dl,
+                tok,
+                device,
+                decode_cfg=cfg.decode,
+                prefetch=device_prefetch(cfg),
+                metric_workers=metric_workers(cfg),
+            )
 
             mlflow.log_metric("test_loss", metrics["loss"])
             mlflow.log_metric("test_cer", metrics["cer"])
@@ -281,8 +384,16 @@ class HTRCLI:
 
             device = torch.device(cfg.train.device if torch.cuda.is_available() else "cpu")
             model, tok = vt_load_checkpoint(result.best_checkpoint, device)
-            test_dl = vt_make_dataloader(cfg, "test")
-            metrics = vt_evaluate(model, test_dl, tok, device, decode_cfg=cfg.decode)
+            test_dl = vt_make_dataloader(cfg, "test", tok)
+            metrics = vt_evaluate(
+                model,
+                test_dl,
+                tok,
+                device,
+                decode_cfg=cfg.decode,
+                prefetch=device_prefetch(cfg),
+                metric_workers=metric_workers(cfg),
+            )
 
             mlflow.log_metric("test_loss", metrics["loss"])
             mlflow.log_metric("test_cer", metrics["cer"])
@@ -305,8 +416,16 @@ class HTRCLI:
         with mlflow_run("eval_crnn_ctc", cfg, extra_tags={"split": split_name}):
             device = torch.device(cfg.eval.device if torch.cuda.is_available() else "cpu")
             model, tok = load_checkpoint(ckpt_path, device)
-            dl = make_dataloader(cfg, split_name)
-            metrics = evaluate(model, dl, tok, device, decode_cfg=cfg.decode)
+            dl = make_dataloader(cfg, split_name, tok)
+            metrics = evaluate(
+                model,
+                dl,
+                tok,
+                device,
+                decode_cfg=cfg.decode,
+                prefetch=device_prefetch(cfg),
+                metric_workers=metric_workers(cfg),
+            )
 
             mlflow.log_metric(f"{split_name}_loss", metrics["loss"])
             mlflow.log_metric(f"{split_name}_cer", metrics["cer"])
@@ -327,9 +446,17 @@ class HTRCLI:
 
         with mlflow_run("eval_vt_ctc", cfg, extra_tags={"split": split_name}):
             device = torch.device(cfg.eval.device if torch.cuda.is_available() else "cpu")
-            model, tok = vt_load_checkpoint(ckpt_path, device)
-            dl = vt_make_dataloader(cfg, split_name)
-            metrics = vt_evaluate(model, dl, tok, device, decode_cfg=cfg.decode)
+            model, tok = vt_load_checkpoint(ckpt_path, device, fast_path=bool(getattr(cfg.eval, "fast_path", False)))
+            dl = vt_make_dataloader(cfg, split_name, tok)
+            metrics = vt_evaluate(
+                model,
+                dl,
+                tok,
+                device,
+                decode_cfg=cfg.decode,
+                prefetch=device_prefetch(cfg),
+                metric_workers=metric_workers(cfg),
+            )
 
             mlflow.log_metric(f"{split_name}_loss", metrics["loss"])
             mlflow.log_metric(f"{split_name}_cer", metrics["cer"])
@@ -361,6 +488,7 @@ class HTRCLI:
             decode_method=str(getattr(cfg.decode, "method", "greedy")),
             beam_width=int(getattr(cfg.decode, "beam_width", 50)),
             topk=int(getattr(cfg.decode, "topk", 20)),
+            **chunk_options(cfg.infer),
         )
         console.print(f"{pred}")
 
@@ -385,6 +513,8 @@ class HTRCLI:
             decode_method=str(getattr(cfg.decode, "method", "greedy")),
             beam_width=int(getattr(cfg.decode, "beam_width", 50)),
             topk=int(getattr(cfg.decode, "topk", 20)),
+            fast_path=bool(getattr(cfg.infer, "fast_path", False)),
+            **chunk_options(cfg.infer),
         )
         console.print(f"{pred}")
 
@@ -397,7 +527,15 @@ class HTRCLI:
             device = torch.device(cfg.train.device if torch.cuda.is_available() else "cpu")
             model, processor = trocr_load_checkpoint(Path(result.best_checkpoint), device)
             test_dl = trocr_make_dataloader(cfg, "test", processor)
-            metrics = trocr_evaluate(model, processor, test_dl, device, generate_cfg=cfg.generate)
+            metrics = trocr_evaluate(
+                model,
+                processor,
+                test_dl,
+                device,
+                generate_cfg=cfg.generate,
+                prefetch=device_prefetch(cfg),
+                metric_workers=metric_workers(cfg),
+            )
 
             mlflow.log_metric("test_loss", metrics["loss"])
             mlflow.log_metric("test_cer", metrics["cer"])
@@ -421,7 +559,15 @@ class HTRCLI:
             device = torch.device(cfg.eval.device if torch.cuda.is_available() else "cpu")
             model, processor = trocr_load_checkpoint(ckpt_path, device)
             dl = trocr_make_dataloader(cfg, split_name, processor)
-            metrics = trocr_evaluate(model, processor, dl, device, generate_cfg=cfg.generate)
+            metrics = trocr_evaluate(
+                model,
+                processor,
+                dl,
+                device,
+                generate_cfg=cfg.generate,
+                prefetch=device_prefetch(cfg),
+                metric_workers=metric_workers(cfg),
+            )
 
             mlflow.log_metric(f"{split_name}_loss", metrics["loss"])
             mlflow.log_metric(f"{split_name}_cer", metrics["cer"])
@@ -466,8 +612,16 @@ class HTRCLI:
 
             device = torch.device(cfg.train.device if torch.cuda.is_available() else "cpu")
             model, tok = hybrid_load_checkpoint(result.best_checkpoint, device)
-            test_dl = hybrid_make_dataloader(cfg, "test")
-            metrics = hybrid_evaluate(model, test_dl, tok, device, decode_cfg=cfg.decode)
+            test_dl = hybrid_make_dataloader(cfg, "test", tok)
+            metrics = hybrid_evaluate(
+                model,
+                test_dl,
+                tok,
+                device,
+                decode_cfg=cfg.decode,
+                prefetch=device_prefetch(cfg),
+                metric_workers=metric_workers(cfg),
+            )
 
             mlflow.log_metric("test_loss", metrics["loss"])
             mlflow.log_metric("test_cer", metrics["cer"])
@@ -490,8 +644,16 @@ class HTRCLI:
         with mlflow_run("eval_hybrid_ctc", cfg, extra_tags={"split": split_name}):
             device = torch.device(cfg.eval.device if torch.cuda.is_available() else "cpu")
             model, tok = hybrid_load_checkpoint(ckpt_path, device)
-            dl = hybrid_make_dataloader(cfg, split_name)
-            metrics = hybrid_evaluate(model, dl, tok, device, decode_cfg=cfg.decode)
+            dl = hybrid_make_dataloader(cfg, split_name, tok)
+            metrics = hybrid_evaluate(
+                model,
+                dl,
+                tok,
+                device,
+                decode_cfg=cfg.decode,
+                prefetch=device_prefetch(cfg),
+                metric_workers=metric_workers(cfg),
+            )
 
             mlflow.log_metric(f"{split_name}_loss", metrics["loss"])
             mlflow.log_metric(f"{split_name}_cer", metrics["cer"])
@@ -523,6 +685,7 @@ class HTRCLI:
             decode_method=str(getattr(cfg.decode, "method", "beam")),
             beam_width=int(getattr(cfg.decode, "beam_width", 50)),
             topk=int(getattr(cfg.decode, "topk", 20)),
+            **chunk_options(cfg.infer),
         )
         console.print(f"{pred}")
 
@@ -0,0 +1,187 @@
+import math
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+from omegaconf import DictConfig, OmegaConf
+from PIL import Image
+
+from htr_ocr.config_loader import configs_dir
+from htr_ocr.data.collate import collate_line_batch
+from htr_ocr.data.dataset import IamLineDataset
+from htr_ocr.data.packed import resolve_packed_dir
+from htr_ocr.data.preprocess_cache import make_preprocess_cache
+from htr_ocr.data.split_store import resolve_split_path
+from htr_ocr.data.transforms import LineImageTransform, build_augment_ops, make_image_transform
+
+
+def _latency_stats(seconds: list[float]) -> dict[str, float]:
+    ms = np.asarray(seconds, dtype=np.float64) * 1000.0
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def _enabled_augment(augment_cfg: Any) -> DictConfig:
+    """Копия конфига аугментаций с enabled=true — так, как его увидит тренер с augment.enabled=true."""
+    aug = OmegaConf.create(OmegaConf.to_container(augment_cfg, resolve=True))
+    aug.enabled = True
+    return aug
+
+
+def load_augment_cfg(name: str) -> DictConfig:
+    path = configs_dir() / "augment" / f"{name}.yaml"
+    if not path.exists():
+        raise FileNotFoundError(f"Augment config not found: {path}")
+    return OmegaConf.load(path)
+
+
+def _make_transform(cfg, augment_cfg: Any | None, backend: str) -> LineImageTransform:
+    return make_image_transform(
+        height=int(cfg.preprocess.height),
+        keep_aspect=bool(cfg.preprocess.keep_aspect),
+        tight_crop_enabled=bool(cfg.preprocess.tight_crop.enabled),
+        tight_crop_threshold=int(cfg.preprocess.tight_crop.threshold),
+        tight_crop_margin=int(cfg.preprocess.tight_crop.margin),
+        augment_cfg=augment_cfg,
+        is_train=augment_cfg is not None,
+        fill=int(cfg.preprocess.pad_value),
+        backend=backend,
+        to_float_tensor=True,
+    )
+
+
+def _make_dataset(cfg, split: str, transform: LineImageTransform | None) -> IamLineDataset:
+    return IamLineDataset(
+        csv_path=resolve_split_path(Path(cfg.data.processed_dir), split),
+        transform=transform,
+        target_height=int(cfg.preprocess.height),
+        packed_dir=resolve_packed_dir(cfg, split),
+        preprocess_cache=make_preprocess_cache(cfg),
+    )
+
+
+def _sample_indices(n_total: int, n: int) -> list[int]:
+    # равномерно по сплиту, чтобы попали строки разной ширины
+    n = max(1, min(int(n), n_total))
+    return np.linspace(0, n_total - 1, n).round().astype(np.int64).tolist()
+
+
+def sample_lines(cfg, split: str, n_lines: int) -> list[Image.Image]:
+    """Реальные строки сплита после convert("L") + TightCrop — то, что получают аугментации."""
+    tf = _make_transform(cfg, _enabled_augment(cfg.augment), backend="pil")
+    ds = _make_dataset(cfg, split, transform=None)
+    lines = []
+    for i in _sample_indices(len(ds), n_lines):
+        img = ds[i]["pixel_values"]
+        lines.append(tf.prepare(img))
+    return lines
+
+
+def time_op(op: Callable[[Image.Image], Image.Image], images: list[Image.Image], repeats: int, warmup: int) -> list[float]:
+    for img in images[: max(0, int(warmup))]:
+        op(img)
+    seconds: list[float] = []
+    for _ in range(max(1, int(repeats))):
+        for img in images:
+            t0 = time.perf_counter()
+            op(img)
+            seconds.append(time.perf_counter() - t0)
+    return seconds
+
+
+def profile_ops(cfg, images: list[Image.Image], repeats: int = 3, warmup: int = 2) -> list[dict[str, Any]]:
+    """
+    Каждая аугментация из _build_train_augment отдельно, с p=1 (чистая цена одного применения),
+    плюс resize после неё — он тоже переезжает из кэша в обучение, когда аугментации включены.
+    """
+    fill = int(cfg.preprocess.pad_value)
+    named, geo_named = build_augment_ops(cfg.augment, fill=fill, p_each=1.0)
+    resize = _make_transform(cfg, None, backend="pil").resize
+
+    rows = []
+    for group, ops in (("top", named), ("geometric", geo_named)):
+        for name, op in ops:
+            stats = _latency_stats(time_op(op, images, repeats, warmup))
+            rows.append({"name": name, "group": group, **stats})
+    rows.append({"name": "resize", "group": "preprocess", **_latency_stats(time_op(resize, images, repeats, warmup))})
+    return rows
+
+
+def measure_throughput(
+    cfg,
+    augment_cfg: Any,
+    split: str,
+    n_lines: int,
+    repeats: int = 3,
+    warmup: int = 2,
+) -> dict[str, float]:
+    """
+    samples/sec одного воркера DataLoader: __getitem__ (чтение, препроцессинг, аугментации) + collate.
+    Считается в текущем процессе, последовательно — воркеры масштабируются примерно линейно.
+    """
+    backend = str(getattr(cfg.preprocess, "backend", "pil"))
+    ds = _make_dataset(cfg, split, _make_transform(cfg, _enabled_augment(augment_cfg), backend=backend))
+    idx = _sample_indices(len(ds), n_lines) * max(1, int(repeats))
+    bs = max(1, int(cfg.loader.batch_size))
+    pad_value = float(cfg.preprocess.pad_value) / 255.0
+
+    for i in idx[: max(0, int(warmup))]:
+        ds[i]
+
+    per_sample: list[float] = []
+    t_start = time.perf_counter()
+    for b in range(0, len(idx), bs):
+        items = []
+        for i in idx[b : b + bs]:
+            t0 = time.perf_counter()
+            items.append(ds[i])
+            per_sample.append(time.perf_counter() - t0)
+        collate_line_batch(items, pad_value=pad_value)
+    elapsed = time.perf_counter() - t_start
+
+    return {
+        "samples": len(idx),
+        "samples_per_sec": float(len(idx) / max(elapsed, 1e-9)),
+        **_latency_stats(per_sample),
+    }
+
+
+def profile_augmentations(cfg) -> dict[str, Any]:
+    """
+    inspect_aug.mode=profile: цена каждой аугментации на реальных строках и
+    пропускная способность одного воркера для нескольких конфигов augment/*.yaml.
+    """
+    prof = cfg.inspect_aug.profile
+    split = str(cfg.loader.split)
+    n_lines = int(getattr(prof, "n_lines", 64))
+    repeats = int(getattr(prof, "repeats", 3))
+    warmup = int(getattr(prof, "warmup", 2))
+    gpu_rate = float(getattr(prof, "gpu_samples_per_sec", 0.0))
+
+    images = sample_lines(cfg, split, n_lines)
+    ops = profile_ops(cfg, images, repeats=repeats, warmup=warmup)
+
+    configs = []
+    for name in list(getattr(prof, "configs", ["off", "paper"])):
+        stats = measure_throughput(cfg, load_augment_cfg(str(name)), split, n_lines, repeats=repeats, warmup=warmup)
+        row: dict[str, Any] = {"config": str(name), **stats}
+        if gpu_rate > 0:
+            # сколько воркеров нужно, чтобы загрузка не отставала от одного GPU
+            row["workers_per_gpu"] = int(math.ceil(gpu_rate / max(stats["samples_per_sec"], 1e-9)))
+        configs.append(row)
+
+    return {
+        "split": split,
+        "n_lines": len(images),
+        "repeats": repeats,
+        "backend": str(getattr(cfg.preprocess, "backend", "pil")),
+        "data_backend": str(getattr(cfg.data, "backend", "files")),
+        "gpu_samples_per_sec": gpu_rate,
+        "ops": ops,
+        "configs": configs,
+    }
@@ -1,10 +1,12 @@
 import math
+import os
 import random
 from dataclasses import dataclass
 from typing import Callable, Sequence
 
 
-from torchvision.transforms.functional import affine
+import torch
+from torchvision.transforms.functional import InterpolationMode, affine, elastic_transform, gaussian_blur
 import torchvision.transforms as T
 
 from PIL import Image
@@ -145,21 +147,106 @@ class RandomDistort:
         )
 
 
+class ElasticFieldBank:
+    """
+    Пул сглаженных полей шума для RandomElastic.
+
+    Поле = gaussian_blur(U[-1, 1]) с тем же ядром, что в T.ElasticTransform, только считается
+    заранее на холсте field_size. Для картинки берётся случайное поле, случайный сдвиг
+    и зеркальное тайлирование до [H, W], плюс случайные знаки/перестановка осей —
+    шум стационарный, поэтому статистика смещений та же, что у свежего поля.
+    Раз в refresh_every выдач одно поле пересчитывается.
+    """
+
+    def __init__(
+        self,
+        sigma: float,
+        bank_size: int = 8,
+        refresh_every: int = 64,
+        field_size: tuple[int, int] = (256, 1024),
+    ) -> None:
+        self.sigma = float(sigma)
+        self.bank_size = max(1, int(bank_size))
+        self.refresh_every = max(0, int(refresh_every))
+        self.field_size = (int(field_size[0]), int(field_size[1]))
+        self.pid = os.getpid()
+
+        self._fields = [self._make_field() for _ in range(self.bank_size)]
+        self._draws = 0
+        self._next_refresh = 0
+
+    def _make_field(self) -> torch.Tensor:
+        field = torch.rand([2, 1, *self.field_size]) * 2 - 1
+        if self.sigma > 0.0:
+            k = int(8 * self.sigma + 1)
+            if k % 2 == 0:
+                k += 1
+            field = gaussian_blur(field, [k, k], [self.sigma, self.sigma])
+        return field[:, 0]
+
+    @staticmethod
+    def _mirror_index(n: int, period: int, offset: int) -> torch.Tensor:
+        i = (torch.arange(n) + offset) % (2 * period)
+        return torch.where(i < period, i, 2 * period - 1 - i)
+
+    def sample(self, height: int, width: int) -> torch.Tensor:
+        """Поле [2, H, W] (dx, dy) до умножения на alpha."""
+        self._draws += 1
+        if self.refresh_every and self._draws % self.refresh_every == 0:
+            self._fields[self._next_refresh] = self._make_field()
+            self._next_refresh = (self._next_refresh + 1) % self.bank_size
+
+        field = self._fields[random.randrange(self.bank_size)]
+        fh, fw = self.field_size
+        rows = self._mirror_index(int(height), fh, random.randrange(2 * fh))
+        cols = self._mirror_index(int(width), fw, random.randrange(2 * fw))
+        out = field[:, rows[:, None], cols[None, :]]
+
+        if random.random() < 0.5:
+            out = out.flip(0)
+        signs = torch.tensor([random.choice((-1.0, 1.0)), random.choice((-1.0, 1.0))])
+        return out * signs[:, None, None]
+
+
+# банки живут в процессе (в каждом воркере DataLoader свой), ключ — параметры банка
+_FIELD_BANKS: dict[tuple[float, int, int], ElasticFieldBank] = {}
+
+
+def get_elastic_field_bank(sigma: float, bank_size: int, refresh_every: int) -> ElasticFieldBank:
+    key = (float(sigma), int(bank_size), int(refresh_every))
+    bank = _FIELD_BANKS.get(key)
+    # после fork воркер получил бы копию банка родителя с теми же полями
+    if bank is None or bank.pid != os.getpid():
+        bank = ElasticFieldBank(sigma=sigma, bank_size=bank_size, refresh_every=refresh_every)
+        _FIELD_BANKS[key] = bank
+    return bank
+
+
 @dataclass(frozen=True)
 class RandomElastic:
-    """Эластичное преобразование"""
+    """Эластичное преобразование. bank_size > 0 — поля смещений берутся из ElasticFieldBank."""
 
     alpha: float = 40.0
     sigma: float = 6.0
     p: float = 0.5
     fill: int = 255
+    bank_size: int = 0
+    bank_refresh: int = 64
 
     def __call__(self, img: Image.Image) -> Image.Image:
         if random.random() > self.p:
             return img
 
-        t = T.ElasticTransform(alpha=float(self.alpha), sigma=float(self.sigma), fill=self.fill)
-        return t(img)
+        if int(self.bank_size) <= 0:
+            t = T.ElasticTransform(alpha=float(self.alpha), sigma=float(self.sigma), fill=self.fill)
+            return t(img)
+
+        w, h = img.size
+        bank = get_elastic_field_bank(self.sigma, self.bank_size, self.bank_refresh)
+        dx, dy = bank.sample(h, w)
+        # нормировка как в T.ElasticTransform.get_params (torchvision 0.20): dx * alpha / H, dy * alpha / W
+        displacement = torch.stack([dx * float(self.alpha) / h, dy * float(self.alpha) / w], dim=-1)[None]
+        return elastic_transform(img, displacement, interpolation=InterpolationMode.BILINEAR, fill=self.fill)
 
 
 @dataclass(frozen=True)
@@ -176,3 +263,18 @@ class RandomOneOf:
             return img
         t = random.choice(list(self.transforms))
         return t(img)
+
+
+@dataclass(frozen=True)
+class RandomApplyAll:
+    """С вероятностью p_total применяем все аугментации подряд (augment.one_of=false)."""
+
+    transforms: Sequence[Callable[[Image.Image], Image.Image]]
+    p_total: float = 0.5
+
+    def __call__(self, img: Image.Image) -> Image.Image:
+        if random.random() > self.p_total:
+            return img
+        for t in self.transforms:
+            img = t(img)
+        return img
@@ -0,0 +1,374 @@
+import math
+from dataclasses import dataclass
+from typing import Any
+
+import torch
+import torch.nn.functional as F
+
+# порядок как в _build_train_augment: shear -> rotate -> elastic -> one_of(geometric)
+TOP_OPS = ("shear", "rotate", "elastic", "geometric")
+GEO_OPS = ("distort", "stretch", "perspective")
+
+
+def _uniform(n: int, low: float | torch.Tensor, high: float | torch.Tensor) -> torch.Tensor:
+    return low + (high - low) * torch.rand(n)
+
+
+def _inside(x: torch.Tensor, y: torch.Tensor, w: torch.Tensor, h: int) -> torch.Tensor:
+    return (x >= -0.5) & (x <= w - 0.5) & (y >= -0.5) & (y <= h - 0.5)
+
+
+def _perspective_homographies(w: torch.Tensor, h: int, scale: float) -> torch.Tensor:
+    """
+    Углы как в T.RandomPerspective.get_params, матрица как в F.perspective:
+    точка выхода (endpoint) -> точка входа (startpoint), координаты в пикселях.
+    """
+    n = int(w.numel())
+    wi = w.to(torch.int64)
+    bw = (scale * (wi // 2)).to(torch.int64) + 1
+    bh = int(scale * (h // 2)) + 1
+
+    def rx() -> torch.Tensor:
+        return (torch.rand(n) * bw).floor()
+
+    def ry() -> torch.Tensor:
+        return torch.randint(0, bh, (n,)).to(torch.float64)
+
+    wf = wi.to(torch.float64)
+    end = torch.stack(
+        [
+            torch.stack([rx(), ry()], -1),
+            torch.stack([wf - rx() - 1, ry()], -1),
+            torch.stack([wf - rx() - 1, h - ry() - 1], -1),
+            torch.stack([rx(), h - ry() - 1], -1),
+        ],
+        dim=1,
+    )
+    zeros = torch.zeros_like(wf)
+    start = torch.stack(
+        [
+            torch.stack([zeros, zeros], -1),
+            torch.stack([wf - 1, zeros], -1),
+            torch.stack([wf - 1, zeros + h - 1], -1),
+            torch.stack([zeros, zeros + h - 1], -1),
+        ],
+        dim=1,
+    )
+
+    a = torch.zeros(n, 8, 8, dtype=torch.float64)
+    ex, ey = end[..., 0], end[..., 1]
+    sx, sy = start[..., 0], start[..., 1]
+    a[:, 0::2, 0], a[:, 0::2, 1], a[:, 0::2, 2] = ex, ey, 1.0
+    a[:, 0::2, 6], a[:, 0::2, 7] = -sx * ex, -sx * ey
+    a[:, 1::2, 3], a[:, 1::2, 4], a[:, 1::2, 5] = ex, ey, 1.0
+    a[:, 1::2, 6], a[:, 1::2, 7] = -sy * ex, -sy * ey
+    b = torch.stack([sx, sy], dim=-1).reshape(n, 8)
+    coeffs = torch.linalg.solve(a, b)
+    return torch.cat([coeffs, torch.ones(n, 1, dtype=torch.float64)], dim=1).reshape(n, 3, 3).float()
+
+
+def _gaussian_blur_per_sample(x: torch.Tensor, sigmas: torch.Tensor) -> torch.Tensor:
+    """
+    x: [N, C, H, W], у каждого сэмпла своя sigma. Ядро как у F.gaussian_blur (k = int(8*sigma + 1) | 1),
+    все ядра дополнены нулями до максимального, чтобы свёртка шла одним grouped conv.
+    """
+    n, c, h, w = x.shape
+    ks = [int(8 * float(s) + 1) | 1 for s in sigmas.tolist()]
+    k_max = max(ks)
+    half = min(k_max // 2, h - 1, w - 1)
+    k_max = 2 * half + 1
+    if half <= 0:
+        return x
+
+    t = torch.arange(k_max, dtype=torch.float32, device=x.device) - half
+    sig = sigmas.to(device=x.device, dtype=torch.float32).clamp_min(1e-6)[:, None]
+    radius = torch.tensor([k // 2 for k in ks], device=x.device, dtype=torch.float32)[:, None]
+    kernel = torch.exp(-0.5 * (t[None, :] / sig) ** 2) * (t[None, :].abs() <= radius)
+    kernel = kernel / kernel.sum(dim=1, keepdim=True)
+    kernel = kernel.repeat_interleave(c, dim=0)  # [N*C, K]
+
+    y = x.reshape(1, n * c, h, w)
+    y = F.pad(y, (half, half, half, half), mode="reflect")
+    y = F.conv2d(y, kernel[:, None, None, :], groups=n * c)
+    y = F.conv2d(y, kernel[:, None, :, None], groups=n * c)
+    return y.reshape(n, c, h, w)
+
+
+@dataclass(frozen=True)
+class BatchLineAugment:
+    """
+    Те же аугментации, что собирает _build_train_augment, но на всём батче после collate_line_batch:
+    для каждого сэмпла строится обратное отображение координат (растяжение/сетка/перспектива ->
+    эластика -> поворот -> наклон), и картинки сэмплируются одним grid_sample.
+
+    Выбор операций и распределения параметров повторяют PIL-версию (p, one_of, p_each).
+    Пиксельные параметры (max_shift_px, sigma) заданы для исходной картинки, поэтому
+    умножаются на target_h / height (height берётся из meta). Работает на любом device.
+    """
+
+    p: float = 0.5
+    one_of: bool = True
+    p_each: float = 1.0
+    shear_degrees: float | None = None
+    rotate_degrees: float | None = None
+    elastic_alpha: float | None = None
+    elastic_sigma: float = 6.0
+    distort_shift_px: float | None = None
+    distort_stripes: int = 12
+    stretch_factor: float | None = None
+    perspective_scale: float | None = None
+    fill: float = 1.0
+    on_device: bool = False
+
+    def _top_ops(self) -> list[str]:
+        ops = [
+            name
+            for name, value in (
+                ("shear", self.shear_degrees),
+                ("rotate", self.rotate_degrees),
+                ("elastic", self.elastic_alpha),
+            )
+            if value is not None
+        ]
+        if self._geo_ops():
+            ops.append("geometric")
+        return ops
+
+    def _geo_ops(self) -> list[str]:
+        return [
+            name
+            for name, value in (
+                ("distort", self.distort_shift_px),
+                ("stretch", self.stretch_factor),
+                ("perspective", self.perspective_scale),
+            )
+            if value is not None
+        ]
+
+    def sample_ops(self, n: int) -> dict[str, torch.Tensor]:
+        """Маски [n] активных операций для каждого сэмпла."""
+        top = self._top_ops()
+        geo = self._geo_ops()
+        active = {name: torch.zeros(n, dtype=torch.bool) for name in (*TOP_OPS[:3], *GEO_OPS)}
+        if not top:
+            return active
+
+        gate = torch.rand(n) <= float(self.p)
+        if self.one_of:
+            pick = torch.randint(len(top), (n,))
+            chosen = {name: gate & (pick == i) for i, name in enumerate(top)}
+        else:
+            chosen = {name: gate for name in top}
+
+        p_each = float(self.p_each)
+        for name in top:
+            if name != "geometric":
+                active[name] = chosen[name] & (torch.rand(n) <= p_each)
+        if "geometric" in chosen:
+            gpick = torch.randint(len(geo), (n,))
+            for i, name in enumerate(geo):
+                active[name] = chosen["geometric"] & (gpick == i) & (torch.rand(n) <= p_each)
+        return active
+
+    def __call__(self, batch: dict[str, Any], device: torch.device | str | None = None) -> dict[str, Any]:
+        x = batch["pixel_values"]
+        if device is not None:
+            x = x.to(device, non_blocking=True)
+        if x.dtype == torch.uint8:
+            # uint8-батч (loader.collate.uint8): варпы считаются во float
+            x = x.to(torch.float32).div_(255.0)
+
+        b, _, h, w_in = x.shape
+        widths = torch.tensor([int(v) for v in batch["widths"]], dtype=torch.float32)
+        src_h = torch.tensor(
+            [float((m or {}).get("height") or h) for m in batch.get("meta", [{}] * b)],
+            dtype=torch.float32,
+        )
+        scale = h / src_h.clamp_min(1.0)
+
+        ops = self.sample_ops(b)
+        idx = torch.stack(list(ops.values())).any(dim=0).nonzero().flatten()
+
+        new_w = widths.clone()
+        if self.stretch_factor is not None:
+            f = _uniform(b, 1.0 - float(self.stretch_factor), 1.0 + float(self.stretch_factor))
+            stretched = torch.clamp(torch.round(widths * f), min=1.0)
+            new_w = torch.where(ops["stretch"], stretched, widths)
+
+        # растяжение может как расширить холст, так и сузить (все строки стали короче)
+        w_out = int(new_w.max().item())
+        out = x[..., :w_out]
+        if w_out > w_in:
+            out = F.pad(out, (0, w_out - w_in), value=float(self.fill))
+        if idx.numel() > 0:
+            warped = self._warp(x[idx.to(x.device)], widths[idx], new_w[idx], scale[idx], {k: v[idx] for k, v in ops.items()}, w_out)
+            out = out.clone()
+            out[idx.to(x.device)] = warped
+
+        mask = torch.arange(w_out, device=x.device)[None, :] < new_w.to(x.device)[:, None]
+        out = torch.where(mask[:, None, None, :], out, torch.full_like(out, float(self.fill)))
+
+        result = dict(batch)
+        result["pixel_values"] = out
+        result["pixel_mask"] = mask
+        result["widths"] = [int(v) for v in new_w.tolist()]
+        return result
+
+    def _warp(
+        self,
+        x: torch.Tensor,
+        w: torch.Tensor,
+        new_w: torch.Tensor,
+        scale: torch.Tensor,
+        ops: dict[str, torch.Tensor],
+        w_out: int,
+    ) -> torch.Tensor:
+        n, _, h, w_in = x.shape
+        dev = x.device
+
+        def col(v: torch.Tensor) -> torch.Tensor:
+            return v.to(device=dev, dtype=torch.float32)[:, None, None]
+
+        wc = col(w)
+        ys, xs = torch.meshgrid(
+            torch.arange(h, device=dev, dtype=torch.float32),
+            torch.arange(w_out, device=dev, dtype=torch.float32),
+            indexing="ij",
+        )
+        gx = xs.expand(n, h, w_out).clone()
+        gy = ys.expand(n, h, w_out).clone()
+        valid = torch.ones(n, h, w_out, dtype=torch.bool, device=dev)
+
+        # geometric: растяжение меняет ширину холста, сетка и перспектива — нет
+        if bool(ops["stretch"].any()):
+            r = col(torch.where(ops["stretch"], w / new_w, torch.ones_like(w)))
+            gx = (gx + 0.5) * r - 0.5
+
+        if bool(ops["distort"].any()):
+            stripes = max(2, int(self.distort_stripes))
+            amp = max(1, int(float(self.distort_shift_px))) * scale * ops["distort"]
+            period = _uniform(n, w * 0.6, w * 1.4)
+            phase = _uniform(n, 0.0, 2 * math.pi)
+            t = (gx * stripes / wc).clamp(0, stripes - 1e-4)
+            k = t.floor()
+            x0 = k * wc / stripes
+            x1 = (k + 1) * wc / stripes
+            s0 = col(amp) * torch.sin(2 * math.pi * x0 / col(period) + col(phase))
+            s1 = col(amp) * torch.sin(2 * math.pi * x1 / col(period) + col(phase))
+            small = col(((w < 4) | (h < 4)).float())
+            gy = gy - (s0 + (t - k) * (s1 - s0)) * (1 - small)
+
+        if bool(ops["perspective"].any()):
+            hom = _perspective_homographies(w, h, float(self.perspective_scale)).to(dev)
+            hom[~ops["perspective"].to(dev)] = torch.eye(3, device=dev)
+            den = hom[:, 2, 0, None, None] * gx + hom[:, 2, 1, None, None] * gy + 1.0
+            px = (hom[:, 0, 0, None, None] * gx + hom[:, 0, 1, None, None] * gy + hom[:, 0, 2, None, None]) / den
+            py = (hom[:, 1, 0, None, None] * gx + hom[:, 1, 1, None, None] * gy + hom[:, 1, 2, None, None]) / den
+            gx, gy = px, py
+
+        valid &= _inside(gx, gy, wc, h)
+
+        if bool(ops["elastic"].any()):
+            gx, gy = self._elastic(gx, gy, w, scale, ops["elastic"], h, w_in)
+            valid &= _inside(gx, gy, wc, h)
+
+        if bool(ops["rotate"].any()):
+            deg = _uniform(n, -float(self.rotate_degrees), float(self.rotate_degrees)) * ops["rotate"]
+            a = torch.deg2rad(deg)
+            cos, sin = col(torch.cos(a)), col(torch.sin(a))
+            cx, cy = gx + 0.5 - wc / 2, gy + 0.5 - h / 2
+            # как Image.rotate: положительный угол — против часовой стрелки
+            gx = cos * cx - sin * cy + wc / 2 - 0.5
+            gy = sin * cx + cos * cy + h / 2 - 0.5
+            valid &= _inside(gx, gy, wc, h)
+
+        if bool(ops["shear"].any()):
+            deg = _uniform(n, -float(self.shear_degrees), float(self.shear_degrees)) * ops["shear"]
+            tan = col(torch.tan(torch.deg2rad(deg)))
+            gx = gx + tan * (gy + 0.5 - h / 2)
+            valid &= _inside(gx, gy, wc, h)
+
+        # pixel -> [-1, 1] (align_corners=False); невалидные точки уводим за холст -> fill
+        grid = torch.stack([(2 * gx + 1) / w_in - 1, (2 * gy + 1) / h - 1], dim=-1)
+        grid = torch.where(valid[..., None], grid, torch.full_like(grid, -2.0))
+        fill = float(self.fill)
+        y = F.grid_sample(x - fill, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+        return y + fill
+
+    def _elastic(
+        self,
+        gx: torch.Tensor,
+        gy: torch.Tensor,
+        w: torch.Tensor,
+        scale: torch.Tensor,
+        active: torch.Tensor,
+        h: int,
+        w_in: int,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Как T.ElasticTransform: равномерный шум [-1, 1] сглаживается гауссом sigma и масштабируется
+        alpha / height (по x) и alpha / width (по y) в нормированных координатах исходной картинки.
+        """
+        n = gx.shape[0]
+        dev = gx.device
+        sel = active.nonzero().flatten()
+        noise = torch.rand(int(sel.numel()), 2, h, w_in, device=dev) * 2 - 1
+        sigma = float(self.elastic_sigma) * scale[sel]
+        if float(self.elastic_sigma) > 0:
+            noise = _gaussian_blur_per_sample(noise, sigma)
+
+        alpha = float(self.elastic_alpha) * scale[sel]
+        ws = w[sel]
+        # нормированное смещение -> пиксели текущего холста
+        kx = (alpha / h * ws / 2).to(dev)[:, None, None, None]
+        ky = (alpha / ws * h / 2).to(dev)[:, None, None, None]
+        field = torch.zeros(n, 2, h, w_in, device=dev)
+        field[sel.to(dev)] = torch.cat([noise[:, :1] * kx, noise[:, 1:] * ky], dim=1)
+
+        grid = torch.stack([(2 * gx + 1) / w_in - 1, (2 * gy + 1) / h - 1], dim=-1)
+        disp = F.grid_sample(field, grid, mode="bilinear", padding_mode="border", align_corners=False)
+        return gx + disp[:, 0], gy + disp[:, 1]
+
+
+def make_batch_augment(cfg) -> BatchLineAugment | None:
+    """augment.batched.enabled=true -> BatchLineAugment с теми же ручками, что и PIL-аугментации."""
+    augment_cfg = getattr(cfg, "augment", None)
+    if augment_cfg is None or not bool(getattr(augment_cfg, "enabled", False)):
+        return None
+    batched = getattr(augment_cfg, "batched", None)
+    if batched is None or not bool(getattr(batched, "enabled", False)):
+        return None
+    # augment.pregenerated.enabled=true: варианты уже отрендерены pregenerate_augment
+    pregenerated = getattr(augment_cfg, "pregenerated", None)
+    if pregenerated is not None and bool(getattr(pregenerated, "enabled", False)):
+        return None
+
+    def _section(parent: Any, name: str) -> Any | None:
+        sec = getattr(parent, name, None) if parent is not None else None
+        if sec is None or not bool(getattr(sec, "enabled", True)):
+            return None
+        return sec
+
+    shear = _section(augment_cfg, "shear")
+    rotate = _section(augment_cfg, "rotate")
+    elastic = _section(augment_cfg, "elastic")
+    geo = _section(augment_cfg, "geometric")
+    distort = _section(geo, "distortion")
+    stretch = _section(geo, "stretch")
+    perspective = _section(geo, "perspective")
+
+    return BatchLineAugment(
+        p=float(getattr(augment_cfg, "p", 0.5)),
+        one_of=bool(getattr(augment_cfg, "one_of", True)),
+        p_each=float(getattr(augment_cfg, "p_each", 1.0)),
+        shear_degrees=float(getattr(shear, "max_degrees", 7.0)) if shear is not None else None,
+        rotate_degrees=float(getattr(rotate, "max_degrees", 3.0)) if rotate is not None else None,
+        elastic_alpha=float(getattr(elastic, "alpha", 40.0)) if elastic is not None else None,
+        elastic_sigma=float(getattr(elastic, "sigma", 6.0)) if elastic is not None else 6.0,
+        distort_shift_px=float(getattr(distort, "max_shift_px", 6)) if distort is not None else None,
+        distort_stripes=int(getattr(distort, "num_stripes", 12)) if distort is not None else 12,
+        stretch_factor=float(getattr(stretch, "max_factor", 0.15)) if stretch is not None else None,
+        perspective_scale=float(getattr(perspective, "distortion_scale", 0.2)) if perspective is not None else None,
+        fill=float(cfg.preprocess.pad_value) / 255.0,
+        on_device=bool(getattr(batched, "on_device", False)),
+    )
@@ -1,22 +1,95 @@
-from typing import Any
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable
+import numpy as np
 import torch
 import torch.nn.functional as F
 
+from htr_ocr.utils.loader_stats import BATCH_STATS_KEY, batch_stats
 
-def collate_line_batch(batch: list[dict[str, Any]], pad_value: float = 1.0) -> dict[str, Any]:
+
+# storage слотов BatchBuffer -> event последней асинхронной копии из слота на устройство (None — копий не было)
+_slot_events: dict[int, Any] = {}
+
+
+class BatchBuffer:
+    """
+    Кольцо из slots предвыделенных uint8 буферов [B, 1, H, W] (pinned, если pin=True).
+    Батч — непрерывный view в очередной слот; слот растёт, только если батч в него не влез.
+
+    Только для num_workers=0: из воркеров DataLoader тензоры уходят через shared memory,
+    и переиспользовать их память нельзя. Копия из pinned-слота на CUDA асинхронна:
+    pixels_to_device отмечает её event, и get ждёт его, прежде чем снова отдать слот.
+    Копия должна быть поставлена в очередь до повторной выдачи слота — поэтому slots
+    больше, чем батчей в полёте у BatchPrefetcher (см. collate_options).
+    """
+
+    def __init__(self, slots: int = 2, pin: bool = False) -> None:
+        self.slots = max(1, int(slots))
+        self.pin = bool(pin)
+        self._bufs: list[torch.Tensor | None] = [None] * self.slots
+        self._next = 0
+
+    def get(self, b: int, h: int, w: int) -> torch.Tensor:
+        i = self._next
+        self._next = (i + 1) % self.slots
+        n = int(b) * int(h) * int(w)
+        buf = self._bufs[i]
+        if buf is not None:
+            event = _slot_events.get(buf.untyped_storage().data_ptr())
+            if event is not None:
+                event.synchronize()
+        if buf is None or buf.numel() < n:
+            if buf is not None:
+                _slot_events.pop(buf.untyped_storage().data_ptr(), None)
+            # плоский буфер: view [B, 1, H, W] на его начало всегда непрерывный
+            buf = torch.empty((n,), dtype=torch.uint8, pin_memory=self.pin)
+            self._bufs[i] = buf
+            _slot_events[buf.untyped_storage().data_ptr()] = None
+        return buf[:n].view(int(b), 1, int(h), int(w))
+
+    def __del__(self) -> None:
+        for buf in self._bufs:
+            if buf is not None:
+                _slot_events.pop(buf.untyped_storage().data_ptr(), None)
+
+
+def _as_uint8(img: torch.Tensor) -> torch.Tensor:
+    if img.dtype == torch.uint8:
+        return img
+    return img.mul(255.0).round_().clamp_(0, 255).to(torch.uint8)
+
+
+def collate_line_batch(
+    batch: list[dict[str, Any]],
+    pad_value: float = 1.0,
+    batch_transform: Callable[[dict[str, Any]], dict[str, Any]] | None = None,
+    uint8: bool = False,
+    width_multiple: int = 1,
+    buffer: BatchBuffer | None = None,
+) -> dict[str, Any]:
     """
     Аргументы:
-    pixel_values: torch.FloatTensor [1, H, W] (значения из [0,1])
+    pixel_values: torch.FloatTensor [1, H, W] (значения из [0,1]) или uint8 [1, H, W]
     text: str
 
     Возвращает:
     pixel_values: [B, 1, H, Wmax]
     pixel_mask:  [B, Wmax] (1 для настоящих, 0 для паддинга)
+
+    uint8=True: pixel_values — uint8 [B, 1, H, Wmax], картинки пишутся сразу в один тензор
+    (или в buffer), в [0,1] переводит pixels_to_device уже на устройстве.
+    width_multiple: Wmax округляется вверх до кратного (меньше разных форм для cuDNN / torch.compile).
+    batch_transform: применяется к готовому батчу (например, BatchLineAugment в воркерах)
+    stats: паддинг, время сборки и загрузки (load_s из датасета) для LoaderStats
+    targets / target_lengths: если датасет отдаёт target_ids (IamLineDataset с tokenizer)
     """
 
     if not batch:
         raise ValueError("Empty batch")
-    
+    t0 = time.perf_counter()
+
     imgs = [b["pixel_values"] for b in batch]
     texts = [str(b.get("text", "")) for b in batch]
 
@@ -26,22 +99,36 @@ def collate_line_batch(batch: list[dict[str, Any]], pad_value: float = 1.0) -> d
         raise ValueError(f"Different images height. Current heights={sorted(set(heights))}")
 
     w_max = max(widths)
-    padded = []
-    masks = []
-
-    for img, w in zip(imgs, widths, strict=True):
-        pad_right = w_max - w
-        if pad_right < 0:
-            raise RuntimeError("Negative padding")
-        if pad_right:
-            img = F.pad(img, pad=(0, pad_right, 0, 0), mode="constant", value=float(pad_value))
-        padded.append(img)
-        mask = torch.zeros((w_max,), dtype=torch.bool)
-        mask[:w] = True
-        masks.append(mask)
-
-    pixel_values = torch.stack(padded, dim=0)  # [B, 1, H, W]
-    pixel_mask = torch.stack(masks, dim=0)  # [B, W]
+    m = max(1, int(width_multiple))
+    w_max = int(math.ceil(w_max / m) * m)
+
+    if uint8:
+        h = heights[0]
+        if buffer is not None:
+            pixel_values = buffer.get(len(imgs), h, w_max)
+        else:
+            pixel_values = torch.empty((len(imgs), 1, h, w_max), dtype=torch.uint8)
+        pixel_values.fill_(int(round(float(pad_value) * 255.0)))
+        for i, (img, w) in enumerate(zip(imgs, widths, strict=True)):
+            pixel_values[i, :, :, :w].copy_(_as_uint8(img))
+        pixel_mask = torch.arange(w_max)[None, :] < torch.tensor(widths)[:, None]
+    else:
+        padded = []
+        masks = []
+
+        for img, w in zip(imgs, widths, strict=True):
+            pad_right = w_max - w
+            if pad_right < 0:
+                raise RuntimeError("Negative padding")
+            if pad_right:
+                img = F.pad(img, pad=(0, pad_right, 0, 0), mode="constant", value=float(pad_value))
+            padded.append(img)
+            mask = torch.zeros((w_max,), dtype=torch.bool)
+            mask[:w] = True
+            masks.append(mask)
+
+        pixel_values = torch.stack(padded, dim=0)  # [B, 1, H, W]
+        pixel_mask = torch.stack(masks, dim=0)  # [B, W]
 
     meta: list[dict[str, Any]] = []
     for b in batch:
@@ -51,13 +138,94 @@ def collate_line_batch(batch: list[dict[str, Any]], pad_value: float = 1.0) -> d
                 "form_id": b.get("form_id"),
                 "writer_id": b.get("writer_id"),
                 "image_path": b.get("image_path"),
+                "width": b.get("width"),
+                "height": b.get("height"),
             }
         )
 
-    return {
+    out = {
         "pixel_values": pixel_values,
         "pixel_mask": pixel_mask,
         "texts": texts,
         "widths": widths,
         "meta": meta,
     }
+    if "target_ids" in batch[0]:
+        ids = [np.asarray(b["target_ids"]) for b in batch]
+        out["targets"] = torch.from_numpy(np.concatenate(ids)).long()
+        out["target_lengths"] = torch.tensor([len(x) for x in ids], dtype=torch.long)
+    if batch_transform is not None:
+        out = batch_transform(out)
+
+    x = out["pixel_values"]
+    out[BATCH_STATS_KEY] = batch_stats(
+        real_pixels=int(x.shape[-2]) * sum(int(w) for w in out["widths"]),
+        padded_pixels=int(x.shape[0]) * int(x.shape[-2]) * int(x.shape[-1]),
+        samples=len(batch),
+        collate_s=time.perf_counter() - t0,
+        load_s=sum(float(b.get("load_s", 0.0)) for b in batch),
+    )
+    return out
+
+
+@dataclass
+class LineBatchCollator:
+    """
+    collate_fn для DataLoader: collate_line_batch с заранее заданными аргументами.
+    В отличие от lambda, пиклится, поэтому работает с воркерами на spawn / forkserver.
+    options — аргументы из collate_options (uint8, width_multiple, buffer).
+    """
+
+    pad_value: float = 1.0
+    batch_transform: Callable[[dict[str, Any]], dict[str, Any]] | None = None
+    options: dict[str, Any] = field(default_factory=dict)
+
+    def __call__(self, batch: list[dict[str, Any]]) -> dict[str, Any]:
+        return collate_line_batch(batch, pad_value=self.pad_value, batch_transform=self.batch_transform, **self.options)
+
+
+def pixels_to_device(pixel_values: torch.Tensor, device: torch.device | str) -> torch.Tensor:
+    """Батч на устройство; uint8 (loader.collate.uint8=true) переводится в [0,1] уже там."""
+    x = pixel_values.to(device, non_blocking=True)
+    if x.is_cuda and pixel_values.is_pinned():
+        key = pixel_values.untyped_storage().data_ptr()
+        if key in _slot_events:
+            # копия из слота BatchBuffer ещё может идти: слот не переиспользуется до её event
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(x.device))
+            _slot_events[key] = event
+    if x.dtype == torch.uint8:
+        x = x.to(torch.float32).div_(255.0)
+    return x
+
+
+def uint8_batches(cfg) -> bool:
+    """loader.collate.uint8: трансформ отдаёт uint8, collate собирает uint8-батч."""
+    collate = getattr(cfg.loader, "collate", None)
+    return collate is not None and bool(getattr(collate, "uint8", False))
+
+
+def collate_options(cfg, num_workers: int | None = None) -> dict[str, Any]:
+    """
+    Аргументы collate_line_batch из loader.collate: uint8, width_multiple и,
+    для num_workers=0, кольцо буферов (pinned при loader.pin_memory и CUDA).
+    В кольце должно быть больше слотов, чем батчей в полёте (loader.device_prefetch + 1).
+    """
+    collate = getattr(cfg.loader, "collate", None)
+    uint8 = uint8_batches(cfg)
+    opts: dict[str, Any] = {
+        "uint8": uint8,
+        "width_multiple": int(getattr(collate, "width_multiple", 1)) if collate is not None else 1,
+    }
+    workers = int(cfg.loader.num_workers) if num_workers is None else int(num_workers)
+    slots = int(getattr(collate, "buffer_slots", 0)) if collate is not None else 0
+    if uint8 and workers == 0 and slots > 0:
+        in_flight = int(getattr(cfg.loader, "device_prefetch", 2)) + 1
+        if slots <= in_flight:
+            raise ValueError(
+                f"loader.collate.buffer_slots={slots} must be > loader.device_prefetch + 1 = {in_flight}: "
+                "a slot would be refilled while its batch is still being copied to the device"
+            )
+        pin = bool(cfg.loader.pin_memory) and torch.cuda.is_available()
+        opts["buffer"] = BatchBuffer(slots=slots, pin=pin)
+    return opts
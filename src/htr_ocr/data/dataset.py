@@ -1,10 +1,18 @@
+import time
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Callable
 
-import pandas as pd
+import numpy as np
 from PIL import Image
 
+from htr_ocr.data.np_preprocess import load_gray
+from htr_ocr.data.packed import PackedLineStore
+from htr_ocr.data.preprocess_cache import PreprocessCache, array_image_key, file_image_key
+from htr_ocr.data.split_store import SplitTable
+from htr_ocr.data.transforms import LineImageTransform
+from htr_ocr.utils.repro import SharedEpoch
+
 
 @dataclass(frozen=True)
 class LineSample:
@@ -20,48 +28,128 @@ class LineSample:
 class IamLineDataset:
     def __init__(
         self,
-        csv_path: str | Path,
+        csv_path: str | Path | None,
         transform: Callable[[Image.Image], Any] | None = None,
         target_height: int = 128,
+        packed_dir: str | Path | None = None,
+        preprocess_cache: PreprocessCache | None = None,
+        augment_variants: Any | None = None,
+        tokenizer: Any | None = None,
     ) -> None:
-        self.csv_path = Path(csv_path)
-        if not self.csv_path.exists():
-            raise FileNotFoundError(f"CSV not found: {self.csv_path}")
+        # packed_dir: картинки и строки сплита берутся из шардов pack_dataset, а не из CSV
+        self.store = PackedLineStore(packed_dir) if packed_dir is not None else None
+
+        if self.store is not None:
+            self.csv_path = Path(csv_path) if csv_path is not None else None
+            self.table = self.store.table
+        else:
+            if csv_path is None:
+                raise ValueError("Either csv_path or packed_dir is required")
+            self.csv_path = Path(csv_path)
+            if not self.csv_path.exists():
+                raise FileNotFoundError(f"CSV not found: {self.csv_path}")
+            # csv_path может быть и .arrow из make_splits (читается через mmap)
+            self.table = SplitTable(self.csv_path)
 
-        self.df = pd.read_csv(self.csv_path)
-        
         required_columns = {"image_path", "text", "width", "height", "line_id", "form_id", "writer_id"}
-        if not required_columns.issubset(self.df.columns):
-            raise ValueError(f"CSV only contains columns: {list(self.df.columns)}")
+        if not required_columns.issubset(self.table.columns):
+            raise ValueError(f"CSV only contains columns: {self.table.columns}")
 
         self.transform = transform
+        # кэш работает только с LineImageTransform: ему нужна детерминированная часть prepare()
+        self.preprocess_cache = preprocess_cache if isinstance(transform, LineImageTransform) else None
+        # numpy-бэкенд препроцессинга принимает uint8-массив: картинка декодируется один раз, без PIL-объектов
+        self._array_input = isinstance(transform, LineImageTransform) and transform.accepts_array
         self.target_height = int(target_height)
 
-        w = self.df["width"].astype(float)
-        h = self.df["height"].astype(float).replace(0, 1.0)
-        self._approx_resized_width = (w * (self.target_height / h)).round().astype(int).clip(lower=1)
+        # augment_variants (AugmentVariantStore): готовые аугментированные строки из pregenerate_augment,
+        # вариант выбирается по эпохе (set_epoch; эпоха общая с воркерами DataLoader)
+        self.augment_variants = augment_variants
+        self._epoch = SharedEpoch()
+        if augment_variants is not None and len(augment_variants) != len(self.table):
+            raise ValueError(
+                f"Augmented variants have {len(augment_variants)} lines, split has {len(self.table)}. "
+                "Rerun `htr pregenerate_augment`."
+            )
+        if augment_variants is not None:
+            # то же число строк ещё не значит те же строки (make_splits перезапущен, другой порядок)
+            split_ids = np.asarray(self.table.strings("line_id"), dtype=object)
+            mismatch = np.flatnonzero(augment_variants.line_ids != split_ids)
+            if mismatch.size:
+                i = int(mismatch[0])
+                raise ValueError(
+                    f"Augmented variants do not match the split: row {i} is {augment_variants.line_ids[i]!r} "
+                    f"in variants, {split_ids[i]!r} in split ({mismatch.size} rows differ). "
+                    "Rerun `htr pregenerate_augment`."
+                )
+
+        # tokenizer (CTCTokenizer): все тексты кодируются один раз в плоский int32 + offsets,
+        # __getitem__ отдаёт target_ids, collate собирает из них targets / target_lengths.
+        # Неизвестный символ — ошибка здесь, а не посреди эпохи
+        self.target_ids: np.ndarray | None = None
+        self.target_offsets: np.ndarray | None = None
+        if tokenizer is not None:
+            try:
+                ids, lengths = tokenizer.encode_batch(self.table.strings("text"))
+            except ValueError as e:
+                raise ValueError(f"{self.csv_path or packed_dir}: {e}") from e
+            self.target_ids = ids
+            self.target_offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+        w = self.table.numeric("width", np.float64)
+        h = self.table.numeric("height", np.float64)
+        h = np.where(h == 0, 1.0, h)
+        self._approx_resized_width = np.clip(np.round(w * (self.target_height / h)), 1, None).astype(np.int64)
 
     def __len__(self) -> int:
-        return int(len(self.df))
+        return int(len(self.table))
+
+    @property
+    def epoch(self) -> int:
+        return self._epoch.get()
+
+    def set_epoch(self, epoch: int) -> None:
+        self._epoch.set(epoch)
 
     def approx_resized_width(self, idx: int) -> int | None:
         if self._approx_resized_width is None:
             return None
-        return int(self._approx_resized_width.iloc[idx])
-
-    def __getitem__(self, idx: int) -> dict[str, Any]:
-        row = self.df.iloc[int(idx)]
-        image_path = str(row["image_path"])
-        text = str(row["text"])
-
+        return int(self._approx_resized_width[idx])
+
+    def approx_resized_widths(self) -> np.ndarray:
+        """Ширины после ResizeToHeight для всех строк сразу (для семплеров)."""
+        return self._approx_resized_width
+
+    def _load_image(self, idx: int, image_path: str) -> Image.Image | np.ndarray:
+        if self.store is not None:
+            arr = self.store.image(idx)
+            return arr if self._array_input else Image.fromarray(arr)
+        if self._array_input:
+            return load_gray(image_path)
         with Image.open(image_path) as im:
             im = im.convert("L")
-            sample_img = im.copy()
+            return im.copy()
 
-        if self.transform is not None:
-            pixel_values = self.transform(sample_img)
+    def __getitem__(self, idx: int) -> dict[str, Any]:
+        t0 = time.perf_counter()
+        idx = int(idx)
+        image_path = str(self.table.value("image_path", idx))
+        text = str(self.table.value("text", idx))
+
+        if self.augment_variants is not None:
+            # аугментации и resize уже применены, осталось только uint8 -> float
+            arr = self.augment_variants.image(idx, self.epoch)
+            pixel_values = self.transform.finish(arr) if isinstance(self.transform, LineImageTransform) else Image.fromarray(arr)
+        elif self.preprocess_cache is not None:
+            if self.store is not None:
+                key = array_image_key(self.store.image(idx))
+            else:
+                key = file_image_key(image_path)
+            pixel_values = self.preprocess_cache.apply(self.transform, key, lambda: self._load_image(idx, image_path))
+        elif self.transform is not None:
+            pixel_values = self.transform(self._load_image(idx, image_path))
         else:
-            pixel_values = sample_img
+            pixel_values = self._load_image(idx, image_path)
 
         out: dict[str, Any] = {
             "pixel_values": pixel_values,
@@ -69,8 +157,10 @@ class IamLineDataset:
             "image_path": image_path,
         }
 
-        for col in ["line_id", "form_id", "writer_id", "width", "height"]:
-            if col in self.df.columns:
-                out[col] = row[col]
+        out.update(self.table.row(idx, ["line_id", "form_id", "writer_id", "width", "height"]))
+        if self.target_ids is not None:
+            out["target_ids"] = self.target_ids[self.target_offsets[idx] : self.target_offsets[idx + 1]]
+        # чтение + препроцессинг строки, для LoaderStats
+        out["load_s"] = time.perf_counter() - t0
 
         return out
@@ -3,8 +3,8 @@ from pathlib import Path
 from typing import Iterable
 
 import pandas as pd
-from PIL import Image
-from tqdm import tqdm
+
+from htr_ocr.data.image_index import ImageIndex, measure_image_sizes, read_image_size  # noqa: F401
 
 
 @dataclass(frozen=True)
@@ -91,10 +91,20 @@ def parse_forms_txt(forms_txt_path: str | Path) -> dict[str, str]:
     return mapping
 
 
-def index_line_images(images_root: str | Path, exts: Iterable[str] = (".png", ".jpg", ".jpeg")) -> dict[str, Path]:
+def index_line_images(
+    images_root: str | Path,
+    exts: Iterable[str] = (".png", ".jpg", ".jpeg"),
+    index_cache_path: str | Path | None = None,
+    verify_files: bool = True,
+) -> tuple[dict[str, Path], ImageIndex | None]:
     """
     IAM разложен по папкам по-разному (lines/a01/a01-000u/...),
     поэтому вместо жёсткого правила мы один раз индексируем все картинки их же назваением.
+
+    Если задан index_cache_path, индекс хранится на диске (ImageIndex) и при повторном
+    запуске пересканируются только изменившиеся директории, а с verify_files ещё сверяются
+    mtime / размер каждого файла (перезапись на месте не меняет mtime директории). Возвращает (stem -> путь, ImageIndex или None без кэша);
+    по ImageIndex build_manifest потом берёт размеры картинок.
     """
     images_root = Path(images_root)
     mapping: dict[str, Path] = {}
@@ -102,6 +112,12 @@ def index_line_images(images_root: str | Path, exts: Iterable[str] = (".png", ".
     if not images_root.exists():
         raise FileNotFoundError(f"Images root not found: {images_root}")
 
+    if index_cache_path:
+        index = ImageIndex.load(images_root, index_cache_path, exts=exts)
+        index.refresh(verify_files=verify_files)
+        index.save()
+        return index.paths_by_stem(), index
+
     exts_l = {e.lower() for e in exts}
 
     for p in images_root.rglob("*"):
@@ -112,7 +128,7 @@ def index_line_images(images_root: str | Path, exts: Iterable[str] = (".png", ".
         stem = p.stem
         mapping.setdefault(stem, p)
 
-    return mapping
+    return mapping, None
 
 
 def build_manifest(
@@ -121,6 +137,11 @@ def build_manifest(
     forms_path: str | Path,
     keep_status: list[str] | None,
     limit: int = 0,
+    num_workers: int = 0,
+    executor: str = "thread",
+    chunksize: int = 64,
+    index_cache_path: str | Path | None = None,
+    verify_files: bool = True,
 ) -> pd.DataFrame:
     """
     Делаем pd.DataFrame с колонками:
@@ -128,6 +149,11 @@ def build_manifest(
       graylevel, n_components, bbox_x, bbox_y, bbox_w, bbox_h,
 
     images_subdir — путь относительно raw_dir, где лежат изображения строк.
+
+    Размеры берём из заголовков файлов (read_image_size); при num_workers > 1
+    заголовки читаются параллельно пулом executor ("thread" | "process").
+    С index_cache_path список картинок и их размеры берутся из ImageIndex,
+    и заново меряются только новые или изменённые файлы.
     """
     images_root = Path(images_root)
 
@@ -137,25 +163,42 @@ def build_manifest(
         records = records[:limit]
 
     # index_line_images
-    img_index: dict[str, Path] = {}
-    img_index = index_line_images(images_root)
+    img_index, index = index_line_images(images_root, index_cache_path=index_cache_path, verify_files=verify_files)
 
     # parse_forms_txt
     forms_map: dict[str, str] = {}
     forms_map = parse_forms_txt(forms_path)
 
-    rows: list[dict] = []
-
-    for rec in tqdm(records, desc="Building manifest"):
+    img_paths: list[Path] = []
+    for rec in records:
         img_path = img_index.get(rec.line_id)
         if img_path is None:
             raise FileNotFoundError(
                 f"Image not found for line_id={rec.line_id}, images_root={images_root}"
             )
+        img_paths.append(img_path)
+
+    if index is not None:
+        sizes = index.ensure_sizes(
+            img_paths,
+            num_workers=num_workers,
+            executor=executor,
+            chunksize=chunksize,
+            desc="Building manifest",
+        )
+        index.save()
+    else:
+        sizes = measure_image_sizes(
+            img_paths,
+            num_workers=num_workers,
+            executor=executor,
+            chunksize=chunksize,
+            desc="Building manifest",
+        )
 
-        with Image.open(img_path) as im:
-            w_img, h_img = im.size
+    rows: list[dict] = []
 
+    for rec, img_path, (w_img, h_img) in zip(records, img_paths, sizes, strict=True):
         form_id = "-".join(rec.line_id.split("-")[:2])
         writer_id = forms_map.get(form_id)
 
@@ -0,0 +1,312 @@
+import json
+import os
+import struct
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable, Sequence
+
+from PIL import Image
+from tqdm import tqdm
+
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# SOF-маркеры JPEG, в которых лежат размеры (C4, C8, CC — это DHT/JPG/DAC, не кадры)
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _png_size(f) -> tuple[int, int] | None:
+    head = f.read(24)
+    if len(head) < 24 or head[:8] != _PNG_SIGNATURE or head[12:16] != b"IHDR":
+        return None
+    w, h = struct.unpack(">II", head[16:24])
+    return int(w), int(h)
+
+
+def _jpeg_size(f) -> tuple[int, int] | None:
+    if f.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        while byte == b"\xff":
+            byte = f.read(1)
+        if not byte:
+            return None
+
+        marker = byte[0]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker == 0xD9:
+            return None
+
+        seg_len_raw = f.read(2)
+        if len(seg_len_raw) < 2:
+            return None
+        seg_len = struct.unpack(">H", seg_len_raw)[0]
+        if marker in _JPEG_SOF_MARKERS:
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            h, w = struct.unpack(">HH", sof[1:5])
+            return int(w), int(h)
+        f.seek(seg_len - 2, 1)
+
+
+def read_image_size(path: str | Path) -> tuple[int, int]:
+    """
+    Возвращает (width, height) картинки, читая только заголовок PNG/JPEG без декодирования.
+    Для остальных форматов (и битых заголовков) откатываемся на PIL.
+    """
+    path = Path(path)
+    with path.open("rb") as f:
+        suffix = path.suffix.lower()
+        if suffix == ".png":
+            size = _png_size(f)
+        elif suffix in (".jpg", ".jpeg"):
+            size = _jpeg_size(f)
+        else:
+            size = None
+
+    if size is not None and size[0] > 0 and size[1] > 0:
+        return size
+
+    with Image.open(path) as im:
+        w_img, h_img = im.size
+    return int(w_img), int(h_img)
+
+
+def _make_executor(executor: str, num_workers: int) -> Executor:
+    executor = str(executor).lower()
+    if executor == "thread":
+        return ThreadPoolExecutor(max_workers=num_workers)
+    if executor == "process":
+        return ProcessPoolExecutor(max_workers=num_workers)
+    raise ValueError(f"Unknown executor={executor!r}. Expected one of: thread, process")
+
+
+def measure_image_sizes(
+    paths: Sequence[str | Path],
+    num_workers: int = 0,
+    executor: str = "thread",
+    chunksize: int = 64,
+    desc: str = "Reading image headers",
+) -> list[tuple[int, int]]:
+    """
+    Размеры картинок в том же порядке, что и paths.
+    num_workers <= 1 — последовательно, иначе через пул потоков/процессов.
+    """
+    total = len(paths)
+    pbar = tqdm(total=total, desc=desc, unit="img", unit_scale=True, smoothing=0.1)
+
+    sizes: list[tuple[int, int]] = []
+    try:
+        if int(num_workers) <= 1:
+            for p in paths:
+                sizes.append(read_image_size(p))
+                pbar.update(1)
+            return sizes
+
+        with _make_executor(executor, int(num_workers)) as pool:
+            for size in pool.map(read_image_size, paths, chunksize=max(1, int(chunksize))):
+                sizes.append(size)
+                pbar.update(1)
+        return sizes
+    finally:
+        pbar.close()
+
+
+INDEX_VERSION = 1
+
+
+@dataclass
+class IndexRefreshStats:
+    dirs_total: int = 0
+    dirs_rescanned: int = 0
+    files_total: int = 0
+    files_changed: int = 0
+    files_removed: int = 0
+
+
+@dataclass
+class ImageIndex:
+    """
+    Персистентный индекс картинок под images_root.
+
+    dirs:  rel_dir  -> [mtime_ns, [rel_subdirs], [rel_files]]
+    files: rel_file -> [size, mtime_ns, width | None, height | None]
+
+    refresh() перечитывает только директории, у которых изменился mtime
+    (добавили/удалили файлы), и сбрасывает размеры у файлов с новым size/mtime.
+    Размеры меряются лениво в ensure_sizes() и тоже кэшируются.
+    """
+
+    images_root: Path
+    exts: tuple[str, ...] = (".png", ".jpg", ".jpeg")
+    cache_path: Path | None = None
+    dirs: dict[str, list] = field(default_factory=dict)
+    files: dict[str, list] = field(default_factory=dict)
+
+    @classmethod
+    def load(
+        cls,
+        images_root: str | Path,
+        cache_path: str | Path | None,
+        exts: Iterable[str] = (".png", ".jpg", ".jpeg"),
+    ) -> "ImageIndex":
+        images_root = Path(images_root)
+        exts_t = tuple(sorted({e.lower() for e in exts}))
+        index = cls(images_root=images_root, exts=exts_t, cache_path=Path(cache_path) if cache_path else None)
+
+        if index.cache_path is None or not index.cache_path.exists():
+            return index
+
+        try:
+            obj = json.loads(index.cache_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return index
+
+        # кэш от другого корня/набора расширений не переиспользуем
+        if (
+            obj.get("version") != INDEX_VERSION
+            or obj.get("images_root") != str(images_root.resolve())
+            or tuple(obj.get("exts", ())) != exts_t
+        ):
+            return index
+
+        index.dirs = dict(obj.get("dirs", {}))
+        index.files = dict(obj.get("files", {}))
+        return index
+
+    def save(self) -> None:
+        if self.cache_path is None:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        obj = {
+            "version": INDEX_VERSION,
+            "images_root": str(self.images_root.resolve()),
+            "exts": list(self.exts),
+            "dirs": self.dirs,
+            "files": self.files,
+        }
+        tmp = self.cache_path.with_name(self.cache_path.name + ".tmp")
+        tmp.write_text(json.dumps(obj, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.cache_path)
+
+    def _abs(self, rel: str) -> Path:
+        return self.images_root / rel if rel else self.images_root
+
+    @staticmethod
+    def _join(rel_dir: str, name: str) -> str:
+        return f"{rel_dir}/{name}" if rel_dir else name
+
+    def _file_entry(self, rel: str, st: os.stat_result) -> list:
+        old = self.files.get(rel)
+        if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+            return old
+        return [int(st.st_size), int(st.st_mtime_ns), None, None]
+
+    def refresh(self, verify_files: bool = True) -> IndexRefreshStats:
+        """
+        Обходит дерево, пересканируя только изменившиеся директории.
+        verify_files=True (по умолчанию) дополнительно stat-ит файлы в неизменённых директориях
+        (ловит перезапись файла на месте, которая не меняет mtime директории); False — только
+        mtime директорий, перезаписанный на месте файл останется со старым размером.
+        """
+        if not self.images_root.exists():
+            raise FileNotFoundError(f"Images root not found: {self.images_root}")
+
+        stats = IndexRefreshStats()
+        new_dirs: dict[str, list] = {}
+        new_files: dict[str, list] = {}
+
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = self._abs(rel_dir)
+            try:
+                dir_mtime = os.stat(abs_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            cached = self.dirs.get(rel_dir)
+            if cached is not None and cached[0] == dir_mtime:
+                _, subdirs, rel_files = cached
+                for rel in rel_files:
+                    entry = self.files.get(rel)
+                    if entry is None or verify_files:
+                        try:
+                            entry = self._file_entry(rel, os.stat(self._abs(rel)))
+                        except FileNotFoundError:
+                            continue
+                    new_files[rel] = entry
+            else:
+                stats.dirs_rescanned += 1
+                subdirs = []
+                rel_files = []
+                with os.scandir(abs_dir) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            subdirs.append(self._join(rel_dir, entry.name))
+                            continue
+                        if not entry.is_file():
+                            continue
+                        if os.path.splitext(entry.name)[1].lower() not in self.exts:
+                            continue
+                        rel = self._join(rel_dir, entry.name)
+                        rel_files.append(rel)
+                        new_files[rel] = self._file_entry(rel, entry.stat())
+                subdirs.sort()
+                rel_files.sort()
+
+            new_dirs[rel_dir] = [dir_mtime, subdirs, rel_files]
+            # обратный порядок, чтобы обход шёл по алфавиту
+            stack.extend(reversed(subdirs))
+
+        stats.dirs_total = len(new_dirs)
+        stats.files_total = len(new_files)
+        stats.files_changed = sum(1 for rel, e in new_files.items() if self.files.get(rel) is not e)
+        stats.files_removed = sum(1 for rel in self.files if rel not in new_files)
+
+        self.dirs = new_dirs
+        self.files = new_files
+        return stats
+
+    def paths_by_stem(self) -> dict[str, Path]:
+        mapping: dict[str, Path] = {}
+        for rel_dir in sorted(self.dirs):
+            for rel in self.dirs[rel_dir][2]:
+                mapping.setdefault(Path(rel).stem, self._abs(rel))
+        return mapping
+
+    def ensure_sizes(
+        self,
+        paths: Sequence[str | Path],
+        num_workers: int = 0,
+        executor: str = "thread",
+        chunksize: int = 64,
+        desc: str = "Reading image headers",
+    ) -> list[tuple[int, int]]:
+        """Размеры для paths (внутри images_root); меряем только то, чего нет в индексе."""
+        rels = [Path(p).relative_to(self.images_root).as_posix() for p in paths]
+
+        missing = sorted({rel for rel in rels if self.files.get(rel, [0, 0, None, None])[2] is None})
+        if missing:
+            measured = measure_image_sizes(
+                [self._abs(rel) for rel in missing],
+                num_workers=num_workers,
+                executor=executor,
+                chunksize=chunksize,
+                desc=desc,
+            )
+            for rel, (w, h) in zip(missing, measured, strict=True):
+                entry = self.files.get(rel)
+                if entry is None:
+                    st = os.stat(self._abs(rel))
+                    entry = [int(st.st_size), int(st.st_mtime_ns), None, None]
+                    self.files[rel] = entry
+                entry[2], entry[3] = int(w), int(h)
+
+        return [(int(self.files[rel][2]), int(self.files[rel][3])) for rel in rels]
@@ -0,0 +1,106 @@
+from pathlib import Path
+from typing import Any, Callable
+
+from torch.utils.data import DataLoader
+
+from htr_ocr.data.batch_augment import make_batch_augment
+from htr_ocr.data.collate import LineBatchCollator, collate_options, uint8_batches
+from htr_ocr.data.dataset import IamLineDataset
+from htr_ocr.data.packed import resolve_packed_dir
+from htr_ocr.data.pregenerated import resolve_augment_variants
+from htr_ocr.data.preprocess_cache import make_preprocess_cache
+from htr_ocr.data.samplers import make_bucket_sampler
+from htr_ocr.data.split_store import resolve_split_path
+from htr_ocr.data.streaming import make_streaming_dataset, streaming_enabled
+from htr_ocr.data.transforms import make_image_transform
+from htr_ocr.utils.repro import seed_worker
+
+
+def dataloader_options(cfg, num_workers: int | None = None) -> dict[str, Any]:
+    """
+    Общие аргументы DataLoader из конфига loader:
+    num_workers, pin_memory и, при num_workers > 0,
+    - persistent_workers: воркеры живут между эпохами (датасет не копируется в них заново);
+    - prefetch_factor: сколько батчей каждый воркер держит готовыми;
+    - worker_init_fn=seed_worker: свои random / numpy в каждом воркере;
+    - multiprocessing_context из loader.start_method (fork | spawn | forkserver), null — по умолчанию.
+    """
+    workers = int(cfg.loader.num_workers) if num_workers is None else int(num_workers)
+    opts: dict[str, Any] = {"num_workers": workers, "pin_memory": bool(cfg.loader.pin_memory)}
+    if workers > 0:
+        opts["persistent_workers"] = bool(getattr(cfg.loader, "persistent_workers", False))
+        opts["prefetch_factor"] = int(getattr(cfg.loader, "prefetch_factor", 2))
+        opts["worker_init_fn"] = seed_worker
+        start_method = getattr(cfg.loader, "start_method", None)
+        if start_method:
+            opts["multiprocessing_context"] = str(start_method)
+    return opts
+
+
+def build_dataloader(
+    cfg,
+    ds,
+    collate_fn: Callable[[list[dict[str, Any]]], Any] | None,
+    batch_sampler=None,
+    shuffle: bool = False,
+) -> DataLoader:
+    """DataLoader с batch_sampler или с loader.batch_size; collate_fn должен пиклиться (не lambda)."""
+    opts = dataloader_options(cfg)
+    if batch_sampler is not None:
+        return DataLoader(ds, batch_sampler=batch_sampler, collate_fn=collate_fn, **opts)
+    return DataLoader(ds, batch_size=int(cfg.loader.batch_size), shuffle=shuffle, collate_fn=collate_fn, **opts)
+
+
+def make_line_dataloader(cfg, split: str, eval_buckets: bool = False, tokenizer=None) -> DataLoader:
+    """
+    DataLoader строк для CTC-моделей (IamLineDataset + collate_line_batch).
+
+    train: аугментации (по строке в трансформе, батчевые в воркерах или готовые варианты),
+    бакетинг (loader.bucket), перемешивание, loader.streaming.
+    Остальные сплиты — по порядку; eval_buckets=True — бакетинг и для них (меньше паддинга).
+    tokenizer: тексты кодируются при создании датасета, батчи приходят с targets / target_lengths.
+    """
+    is_train = split == "train"
+    batch_aug = make_batch_augment(cfg) if is_train else None
+    variants = resolve_augment_variants(cfg, split)
+    transform = make_image_transform(
+        height=int(cfg.preprocess.height),
+        keep_aspect=bool(cfg.preprocess.keep_aspect),
+        tight_crop_enabled=bool(cfg.preprocess.tight_crop.enabled),
+        tight_crop_threshold=int(cfg.preprocess.tight_crop.threshold),
+        tight_crop_margin=int(cfg.preprocess.tight_crop.margin),
+        augment_cfg=getattr(cfg, "augment", None) if is_train and batch_aug is None and variants is None else None,
+        is_train=is_train,
+        fill=int(cfg.preprocess.pad_value),
+        backend=str(getattr(cfg.preprocess, "backend", "pil")),
+        to_float_tensor=True,
+        uint8_tensor=uint8_batches(cfg),
+    )
+
+    # augment.batched.on_device=false: батчевые аугментации считаются в воркерах DataLoader
+    worker_aug = batch_aug if batch_aug is not None and not batch_aug.on_device else None
+
+    if is_train and streaming_enabled(cfg):
+        ds = make_streaming_dataset(cfg, split, transform, batch_transform=worker_aug, augment_variants=variants, tokenizer=tokenizer)
+        return DataLoader(ds, batch_size=None, **dataloader_options(cfg))
+
+    ds = IamLineDataset(
+        csv_path=resolve_split_path(Path(cfg.data.processed_dir), split),
+        transform=transform,
+        target_height=int(cfg.preprocess.height),
+        packed_dir=resolve_packed_dir(cfg, split),
+        preprocess_cache=make_preprocess_cache(cfg),
+        augment_variants=variants,
+        tokenizer=tokenizer,
+    )
+    collate_fn = LineBatchCollator(
+        pad_value=float(cfg.preprocess.pad_value) / 255.0,
+        batch_transform=worker_aug,
+        options=collate_options(cfg),
+    )
+
+    if bool(getattr(cfg.loader.bucket, "enabled", False)) and (is_train or eval_buckets):
+        sampler = make_bucket_sampler(cfg, ds.approx_resized_widths(), distributed=is_train)
+        return build_dataloader(cfg, ds, collate_fn, batch_sampler=sampler)
+
+    return build_dataloader(cfg, ds, collate_fn, shuffle=bool(cfg.loader.shuffle) and is_train)
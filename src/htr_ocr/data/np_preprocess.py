@@ -0,0 +1,101 @@
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+# как в Pillow (libImaging/Resample.c): веса 8-битного ресемплинга в фиксированной точке
+PRECISION_BITS = 32 - 8 - 2
+
+
+def decode_gray(img: Image.Image) -> np.ndarray:
+    """PIL -> uint8 [H, W] в градациях серого; для режима L без лишней конвертации."""
+    if img.mode != "L":
+        img = img.convert("L")
+    return np.asarray(img, dtype=np.uint8)
+
+
+def load_gray(image_path: str) -> np.ndarray:
+    with Image.open(image_path) as im:
+        return np.array(decode_gray(im))
+
+
+def ink_bbox(arr: np.ndarray, threshold: int) -> tuple[int, int, int, int] | None:
+    """
+    Bbox пикселей темнее threshold, как point(p < threshold -> 255).getbbox():
+    (left, upper, right, lower), right/lower не включительно. Проекции по строкам и столбцам.
+    """
+    ink = arr < int(threshold)
+    rows = np.flatnonzero(ink.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(ink.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+@lru_cache(maxsize=4096)
+def _bilinear_coeffs(in_size: int, out_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    precompute_coeffs + normalize_coeffs_8bpc из Pillow для BILINEAR (support = 1):
+    xmin [out], веса int32 [out, ksize] (нули за пределами окна). Кэшируется по размерам.
+    """
+    scale = in_size / out_size
+    filterscale = max(scale, 1.0)
+    support = 1.0 * filterscale
+    ksize = int(np.ceil(support)) * 2 + 1
+
+    center = (np.arange(out_size, dtype=np.float64) + 0.5) * scale
+    xmin = np.maximum(np.trunc(center - support + 0.5).astype(np.int64), 0)
+    xmax = np.minimum(np.trunc(center + support + 0.5).astype(np.int64), in_size) - xmin
+
+    taps = np.arange(ksize, dtype=np.int64)
+    used = taps[None, :] < xmax[:, None]
+    x = ((taps[None, :] + xmin[:, None]) - center[:, None] + 0.5) * (1.0 / filterscale)
+    w = np.where(used, np.maximum(1.0 - np.abs(x), 0.0), 0.0)
+
+    # сумма строго слева направо, как в C (np.sum суммирует попарно)
+    ww = np.cumsum(w, axis=1)[:, -1:]
+    w = np.divide(w, ww, out=w.copy(), where=ww != 0.0)
+
+    scaled = w * (1 << PRECISION_BITS)
+    kk = np.where(scaled < 0, np.trunc(scaled - 0.5), np.trunc(scaled + 0.5)).astype(np.int32)
+    xmin.setflags(write=False)
+    kk.setflags(write=False)
+    return xmin, kk
+
+
+def _clip8(acc: np.ndarray) -> np.ndarray:
+    return np.clip(acc >> PRECISION_BITS, 0, 255).astype(np.uint8)
+
+
+def _resample(arr: np.ndarray, out_size: int) -> np.ndarray:
+    """
+    Один проход Resample.c вдоль оси 0: [N, M] -> [out_size, M].
+    Строки берутся целиком (непрерывная память), сумма влезает в int32, как и в C.
+    """
+    in_size = arr.shape[0]
+    xmin, kk = _bilinear_coeffs(in_size, out_size)
+    acc = np.full((out_size, arr.shape[1]), 1 << (PRECISION_BITS - 1), dtype=np.int32)
+    for t in range(kk.shape[1]):
+        k = kk[:, t]
+        if not k.any():
+            continue
+        idx = np.minimum(xmin + t, in_size - 1)
+        acc += arr[idx] * k[:, None]
+    return _clip8(acc)
+
+
+def resize_bilinear(arr: np.ndarray, width: int, height: int) -> np.ndarray:
+    """
+    Бит-в-бит Image.resize((width, height), BILINEAR) для uint8 [H, W]:
+    сначала горизонтальный проход, потом вертикальный, промежуточный результат в uint8.
+    """
+    h0, w0 = arr.shape
+    if (w0, h0) == (int(width), int(height)):
+        return arr.copy()
+    out = arr
+    if int(width) != w0:
+        # горизонтальный проход в транспонированном виде, чтобы брать непрерывные строки
+        out = np.ascontiguousarray(_resample(np.ascontiguousarray(out.T), int(width)).T)
+    if int(height) != h0:
+        out = _resample(out, int(height))
+    return out
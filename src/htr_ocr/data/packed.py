@@ -0,0 +1,201 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+from htr_ocr.data.split_store import SplitTable, write_split_table
+
+INDEX_NAME = "index.arrow"
+# индексы, упакованные до перехода на Arrow
+LEGACY_INDEX_NAME = "index.parquet"
+SHARD_PATTERN = "shard_{:05d}.bin"
+
+# колонки индекса, которые добавляет упаковка поверх колонок сплита
+PACKED_COLUMNS = ("shard", "offset", "packed_height", "packed_width")
+
+
+def shard_path(packed_dir: str | Path, shard_id: int) -> Path:
+    return Path(packed_dir) / SHARD_PATTERN.format(int(shard_id))
+
+
+class PackedShardWriter:
+    """
+    Пишет uint8 картинки [H, W] подряд в shard_XXXXX.bin.
+    Новый шард открывается, когда текущий перевалил за shard_bytes.
+    """
+
+    def __init__(self, out_dir: str | Path, shard_bytes: int = 512 * 1024 * 1024) -> None:
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_bytes = max(1, int(shard_bytes))
+
+        self._shard_id = -1
+        self._offset = 0
+        self._f = None
+
+    def _roll(self) -> None:
+        if self._f is not None:
+            self._f.close()
+        self._shard_id += 1
+        self._offset = 0
+        self._f = shard_path(self.out_dir, self._shard_id).open("wb")
+
+    def add(self, arr: np.ndarray) -> tuple[int, int]:
+        """Дописывает картинку и возвращает (shard, offset) в байтах."""
+        arr = np.ascontiguousarray(arr, dtype=np.uint8)
+        if arr.ndim != 2:
+            raise ValueError(f"Expected [H, W] uint8 image, got shape={arr.shape}")
+
+        if self._f is None or (self._offset > 0 and self._offset + arr.nbytes > self.shard_bytes):
+            self._roll()
+
+        shard_id, offset = self._shard_id, self._offset
+        self._f.write(arr.tobytes())
+        self._offset += arr.nbytes
+        return shard_id, offset
+
+    @property
+    def num_shards(self) -> int:
+        return self._shard_id + 1
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self) -> "PackedShardWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _load_gray(image_path: str) -> np.ndarray:
+    with Image.open(image_path) as im:
+        return np.asarray(im.convert("L"), dtype=np.uint8)
+
+
+def pack_split(
+    csv_path: str | Path,
+    out_dir: str | Path,
+    shard_mb: int = 512,
+    num_workers: int = 0,
+) -> pd.DataFrame:
+    """
+    Упаковывает картинки сплита (.csv/.arrow из make_splits) в шарды out_dir/shard_XXXXX.bin.
+    Храним исходную картинку в градациях серого (до препроцессинга), поэтому
+    смена preprocess.* не требует перепаковки.
+
+    index.arrow = колонки сплита + shard, offset, packed_height, packed_width.
+    """
+    csv_path = Path(csv_path)
+    if not csv_path.exists():
+        raise FileNotFoundError(f"Split not found: {csv_path}")
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for old in out_dir.glob("shard_*.bin"):
+        old.unlink()
+
+    df = SplitTable(csv_path).to_pandas()
+    paths = df["image_path"].astype(str).tolist()
+
+    shards: list[int] = []
+    offsets: list[int] = []
+    heights: list[int] = []
+    widths: list[int] = []
+
+    def _decoded() -> Iterator[np.ndarray]:
+        if int(num_workers) <= 1:
+            yield from map(_load_gray, paths)
+            return
+        # декодирование PIL отпускает GIL, а порядок map сохраняет
+        with ThreadPoolExecutor(max_workers=int(num_workers)) as pool:
+            yield from pool.map(_load_gray, paths)
+
+    with PackedShardWriter(out_dir, shard_bytes=int(shard_mb) * 1024 * 1024) as writer:
+        for arr in tqdm(_decoded(), total=len(paths), desc=f"Packing {csv_path.stem}", unit="img"):
+            shard_id, offset = writer.add(arr)
+            shards.append(shard_id)
+            offsets.append(offset)
+            heights.append(int(arr.shape[0]))
+            widths.append(int(arr.shape[1]))
+
+    index = df.copy()
+    index["shard"] = np.asarray(shards, dtype=np.int32)
+    index["offset"] = np.asarray(offsets, dtype=np.int64)
+    index["packed_height"] = np.asarray(heights, dtype=np.int32)
+    index["packed_width"] = np.asarray(widths, dtype=np.int32)
+    (out_dir / LEGACY_INDEX_NAME).unlink(missing_ok=True)
+    write_split_table(index, out_dir / INDEX_NAME)
+    return index
+
+
+def find_packed_index(packed_dir: str | Path) -> Path | None:
+    for name in (INDEX_NAME, LEGACY_INDEX_NAME):
+        p = Path(packed_dir) / name
+        if p.exists():
+            return p
+    return None
+
+
+class PackedLineStore:
+    """
+    Чтение упакованного сплита: image(idx) возвращает view [H, W] uint8 прямо из np.memmap,
+    без копирования. Шарды открываются лениво в каждом процессе (воркеры DataLoader
+    получают store без открытых memmap-ов).
+    """
+
+    def __init__(self, packed_dir: str | Path) -> None:
+        self.packed_dir = Path(packed_dir)
+        index_path = find_packed_index(self.packed_dir)
+        if index_path is None:
+            raise FileNotFoundError(f"Packed index not found in {self.packed_dir}. Run `htr pack_dataset` first.")
+
+        self.table = SplitTable(index_path)
+        self._shard = self.table.numeric("shard", np.int64)
+        self._offset = self.table.numeric("offset", np.int64)
+        self._height = self.table.numeric("packed_height", np.int64)
+        self._width = self.table.numeric("packed_width", np.int64)
+        self._maps: dict[int, np.memmap] = {}
+
+    def __len__(self) -> int:
+        return int(len(self.table))
+
+    def __getstate__(self) -> dict:
+        return {"packed_dir": self.packed_dir}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["packed_dir"])
+
+    def _shard_map(self, shard_id: int) -> np.memmap:
+        m = self._maps.get(shard_id)
+        if m is None:
+            m = np.memmap(shard_path(self.packed_dir, shard_id), dtype=np.uint8, mode="r")
+            self._maps[shard_id] = m
+        return m
+
+    def image(self, idx: int) -> np.ndarray:
+        idx = int(idx)
+        h, w = int(self._height[idx]), int(self._width[idx])
+        offset = int(self._offset[idx])
+        buf = self._shard_map(int(self._shard[idx]))
+        return buf[offset : offset + h * w].reshape(h, w)
+
+
+def resolve_packed_dir(cfg, split: str) -> Path | None:
+    """data.backend=packed -> data.packed_dir/<split>, иначе None (читаем файлы по image_path)."""
+    backend = str(getattr(cfg.data, "backend", "files")).lower()
+    if backend == "files":
+        return None
+    if backend != "packed":
+        raise ValueError(f"Unknown data.backend={backend!r}. Expected one of: files, packed")
+
+    packed_dir = Path(str(cfg.data.packed_dir)) / split
+    if find_packed_index(packed_dir) is None:
+        raise FileNotFoundError(f"Packed split not found: {packed_dir}. Run `htr pack_dataset` first.")
+    return packed_dir
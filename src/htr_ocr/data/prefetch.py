@@ -0,0 +1,118 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator
+
+import torch
+
+from htr_ocr.data.collate import pixels_to_device
+
+
+class CTCBatchTargets:
+    """
+    prepare для BatchPrefetcher в CTC-тренерах: добавляет в батч
+    targets [sum(L)] и target_lengths [B] (склеенные id символов) и token_lengths [B]
+    (длины выхода энкодера по ширинам строк, token_lengths_fn модели).
+    """
+
+    def __init__(self, tokenizer, token_lengths_fn: Callable[[list[int]], torch.Tensor]) -> None:
+        self.tokenizer = tokenizer
+        self.token_lengths_fn = token_lengths_fn
+
+    def __call__(self, batch: dict[str, Any]) -> dict[str, Any]:
+        # датасет с tokenizer уже отдал таргеты из collate; иначе кодируем тексты батча разом
+        if "targets" not in batch:
+            ids, lengths = self.tokenizer.encode_batch(batch["texts"])
+            batch["targets"] = torch.from_numpy(ids).long()
+            batch["target_lengths"] = torch.from_numpy(lengths).long()
+        batch["token_lengths"] = self.token_lengths_fn(batch["widths"])
+        return batch
+
+    def refresh_token_lengths(self, batch: dict[str, Any], device: torch.device | str) -> dict[str, Any]:
+        """После батчевых аугментаций на устройстве: растяжение меняет widths, длины пересчитываются."""
+        batch["token_lengths"] = self.token_lengths_fn(batch["widths"]).to(device)
+        return batch
+
+
+class BatchPrefetcher:
+    """
+    Обёртка над DataLoader: пока идёт шаг модели, фоновый поток для depth следующих батчей делает
+    prepare (например, CTCBatchTargets) и перенос всех тензоров батча на device
+    (pixel_values через pixels_to_device: uint8 переводится в [0,1] уже на устройстве).
+    На CUDA перенос идёт в отдельном stream, основной stream ждёт его event перед выдачей батча.
+
+    Сам loader (sampler, аугментации при num_workers=0, их random / torch RNG) итерируется
+    в вызывающем потоке, поэтому порядок случайных чисел не зависит от потоков и запуски
+    с seed_everything воспроизводятся. Фоновый поток случайных чисел не трогает.
+    depth=0 — без потока: то же самое синхронно в цикле обучения.
+    """
+
+    def __init__(
+        self,
+        loader: Iterable[dict[str, Any]],
+        device: torch.device | str,
+        prepare: Callable[[dict[str, Any]], dict[str, Any]] | None = None,
+        depth: int = 2,
+    ) -> None:
+        self.loader = loader
+        self.device = torch.device(device)
+        self.prepare = prepare
+        self.depth = max(0, int(depth))
+        self._cuda = self.device.type == "cuda" and torch.cuda.is_available()
+
+    def __len__(self) -> int:
+        return len(self.loader)  # type: ignore[arg-type]
+
+    def _to_device(self, batch: dict[str, Any]) -> dict[str, Any]:
+        if self.prepare is not None:
+            batch = self.prepare(batch)
+        out = dict(batch)
+        for k, v in batch.items():
+            if not torch.is_tensor(v):
+                continue
+            out[k] = pixels_to_device(v, self.device) if k == "pixel_values" else v.to(self.device, non_blocking=True)
+        return out
+
+    def _transfer(self, batch: dict[str, Any], stream: torch.cuda.Stream | None) -> tuple[dict[str, Any], Any]:
+        if stream is None:
+            return self._to_device(batch), None
+        with torch.cuda.stream(stream):
+            batch = self._to_device(batch)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return batch, event
+
+    def _ready(self, future: Future, main_stream: torch.cuda.Stream | None) -> dict[str, Any]:
+        batch, event = future.result()
+        if main_stream is not None:
+            main_stream.wait_event(event)
+            # память выделена в side stream: аллокатор не должен отдать её, пока шаг не закончится
+            for v in batch.values():
+                if torch.is_tensor(v) and v.is_cuda:
+                    v.record_stream(main_stream)
+        return batch
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        if self.depth == 0:
+            for batch in self.loader:
+                yield self._to_device(batch)
+            return
+
+        stream = torch.cuda.Stream(self.device) if self._cuda else None
+        main_stream = torch.cuda.current_stream(self.device) if self._cuda else None
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-prefetch")
+        pending: deque[Future] = deque()
+        try:
+            for batch in self.loader:
+                pending.append(pool.submit(self._transfer, batch, stream))
+                if len(pending) > self.depth:
+                    yield self._ready(pending.popleft(), main_stream)
+            while pending:
+                yield self._ready(pending.popleft(), main_stream)
+        finally:
+            # цикл обучения мог выйти раньше (break): недоделанные переносы отменяются
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def device_prefetch(cfg) -> int:
+    """loader.device_prefetch: сколько батчей BatchPrefetcher готовит заранее (0 — синхронно)."""
+    return int(getattr(cfg.loader, "device_prefetch", 2))
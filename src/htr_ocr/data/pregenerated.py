@@ -0,0 +1,312 @@
+import json
+import random
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Iterator
+
+import numpy as np
+import pandas as pd
+import torch
+from omegaconf import DictConfig, OmegaConf
+from tqdm import tqdm
+
+from htr_ocr.data.dataset import IamLineDataset
+from htr_ocr.data.packed import INDEX_NAME, PackedLineStore, PackedShardWriter, resolve_packed_dir
+from htr_ocr.data.split_store import resolve_split_path, write_split_table
+from htr_ocr.data.transforms import LineImageTransform, make_image_transform
+
+META_NAME = "variants.json"
+PART_PATTERN = "part_{:05d}"
+
+
+def pregenerated_enabled(cfg) -> bool:
+    """augment.enabled и augment.pregenerated.enabled (как у make_batch_augment: без augment.enabled — без аугментаций)."""
+    augment_cfg = getattr(cfg, "augment", None)
+    if augment_cfg is None or not bool(getattr(augment_cfg, "enabled", False)):
+        return False
+    pregen = getattr(augment_cfg, "pregenerated", None)
+    return pregen is not None and bool(getattr(pregen, "enabled", False))
+
+
+def render_spec(cfg) -> dict[str, Any]:
+    """От чего зависят готовые варианты, кроме самих аугментаций: препроцессинг до и после них."""
+    return {
+        "height": int(cfg.preprocess.height),
+        "keep_aspect": bool(cfg.preprocess.keep_aspect),
+        "tight_crop": {
+            "enabled": bool(cfg.preprocess.tight_crop.enabled),
+            "threshold": int(cfg.preprocess.tight_crop.threshold),
+            "margin": int(cfg.preprocess.tight_crop.margin),
+        },
+        "fill": int(cfg.preprocess.pad_value),
+    }
+
+
+def _render_augment_cfg(augment_cfg: Any) -> DictConfig:
+    """
+    Конфиг аугментаций для рендера: enabled=true и elastic без пула полей —
+    пул зависит от истории процесса, а вариант должен зависеть только от (seed, строка, номер).
+    """
+    aug = OmegaConf.create(OmegaConf.to_container(augment_cfg, resolve=True))
+    aug.enabled = True
+    if "elastic" in aug and aug.elastic is not None:
+        aug.elastic.bank_size = 0
+    return aug
+
+
+def augment_spec(augment_cfg: Any) -> dict[str, Any]:
+    """
+    Ручки аугментаций, от которых зависят отрендеренные варианты: конфиг рендера
+    (_render_augment_cfg) без batched / pregenerated — они выбирают способ, а не сами аугментации.
+    """
+    if isinstance(augment_cfg, dict):  # из variants.json
+        augment_cfg = OmegaConf.create(augment_cfg)
+    spec = OmegaConf.to_container(_render_augment_cfg(augment_cfg), resolve=True)
+    assert isinstance(spec, dict)
+    spec.pop("batched", None)
+    spec.pop("pregenerated", None)
+    return spec
+
+
+def _diff_keys(a: Any, b: Any, prefix: str = "") -> list[str]:
+    """Ключи (через точку), в которых расходятся два вложенных словаря."""
+    if not isinstance(a, dict) or not isinstance(b, dict):
+        return [] if a == b else [prefix or "<root>"]
+    out: list[str] = []
+    for key in sorted(set(a) | set(b), key=str):
+        out += _diff_keys(a.get(key), b.get(key), f"{prefix}.{key}" if prefix else str(key))
+    return out
+
+
+def variant_seed(seed: int, line_idx: int, variant: int) -> int:
+    return int(np.random.SeedSequence([int(seed), int(line_idx), int(variant)]).generate_state(1)[0])
+
+
+class _VariantRenderer:
+    """convert("L") -> TightCrop -> аугментации -> ResizeToHeight, результат uint8 [H, W]."""
+
+    def __init__(self, cfg, split: str, variants: int, seed: int) -> None:
+        self.lines = IamLineDataset(
+            resolve_split_path(Path(cfg.data.processed_dir), split),
+            transform=None,
+            target_height=int(cfg.preprocess.height),
+            packed_dir=resolve_packed_dir(cfg, split),
+        )
+        self.transform: LineImageTransform = make_image_transform(
+            height=int(cfg.preprocess.height),
+            keep_aspect=bool(cfg.preprocess.keep_aspect),
+            tight_crop_enabled=bool(cfg.preprocess.tight_crop.enabled),
+            tight_crop_threshold=int(cfg.preprocess.tight_crop.threshold),
+            tight_crop_margin=int(cfg.preprocess.tight_crop.margin),
+            augment_cfg=_render_augment_cfg(cfg.augment),
+            is_train=True,
+            fill=int(cfg.preprocess.pad_value),
+            backend="pil",
+            to_float_tensor=False,
+        )
+        self.variants = int(variants)
+        self.seed = int(seed)
+
+    def __call__(self, line_idx: int) -> list[np.ndarray]:
+        base = self.transform.prepare(self.lines[line_idx]["pixel_values"])
+        out = []
+        for k in range(self.variants):
+            s = variant_seed(self.seed, line_idx, k)
+            random.seed(s)
+            torch.manual_seed(s)
+            out.append(np.asarray(self.transform.finish(base), dtype=np.uint8))
+        return out
+
+
+_WORKER_RENDERER: _VariantRenderer | None = None
+
+
+def _init_worker(cfg, split: str, variants: int, seed: int) -> None:
+    global _WORKER_RENDERER
+    torch.set_num_threads(1)
+    _WORKER_RENDERER = _VariantRenderer(cfg, split, variants, seed)
+
+
+def _render_in_worker(line_idx: int) -> list[np.ndarray]:
+    assert _WORKER_RENDERER is not None
+    return _WORKER_RENDERER(line_idx)
+
+
+def part_lines(num_lines: int, part: int, num_parts: int) -> range:
+    """Непрерывный кусок строк для части part из num_parts (части можно считать на разных машинах)."""
+    if not 0 <= int(part) < int(num_parts):
+        raise ValueError(f"part must be in [0, {num_parts}), got {part}")
+    bounds = np.linspace(0, int(num_lines), int(num_parts) + 1).round().astype(np.int64)
+    return range(int(bounds[part]), int(bounds[part + 1]))
+
+
+def pregenerate_split(
+    cfg,
+    split: str,
+    out_dir: str | Path,
+    variants: int = 8,
+    seed: int = 1234,
+    part: int = 0,
+    num_parts: int = 1,
+    shard_mb: int = 512,
+    num_workers: int = 0,
+) -> pd.DataFrame:
+    """
+    Рендерит variants аугментированных вариантов на строку сплита в out_dir/part_XXXXX
+    (шарды PackedShardWriter + index.arrow + variants.json). Вариант k строки i зависит
+    только от (seed, i, k), поэтому части можно считать независимо и в любом порядке.
+
+    index.arrow: line_idx, variant, line_id + shard, offset, packed_height, packed_width.
+    """
+    variants = int(variants)
+    if variants <= 0:
+        raise ValueError("variants must be > 0")
+
+    renderer = _VariantRenderer(cfg, split, variants, seed)
+    num_lines = len(renderer.lines)
+    lines = part_lines(num_lines, part, num_parts)
+    line_ids = renderer.lines.table.strings("line_id")
+
+    out_dir = Path(out_dir) / PART_PATTERN.format(int(part))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for old in out_dir.glob("shard_*.bin"):
+        old.unlink()
+    (out_dir / META_NAME).unlink(missing_ok=True)
+
+    def _rendered() -> Iterator[list[np.ndarray]]:
+        if int(num_workers) <= 1:
+            yield from map(renderer, lines)
+            return
+        with ProcessPoolExecutor(
+            max_workers=int(num_workers),
+            initializer=_init_worker,
+            initargs=(cfg, split, variants, seed),
+        ) as pool:
+            yield from pool.map(_render_in_worker, lines, chunksize=16)
+
+    rows: dict[str, list] = {k: [] for k in ("line_idx", "variant", "line_id", "shard", "offset", "packed_height", "packed_width")}
+    with PackedShardWriter(out_dir, shard_bytes=int(shard_mb) * 1024 * 1024) as writer:
+        for line_idx, arrs in tqdm(zip(lines, _rendered()), total=len(lines), desc=f"Augmenting {split}", unit="line"):
+            for k, arr in enumerate(arrs):
+                shard_id, offset = writer.add(arr)
+                rows["line_idx"].append(line_idx)
+                rows["variant"].append(k)
+                rows["line_id"].append(line_ids[line_idx])
+                rows["shard"].append(shard_id)
+                rows["offset"].append(offset)
+                rows["packed_height"].append(int(arr.shape[0]))
+                rows["packed_width"].append(int(arr.shape[1]))
+
+    index = pd.DataFrame(
+        {
+            "line_idx": np.asarray(rows["line_idx"], dtype=np.int64),
+            "variant": np.asarray(rows["variant"], dtype=np.int32),
+            "line_id": rows["line_id"],
+            "shard": np.asarray(rows["shard"], dtype=np.int32),
+            "offset": np.asarray(rows["offset"], dtype=np.int64),
+            "packed_height": np.asarray(rows["packed_height"], dtype=np.int32),
+            "packed_width": np.asarray(rows["packed_width"], dtype=np.int32),
+        }
+    )
+    write_split_table(index, out_dir / INDEX_NAME)
+
+    # meta пишется последней: часть без variants.json считается недописанной
+    meta = {
+        "split": str(split),
+        "num_lines": int(num_lines),
+        "variants": variants,
+        "seed": int(seed),
+        "part": int(part),
+        "num_parts": int(num_parts),
+        "spec": render_spec(cfg),
+        "augment": augment_spec(cfg.augment),
+    }
+    (out_dir / META_NAME).write_text(json.dumps(meta, indent=2, ensure_ascii=False), encoding="utf-8")
+    return index
+
+
+class AugmentVariantStore:
+    """
+    Готовые варианты из pregenerate_augment. image(idx, epoch) — вариант строки idx для эпохи:
+    у каждой строки свой случайный сдвиг, дальше варианты идут по кругу, так что за
+    variants эпох строка проходит все свои варианты без повторов.
+    """
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+        metas = []
+        for part_dir in sorted(self.root.glob(PART_PATTERN.replace("{:05d}", "*"))):
+            meta_path = part_dir / META_NAME
+            if meta_path.exists():
+                metas.append((part_dir, json.loads(meta_path.read_text(encoding="utf-8"))))
+        if not metas:
+            raise FileNotFoundError(f"No augmented variants in {self.root}. Run `htr pregenerate_augment` first.")
+
+        for _, m in metas:
+            m["augment"] = augment_spec(m["augment"])
+        first = metas[0][1]
+        for key in ("num_lines", "variants", "seed", "num_parts", "spec", "augment"):
+            if any(m[key] != first[key] for _, m in metas):
+                raise ValueError(f"Parts in {self.root} disagree on {key!r}; regenerate them with the same settings")
+        found = sorted(int(m["part"]) for _, m in metas)
+        if found != list(range(int(first["num_parts"]))):
+            raise FileNotFoundError(f"Augmented variants in {self.root}: have parts {found} of {first['num_parts']}")
+
+        self.meta = first
+        self.num_lines = int(first["num_lines"])
+        self.variants = int(first["variants"])
+        self.spec = dict(first["spec"])
+        self.augment = dict(first["augment"])
+
+        self._parts = [PackedLineStore(part_dir) for part_dir, _ in sorted(metas, key=lambda x: int(x[1]["part"]))]
+        self._part = np.full((self.num_lines, self.variants), -1, dtype=np.int32)
+        self._row = np.full((self.num_lines, self.variants), -1, dtype=np.int64)
+        # line_id строки сплита, для которой рендерился вариант: по нему варианты сверяются со сплитом
+        self.line_ids = np.full((self.num_lines,), None, dtype=object)
+        for p, store in enumerate(self._parts):
+            line_idx = store.table.numeric("line_idx", np.int64)
+            variant = store.table.numeric("variant", np.int64)
+            self._part[line_idx, variant] = p
+            self._row[line_idx, variant] = np.arange(len(line_idx))
+            self.line_ids[line_idx] = store.table.strings("line_id")
+        if (self._part < 0).any():
+            raise ValueError(f"Augmented variants in {self.root} are incomplete")
+
+        self._shift = np.random.default_rng(int(first["seed"])).integers(self.variants, size=self.num_lines)
+
+    def __len__(self) -> int:
+        return self.num_lines
+
+    def __getstate__(self) -> dict:
+        return {"root": self.root}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["root"])
+
+    def variant(self, idx: int, epoch: int) -> int:
+        return int((self._shift[idx] + int(epoch)) % self.variants)
+
+    def image(self, idx: int, epoch: int = 0) -> np.ndarray:
+        idx = int(idx)
+        k = self.variant(idx, epoch)
+        return self._parts[int(self._part[idx, k])].image(int(self._row[idx, k]))
+
+
+def resolve_augment_variants(cfg, split: str) -> AugmentVariantStore | None:
+    """augment.pregenerated.enabled=true -> варианты из data.augmented_dir/<split> (только train)."""
+    if split != "train" or not pregenerated_enabled(cfg):
+        return None
+
+    store = AugmentVariantStore(Path(str(cfg.data.augmented_dir)) / split)
+    if store.spec != render_spec(cfg):
+        raise ValueError(
+            f"Augmented variants in {store.root} were rendered with preprocess {store.spec}, "
+            f"current is {render_spec(cfg)}. Rerun `htr pregenerate_augment`."
+        )
+    diff = _diff_keys(store.augment, augment_spec(cfg.augment))
+    if diff:
+        raise ValueError(
+            f"Augmented variants in {store.root} were rendered with another augment config "
+            f"(differs in {', '.join('augment.' + k for k in diff)}). Rerun `htr pregenerate_augment`."
+        )
+    return store
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+from PIL import Image
+
+from htr_ocr.data.transforms import LineImageTransform
+
+CACHE_VERSION = 1
+
+
+def transform_fingerprint(transform: LineImageTransform) -> str:
+    """Хэш параметров детерминированной части препроцессинга (height, keep_aspect, tight_crop.*)."""
+    spec = {"version": CACHE_VERSION, **transform.cache_spec()}
+    raw = json.dumps(spec, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+
+def file_image_key(image_path: str | Path) -> str:
+    """Ключ картинки на диске: путь + размер + mtime (без чтения содержимого)."""
+    p = Path(image_path)
+    st = p.stat()
+    raw = f"{p.resolve()}|{st.st_size}|{st.st_mtime_ns}".encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def array_image_key(arr: np.ndarray) -> str:
+    """Ключ по содержимому (для упакованных шардов, где картинка уже в памяти)."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.asarray(arr.shape, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(arr).data)
+    return h.hexdigest()
+
+
+class PreprocessCache:
+    """
+    Кэш результата LineImageTransform.prepare() на диске.
+
+    Лежит в <cache_dir>/<fingerprint>/<key[:2]>/<key>.npy, где fingerprint — хэш
+    preprocess-конфига. Поменяли height/keep_aspect/tight_crop — пишем в другую
+    папку, старые записи просто не читаются.
+    """
+
+    def __init__(self, cache_dir: str | Path) -> None:
+        self.cache_dir = Path(cache_dir)
+        self._fingerprints: dict[int, tuple[LineImageTransform, str]] = {}
+
+    def _entry_path(self, transform: LineImageTransform, key: str) -> Path:
+        cached = self._fingerprints.get(id(transform))
+        if cached is None or cached[0] is not transform:
+            cached = (transform, transform_fingerprint(transform))
+            self._fingerprints[id(transform)] = cached
+        fp = cached[1]
+        return self.cache_dir / fp / key[:2] / f"{key}.npy"
+
+    def get(self, transform: LineImageTransform, key: str) -> np.ndarray | None:
+        path = self._entry_path(transform, key)
+        try:
+            return np.load(path, allow_pickle=False)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def put(self, transform: LineImageTransform, key: str, arr: np.ndarray) -> None:
+        path = self._entry_path(transform, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # пишем во временный файл и переименовываем: воркеры DataLoader пишут параллельно
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(arr, dtype=np.uint8), allow_pickle=False)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def apply(self, transform: LineImageTransform, key: str, load_image: Callable[[], Image.Image]) -> Any:
+        """transform(load_image()), но детерминированная часть берётся из кэша, если она там есть."""
+        arr = self.get(transform, key)
+        if arr is None:
+            prepared = transform.prepare(load_image())
+            arr = np.array(prepared, dtype=np.uint8)
+            self.put(transform, key, arr)
+        return transform.finish(arr)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_fingerprints"] = {}
+        return state
+
+
+def make_preprocess_cache(cfg) -> PreprocessCache | None:
+    cache_cfg = getattr(cfg.preprocess, "cache", None)
+    if cache_cfg is None or not bool(getattr(cache_cfg, "enabled", False)):
+        return None
+    return PreprocessCache(str(cache_cfg.dir))
@@ -1,10 +1,61 @@
-from dataclasses import dataclass
-import random
+from dataclasses import dataclass, field
 from typing import Iterator, Sequence
 
+import numpy as np
+
+from htr_ocr.utils.dist import rank_world
+
+
+class _EpochShardMixin:
+    """
+    Общее для бакет-семплеров:
+    - set_epoch: перемешивание и джиттер зависят от (seed, epoch), а не только от seed;
+    - sort_jitter: сортировка по width * (1 + U(-j, j)), состав батчей меняется от эпохи к эпохе;
+    - num_replicas / rank: батчи целиком делятся между процессами, у всех одинаковое число шагов
+      (лишние батчи в хвосте отбрасываются; после перемешивания это каждую эпоху разные батчи).
+      None — берутся из torch.distributed / RANK, WORLD_SIZE.
+    """
+
+    seed: int
+    epoch: int
+    sort_jitter: float
+    num_replicas: int | None
+    rank: int | None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = int(epoch)
+
+    def _rank_world(self) -> tuple[int, int]:
+        rank, world = rank_world()
+        world = int(self.num_replicas) if self.num_replicas is not None else world
+        rank = int(self.rank) if self.rank is not None else rank
+        if not 0 <= rank < world:
+            raise ValueError(f"rank must be in [0, {world}), got {rank}")
+        return rank, world
+
+    def _rng(self, stream: int) -> np.random.Generator:
+        # одинаковый на всех rank: разбиение на батчи и их порядок должны совпадать.
+        # stream 0 — джиттер сортировки, 1 — порядок батчей
+        return np.random.default_rng([int(self.seed), int(self.epoch), int(stream)])
+
+    def _sorted_order(self, lengths: np.ndarray) -> np.ndarray:
+        keys = lengths.astype(np.float64)
+        if float(self.sort_jitter) > 0:
+            j = float(self.sort_jitter)
+            keys = keys * (1.0 + self._rng(0).uniform(-j, j, size=len(keys)))
+        # stable argsort == sorted(range(n), key=lengths), но без Python-цикла
+        return np.argsort(keys, kind="stable")
+
+    def _shard(self, batches: list[list[int]]) -> list[list[int]]:
+        rank, world = self._rank_world()
+        if world == 1:
+            return batches
+        usable = len(batches) // world * world
+        return batches[rank:usable:world]
+
 
 @dataclass
-class BucketBatchSampler:
+class BucketBatchSampler(_EpochShardMixin):
     """
     Сортируем все батчи по длинам и отдаем в батч похожие.
     Это уменьшит паддинг.
@@ -15,23 +66,26 @@ class BucketBatchSampler:
     shuffle_batches: bool = True
     seed: int = 42
     drop_last: bool = False
+    sort_jitter: float = 0.0
+    num_replicas: int | None = None
+    rank: int | None = None
+    epoch: int = field(default=0, init=False)
 
     def __iter__(self) -> Iterator[list[int]]:
         bs = int(self.batch_size)
         if bs <= 0:
             raise ValueError("Empty batch")
 
-        order = sorted(range(len(self.lengths)), key=lambda i: int(self.lengths[i]))
+        order = self._sorted_order(np.asarray(self.lengths, dtype=np.int64)).tolist()
         batches = [order[i : i + bs] for i in range(0, len(order), bs)]
 
         if self.drop_last and batches and len(batches[-1]) < bs:
             batches = batches[:-1]
 
         if self.shuffle_batches:
-            rnd = random.Random(int(self.seed))
-            rnd.shuffle(batches)
+            batches = [batches[i] for i in self._rng(1).permutation(len(batches))]
 
-        for b in batches:
+        for b in self._shard(batches):
             yield b
 
     def __len__(self) -> int:
@@ -39,6 +93,136 @@ class BucketBatchSampler:
         bs = int(self.batch_size)
         if bs <= 0:
             return 0
-        if self.drop_last:
-            return n // bs
-        return (n + bs - 1) // bs
\ No newline at end of file
+        total = n // bs if self.drop_last else (n + bs - 1) // bs
+        return total // self._rank_world()[1]
+
+
+@dataclass
+class PixelBudgetBatchSampler(_EpochShardMixin):
+    """
+    Бакетинг по ширине, но батч набирается не до batch_size, а до бюджета:
+    max_pixels >= B * W_max * height и/или max_tokens >= B * ceil(W_max / token_width)
+    (W_max — самая широкая строка батча, т.е. ширина после паддинга; с width_multiple > 1
+    округлённая вверх до кратного, как её паддит collate_line_batch).
+    Узкие строки идут большими батчами, широкие — маленькими, пик памяти на шаг предсказуем.
+
+    Строка, которая одна не влезает в бюджет, идёт отдельным батчем.
+    Разбиение детерминировано по lengths (и эпохе, если sort_jitter > 0), поэтому __len__ точный.
+    """
+
+    lengths: Sequence[int]
+    max_pixels: int = 0
+    height: int = 1
+    max_tokens: int = 0
+    token_width: int = 4
+    max_batch_size: int = 0
+    width_multiple: int = 1
+    shuffle_batches: bool = True
+    seed: int = 42
+    sort_jitter: float = 0.0
+    num_replicas: int | None = None
+    rank: int | None = None
+    epoch: int = field(default=0, init=False)
+
+    def __post_init__(self) -> None:
+        if int(self.max_pixels) <= 0 and int(self.max_tokens) <= 0:
+            raise ValueError("PixelBudgetBatchSampler needs max_pixels > 0 or max_tokens > 0")
+        self._batches: list[list[int]] | None = None
+        self._batches_epoch: int | None = None
+
+    def _cap(self, width: int) -> int:
+        """Сколько строк шириной width (после паддинга) помещается в бюджет."""
+        m = max(1, int(self.width_multiple))
+        width = -(-int(width) // m) * m
+        caps = []
+        if int(self.max_pixels) > 0:
+            caps.append(int(self.max_pixels) // max(1, int(width) * int(self.height)))
+        if int(self.max_tokens) > 0:
+            tokens = -(-int(width) // max(1, int(self.token_width)))
+            caps.append(int(self.max_tokens) // max(1, tokens))
+        if int(self.max_batch_size) > 0:
+            caps.append(int(self.max_batch_size))
+        return max(1, min(caps))
+
+    def _pack(self) -> list[list[int]]:
+        lengths = np.asarray(self.lengths, dtype=np.int64)
+        batches: list[list[int]] = []
+        cur: list[int] = []
+        w_max = 0
+        for i in self._sorted_order(lengths).tolist():
+            # с джиттером порядок почти по возрастанию, поэтому W_max считаем явно
+            w = max(w_max, int(lengths[i]))
+            if cur and len(cur) + 1 > self._cap(w):
+                batches.append(cur)
+                cur, w = [], int(lengths[i])
+            cur.append(i)
+            w_max = w
+        if cur:
+            batches.append(cur)
+        return batches
+
+    def batches(self) -> list[list[int]]:
+        """Все батчи эпохи до перемешивания и деления между rank."""
+        # без джиттера разбиение от эпохи не зависит, считаем один раз
+        key = int(self.epoch) if float(self.sort_jitter) > 0 else 0
+        if self._batches is None or self._batches_epoch != key:
+            self._batches = self._pack()
+            self._batches_epoch = key
+        return self._batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        batches = list(self.batches())
+        if self.shuffle_batches:
+            batches = [batches[i] for i in self._rng(1).permutation(len(batches))]
+
+        for b in self._shard(batches):
+            yield b
+
+    def __len__(self) -> int:
+        return len(self.batches()) // self._rank_world()[1]
+
+
+def make_bucket_sampler(
+    cfg,
+    lengths: Sequence[int],
+    distributed: bool = True,
+) -> BucketBatchSampler | PixelBudgetBatchSampler:
+    """
+    loader.bucket.budget.max_pixels / max_tokens > 0 -> PixelBudgetBatchSampler,
+    иначе BucketBatchSampler с фиксированным loader.batch_size.
+    Тренеры зовут set_epoch у batch_sampler в начале каждой эпохи.
+    distributed=False: каждый процесс видит весь сплит (оценка, inspect_data).
+    """
+    replicas = {} if distributed else {"num_replicas": 1, "rank": 0}
+    bucket = cfg.loader.bucket
+    budget = getattr(bucket, "budget", None)
+    max_pixels = int(getattr(budget, "max_pixels", 0)) if budget is not None else 0
+    max_tokens = int(getattr(budget, "max_tokens", 0)) if budget is not None else 0
+    sort_jitter = float(getattr(bucket, "sort_jitter", 0.0))
+    collate = getattr(cfg.loader, "collate", None)
+
+    if max_pixels > 0 or max_tokens > 0:
+        return PixelBudgetBatchSampler(
+            lengths=lengths,
+            max_pixels=max_pixels,
+            height=int(cfg.preprocess.height),
+            max_tokens=max_tokens,
+            token_width=int(getattr(budget, "token_width", 4)),
+            max_batch_size=int(getattr(budget, "max_batch_size", 0)),
+            # бюджет — по ширине после паддинга collate (loader.collate.width_multiple)
+            width_multiple=int(getattr(collate, "width_multiple", 1)) if collate is not None else 1,
+            shuffle_batches=bool(cfg.loader.shuffle),
+            seed=int(bucket.seed),
+            sort_jitter=sort_jitter,
+            **replicas,
+        )
+
+    return BucketBatchSampler(
+        lengths=lengths,
+        batch_size=int(cfg.loader.batch_size),
+        shuffle_batches=bool(cfg.loader.shuffle),
+        seed=int(bucket.seed),
+        drop_last=bool(bucket.drop_last),
+        sort_jitter=sort_jitter,
+        **replicas,
+    )
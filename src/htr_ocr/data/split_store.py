@@ -0,0 +1,120 @@
+from pathlib import Path
+from typing import Any, Iterable
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+# id-колонки с большим числом повторов храним как dictionary (аналог pandas category)
+CATEGORICAL_COLUMNS = ("form_id", "writer_id", "status")
+
+SPLIT_SUFFIXES = (".arrow", ".csv")
+
+
+def _to_arrow(df: pd.DataFrame) -> pa.Table:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for col in CATEGORICAL_COLUMNS:
+        i = table.schema.get_field_index(col)
+        if i < 0 or pa.types.is_dictionary(table.schema.field(i).type):
+            continue
+        table = table.set_column(i, col, pc.dictionary_encode(table[col]))
+    return table.combine_chunks()
+
+
+def write_split_table(df: pd.DataFrame, path: str | Path) -> Path:
+    """Пишет сплит в Arrow IPC (без сжатия, одним батчем), чтобы его можно было читать через mmap."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = _to_arrow(df)
+    tmp = path.with_name(path.name + ".tmp")
+    with pa.OSFile(str(tmp), "wb") as sink, ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    tmp.replace(path)
+    return path
+
+
+def resolve_split_path(processed_dir: str | Path, split: str) -> Path:
+    """<split>.arrow, если make_splits его записал, иначе <split>.csv."""
+    processed_dir = Path(processed_dir)
+    for suffix in SPLIT_SUFFIXES:
+        p = processed_dir / f"{split}{suffix}"
+        if p.exists():
+            return p
+    raise FileNotFoundError(f"Split not found: {processed_dir / split}.arrow|.csv")
+
+
+class SplitTable:
+    """
+    Колоночный доступ к сплиту.
+
+    .arrow открывается через pa.memory_map: данные не копируются в память процесса,
+    а страницы файла общие для всех воркеров DataLoader. .parquet/.csv читаются целиком
+    (для совместимости со старыми сплитами и индексами).
+
+    value(col, idx) — O(1) доступ к ячейке, numeric(col) — numpy-view числовой колонки.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        if not self.path.exists():
+            raise FileNotFoundError(f"Split not found: {self.path}")
+        self._open()
+
+    def _open(self) -> None:
+        suffix = self.path.suffix.lower()
+        if suffix in (".arrow", ".feather"):
+            source = pa.memory_map(str(self.path), "r")
+            table = ipc.open_file(source).read_all()
+        elif suffix == ".parquet":
+            table = pq.read_table(self.path, memory_map=True)
+        elif suffix == ".csv":
+            table = _to_arrow(pd.read_csv(self.path))
+        else:
+            raise ValueError(f"Unsupported split format: {self.path}")
+
+        if any(table[c].num_chunks > 1 for c in table.column_names):
+            table = table.combine_chunks()
+
+        self.table = table
+        self._cols: dict[str, pa.Array] = {
+            name: (col.chunk(0) if col.num_chunks == 1 else pa.concat_arrays(col.chunks))
+            for name, col in zip(table.column_names, table.columns)
+        }
+
+    def __getstate__(self) -> dict:
+        # в воркер передаём только путь: mmap откроется заново и не будет скопирован пиклом
+        return {"path": self.path}
+
+    def __setstate__(self, state: dict) -> None:
+        self.path = state["path"]
+        self._open()
+
+    def __len__(self) -> int:
+        return int(self.table.num_rows)
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self.table.column_names)
+
+    def __contains__(self, col: str) -> bool:
+        return col in self._cols
+
+    def value(self, col: str, idx: int) -> Any:
+        return self._cols[col][int(idx)].as_py()
+
+    def row(self, idx: int, cols: Iterable[str]) -> dict[str, Any]:
+        return {c: self.value(c, idx) for c in cols if c in self._cols}
+
+    def numeric(self, col: str, dtype: Any = None) -> np.ndarray:
+        # для примитивных колонок без null это view на mmap, без копии
+        out = self._cols[col].to_numpy(zero_copy_only=False)
+        return out.astype(dtype, copy=False) if dtype is not None else out
+
+    def strings(self, col: str) -> list[str]:
+        return [str(x) for x in self._cols[col].to_pylist()]
+
+    def to_pandas(self) -> pd.DataFrame:
+        return self.table.to_pandas()
@@ -0,0 +1,229 @@
+import itertools
+import math
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+from htr_ocr.data.collate import collate_line_batch, collate_options
+from htr_ocr.data.dataset import IamLineDataset
+from htr_ocr.data.packed import resolve_packed_dir
+from htr_ocr.data.preprocess_cache import PreprocessCache, make_preprocess_cache
+from htr_ocr.utils.dist import rank_world
+
+
+class StreamingLineDataset(IterableDataset):
+    """
+    Потоковое чтение упакованного сплита (pack_dataset): отдаёт сразу готовые батчи
+    collate_line_batch, поэтому DataLoader создаётся с batch_size=None.
+
+    - шарды читаются последовательно и делятся между (rank, worker) без пересечений;
+      если шардов меньше, чем читателей, шард режется на непрерывные куски строк;
+    - у всех rank одно число батчей за эпоху (минимум по rank), иначе DDP зависнет на коллективе
+      последнего шага: лишние батчи снимаются с хвостов самых длинных читателей rank;
+    - порядок шардов перемешивается seed + epoch (set_epoch), строки — буфером shuffle_buffer;
+    - bucket_buffer строк сортируются по ширине и режутся на батчи (как BucketBatchSampler).
+
+    В памяти только индексы буферов, картинки декодируются при сборке батча.
+    """
+
+    def __init__(
+        self,
+        packed_dir: str | Path,
+        transform: Callable[[Image.Image], Any] | None = None,
+        target_height: int = 128,
+        batch_size: int = 16,
+        shuffle: bool = True,
+        seed: int = 42,
+        shuffle_buffer: int = 2048,
+        bucket_buffer: int = 512,
+        drop_last: bool = False,
+        pad_value: float = 1.0,
+        num_workers: int = 0,
+        preprocess_cache: PreprocessCache | None = None,
+        batch_transform: Callable[[dict[str, Any]], dict[str, Any]] | None = None,
+        augment_variants: Any | None = None,
+        collate_kwargs: dict[str, Any] | None = None,
+        tokenizer: Any | None = None,
+    ) -> None:
+        super().__init__()
+        self.lines = IamLineDataset(
+            None,
+            transform=transform,
+            target_height=target_height,
+            packed_dir=packed_dir,
+            preprocess_cache=preprocess_cache,
+            augment_variants=augment_variants,
+            tokenizer=tokenizer,
+        )
+        self.batch_size = int(batch_size)
+        if self.batch_size <= 0:
+            raise ValueError("Empty batch")
+        self.shuffle = bool(shuffle)
+        self.seed = int(seed)
+        self.shuffle_buffer = max(0, int(shuffle_buffer))
+        # пул бакетинга кратен batch_size: неполный батч бывает только в конце потока читателя
+        self.bucket_pool = max(1, math.ceil(int(bucket_buffer) / self.batch_size)) * self.batch_size
+        self.drop_last = bool(drop_last)
+        self.pad_value = float(pad_value)
+        self.num_workers = int(num_workers)
+        self.batch_transform = batch_transform
+        self.collate_kwargs = dict(collate_kwargs or {})
+
+        shard = self.lines.store.table.numeric("shard", np.int64)
+        bounds = (np.flatnonzero(np.diff(shard)) + 1).tolist()
+        self._shard_ranges = list(zip([0, *bounds], [*bounds, len(shard)]))
+
+    @property
+    def epoch(self) -> int:
+        # SharedEpoch внутри lines: persistent-воркеры видят новую эпоху при следующем iter()
+        return self.lines.epoch
+
+    def set_epoch(self, epoch: int) -> None:
+        self.lines.set_epoch(epoch)
+
+    def _consumer_ranges(self, gid: int, consumers: int) -> list[tuple[int, int]]:
+        units = self._shard_ranges
+        if len(units) < consumers:
+            parts = math.ceil(consumers / max(1, len(units)))
+            split_units = []
+            for start, end in units:
+                cuts = np.linspace(start, end, parts + 1).round().astype(np.int64).tolist()
+                split_units.extend((a, b) for a, b in zip(cuts[:-1], cuts[1:]) if b > a)
+            units = split_units
+
+        order = np.arange(len(units))
+        if self.shuffle:
+            # одна перестановка на все процессы, чтобы разбиение не пересекалось
+            order = np.random.default_rng([self.seed, self.epoch]).permutation(len(units))
+        return [units[i] for i in order[gid::consumers]]
+
+    def _num_batches(self, rows: int) -> int:
+        if self.drop_last:
+            return rows // self.batch_size
+        return math.ceil(rows / self.batch_size)
+
+    def _quotas(self, rank: int, world: int, nw: int) -> list[int]:
+        """Сколько батчей за эпоху отдаёт каждый воркер этого rank (в сумме — одинаково у всех rank)."""
+        counts = np.array(
+            [
+                [self._num_batches(sum(b - a for a, b in self._consumer_ranges(r * nw + w, world * nw))) for w in range(nw)]
+                for r in range(world)
+            ],
+            dtype=np.int64,
+        )
+        quota = counts[rank].copy()
+        for _ in range(int(quota.sum() - counts.sum(axis=1).min())):
+            quota[int(np.argmax(quota))] -= 1
+        return quota.tolist()
+
+    def __len__(self) -> int:
+        rank, world = rank_world()
+        return sum(self._quotas(rank, world, max(1, self.num_workers)))
+
+    def _rows(self, ranges: list[tuple[int, int]], rng: np.random.Generator) -> Iterator[int]:
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            for start, end in ranges:
+                yield from range(start, end)
+            return
+
+        buf: list[int] = []
+        for start, end in ranges:
+            for i in range(start, end):
+                if len(buf) < self.shuffle_buffer:
+                    buf.append(i)
+                    continue
+                j = int(rng.integers(len(buf)))
+                yield buf[j]
+                buf[j] = i
+        rng.shuffle(buf)
+        yield from buf
+
+    def _bucket(self, pool: list[int], rng: np.random.Generator) -> list[list[int]]:
+        widths = self.lines.approx_resized_widths()[pool]
+        order = np.asarray(pool)[np.argsort(widths, kind="stable")].tolist()
+        bs = self.batch_size
+        batches = [order[i : i + bs] for i in range(0, len(order), bs)]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def _batches(self, rows: Iterator[int], rng: np.random.Generator) -> Iterator[list[int]]:
+        pool: list[int] = []
+        for i in rows:
+            pool.append(i)
+            if len(pool) == self.bucket_pool:
+                yield from self._bucket(pool, rng)
+                pool = []
+        if pool:
+            for b in self._bucket(pool, rng):
+                if self.drop_last and len(b) < self.batch_size:
+                    continue
+                yield b
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        rank, world = rank_world()
+        info = get_worker_info()
+        wid, nw = (info.id, info.num_workers) if info is not None else (0, 1)
+        gid = rank * nw + wid
+
+        ranges = self._consumer_ranges(gid, world * nw)
+        quota = self._quotas(rank, world, nw)[wid]
+        rng = np.random.default_rng([self.seed, self.epoch, gid])
+        for idx in itertools.islice(self._batches(self._rows(ranges, rng), rng), quota):
+            yield collate_line_batch(
+                [self.lines[i] for i in idx],
+                pad_value=self.pad_value,
+                batch_transform=self.batch_transform,
+                **self.collate_kwargs,
+            )
+
+
+def streaming_enabled(cfg) -> bool:
+    streaming = getattr(cfg.loader, "streaming", None)
+    return streaming is not None and bool(getattr(streaming, "enabled", False))
+
+
+def make_streaming_dataset(
+    cfg,
+    split: str,
+    transform: Callable[[Image.Image], Any],
+    batch_transform: Callable[[dict[str, Any]], dict[str, Any]] | None = None,
+    augment_variants: Any | None = None,
+    tokenizer: Any | None = None,
+) -> StreamingLineDataset:
+    """
+    loader.streaming.enabled=true: StreamingLineDataset поверх data.packed_dir/<split>.
+    DataLoader (batch_size=None) собирает data.loader.make_line_dataloader.
+    """
+    packed_dir = resolve_packed_dir(cfg, split)
+    if packed_dir is None:
+        raise ValueError("loader.streaming requires data.backend=packed. Run `htr pack_dataset` first.")
+
+    budget = getattr(cfg.loader.bucket, "budget", None)
+    if budget is not None and (int(getattr(budget, "max_pixels", 0)) > 0 or int(getattr(budget, "max_tokens", 0)) > 0):
+        raise ValueError("loader.streaming does not support loader.bucket.budget; use a fixed loader.batch_size")
+
+    streaming = cfg.loader.streaming
+    bucket_enabled = bool(getattr(cfg.loader.bucket, "enabled", False))
+    ds = StreamingLineDataset(
+        packed_dir=packed_dir,
+        transform=transform,
+        target_height=int(cfg.preprocess.height),
+        batch_size=int(cfg.loader.batch_size),
+        shuffle=bool(cfg.loader.shuffle),
+        seed=int(cfg.loader.bucket.seed),
+        shuffle_buffer=int(getattr(streaming, "shuffle_buffer", 2048)),
+        bucket_buffer=int(getattr(streaming, "bucket_buffer", 512)) if bucket_enabled else 0,
+        drop_last=bool(cfg.loader.bucket.drop_last),
+        pad_value=float(cfg.preprocess.pad_value) / 255.0,
+        num_workers=int(cfg.loader.num_workers),
+        preprocess_cache=make_preprocess_cache(cfg),
+        batch_transform=batch_transform,
+        augment_variants=augment_variants,
+        collate_kwargs=collate_options(cfg),
+        tokenizer=tokenizer,
+    )
+    return ds
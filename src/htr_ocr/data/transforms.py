@@ -1,12 +1,15 @@
 from dataclasses import dataclass
 from typing import Any, Callable
 
+import numpy as np
 from PIL import Image
 
 import torch
 from torchvision.transforms.functional import pil_to_tensor
 
+from htr_ocr.data.np_preprocess import decode_gray, ink_bbox, resize_bilinear
 from htr_ocr.data.augmentations import (
+    RandomApplyAll,
     RandomDistort,
     RandomElastic,
     RandomOneOf,
@@ -32,10 +35,24 @@ class ResizeToHeight:
         if h0 <= 0:
             return img
 
+        return img.resize(self.target_size(w0, h0), resample=Image.Resampling.BILINEAR)
+
+    def target_size(self, w0: int, h0: int) -> tuple[int, int]:
+        h = int(self.height)
         if self.keep_aspect:
-            w = max(1, int(round(w0 * (h / h0))))
-            return img.resize((w, h), resample=Image.Resampling.BILINEAR)
-        return img.resize((w0, h), resample=Image.Resampling.BILINEAR)
+            return max(1, int(round(w0 * (h / h0)))), h
+        return w0, h
+
+    def apply_array(self, arr: np.ndarray) -> np.ndarray:
+        """То же на uint8 [H, W] без PIL (ресемплинг совпадает с BILINEAR бит-в-бит)."""
+        h = int(self.height)
+        if h <= 0:
+            raise ValueError("height must be > 0")
+        h0, w0 = arr.shape
+        if h0 <= 0:
+            return arr
+        w, h = self.target_size(w0, h0)
+        return resize_bilinear(arr, w, h)
 
 
 @dataclass(frozen=True)
@@ -54,91 +71,137 @@ class TightCrop:
         if bbox is None:
             return img
 
+        return img.crop(self._expand(bbox, *img.size))
+
+    def _expand(self, bbox: tuple[int, int, int, int], w: int, h: int) -> tuple[int, int, int, int]:
         left, upper, right, lower = bbox
         m = int(self.margin)
-        left = max(0, left - m)
-        upper = max(0, upper - m)
-        right = min(img.size[0], right + m)
-        lower = min(img.size[1], lower + m)
-        return img.crop((left, upper, right, lower))
+        return max(0, left - m), max(0, upper - m), min(w, right + m), min(h, lower + m)
 
+    def apply_array(self, arr: np.ndarray) -> np.ndarray:
+        """То же на uint8 [H, W]: bbox по проекциям строк/столбцов, crop — это срез (view)."""
+        if not self.enabled:
+            return arr
+        bbox = ink_bbox(arr, self.threshold)
+        if bbox is None:
+            return arr
+        left, upper, right, lower = self._expand(bbox, arr.shape[1], arr.shape[0])
+        return arr[upper:lower, left:right]
 
-def _build_train_augment(augment_cfg: Any, *, fill: int = 255) -> Callable[[Image.Image], Image.Image] | None:
-    if augment_cfg is None:
-        return None
-    if not bool(getattr(augment_cfg, "enabled", False)):
-        return None
 
-    methods: list[Callable[[Image.Image], Image.Image]] = []
-    p_each = float(getattr(augment_cfg, "p_each", 1.0))
+def build_augment_ops(
+    augment_cfg: Any,
+    *,
+    fill: int = 255,
+    p_each: float | None = None,
+) -> tuple[list[tuple[str, Callable[[Image.Image], Image.Image]]], list[tuple[str, Callable[[Image.Image], Image.Image]]]]:
+    """
+    Отдельные аугментации из конфига (без учёта augment.enabled): (верхний уровень, geometric).
+    p_each переопределяет вероятность каждой операции (профайлер ставит 1.0).
+    """
+    methods: list[tuple[str, Callable[[Image.Image], Image.Image]]] = []
+    geo_methods: list[tuple[str, Callable[[Image.Image], Image.Image]]] = []
+    if augment_cfg is None:
+        return methods, geo_methods
+    if p_each is None:
+        p_each = float(getattr(augment_cfg, "p_each", 1.0))
 
     shear_cfg = getattr(augment_cfg, "shear", None)
     if shear_cfg is not None and bool(getattr(shear_cfg, "enabled", True)):
         methods.append(
-            RandomShear(
-                max_degrees=float(getattr(shear_cfg, "max_degrees", 7.0)),
-                p=p_each,
-                fill=fill,
+            (
+                "shear",
+                RandomShear(
+                    max_degrees=float(getattr(shear_cfg, "max_degrees", 7.0)),
+                    p=p_each,
+                    fill=fill,
+                ),
             )
         )
 
     rot_cfg = getattr(augment_cfg, "rotate", None)
     if rot_cfg is not None and bool(getattr(rot_cfg, "enabled", True)):
         methods.append(
-            RandomRotate(
-                max_degrees=float(getattr(rot_cfg, "max_degrees", 3.0)),
-                p=p_each,
-                fill=fill,
+            (
+                "rotate",
+                RandomRotate(
+                    max_degrees=float(getattr(rot_cfg, "max_degrees", 3.0)),
+                    p=p_each,
+                    fill=fill,
+                ),
             )
         )
 
     el_cfg = getattr(augment_cfg, "elastic", None)
     if el_cfg is not None and bool(getattr(el_cfg, "enabled", True)):
         methods.append(
-            RandomElastic(
-                alpha=float(getattr(el_cfg, "alpha", 40.0)),
-                sigma=float(getattr(el_cfg, "sigma", 6.0)),
-                p=p_each,
-                fill=fill,
+            (
+                "elastic",
+                RandomElastic(
+                    alpha=float(getattr(el_cfg, "alpha", 40.0)),
+                    sigma=float(getattr(el_cfg, "sigma", 6.0)),
+                    p=p_each,
+                    fill=fill,
+                    bank_size=int(getattr(el_cfg, "bank_size", 0)),
+                    bank_refresh=int(getattr(el_cfg, "bank_refresh", 64)),
+                ),
             )
         )
 
     geo_cfg = getattr(augment_cfg, "geometric", None)
     if geo_cfg is not None and bool(getattr(geo_cfg, "enabled", True)):
-        geo_methods: list[Callable[[Image.Image], Image.Image]] = []
-
         d_cfg = getattr(geo_cfg, "distortion", None)
         if d_cfg is not None and bool(getattr(d_cfg, "enabled", True)):
             geo_methods.append(
-                RandomDistort(
-                    max_shift_px=int(getattr(d_cfg, "max_shift_px", 6)),
-                    num_stripes=int(getattr(d_cfg, "num_stripes", 12)),
-                    p=p_each,
-                    fill=fill,
+                (
+                    "distortion",
+                    RandomDistort(
+                        max_shift_px=int(getattr(d_cfg, "max_shift_px", 6)),
+                        num_stripes=int(getattr(d_cfg, "num_stripes", 12)),
+                        p=p_each,
+                        fill=fill,
+                    ),
                 )
             )
 
         s_cfg = getattr(geo_cfg, "stretch", None)
         if s_cfg is not None and bool(getattr(s_cfg, "enabled", True)):
             geo_methods.append(
-                RandomStretch(
-                    max_factor=float(getattr(s_cfg, "max_factor", 0.15)),
-                    p=p_each,
+                (
+                    "stretch",
+                    RandomStretch(
+                        max_factor=float(getattr(s_cfg, "max_factor", 0.15)),
+                        p=p_each,
+                    ),
                 )
             )
 
         p_cfg = getattr(geo_cfg, "perspective", None)
         if p_cfg is not None and bool(getattr(p_cfg, "enabled", True)):
             geo_methods.append(
-                RandomPerspective(
-                    distortion_scale=float(getattr(p_cfg, "distortion_scale", 0.2)),
-                    p=p_each,
-                    fill=fill,
+                (
+                    "perspective",
+                    RandomPerspective(
+                        distortion_scale=float(getattr(p_cfg, "distortion_scale", 0.2)),
+                        p=p_each,
+                        fill=fill,
+                    ),
                 )
             )
 
-        if geo_methods:
-            methods.append(RandomOneOf(transforms=geo_methods, p_total=1.0))
+    return methods, geo_methods
+
+
+def _build_train_augment(augment_cfg: Any, *, fill: int = 255) -> Callable[[Image.Image], Image.Image] | None:
+    if augment_cfg is None:
+        return None
+    if not bool(getattr(augment_cfg, "enabled", False)):
+        return None
+
+    named, geo_named = build_augment_ops(augment_cfg, fill=fill)
+    methods: list[Callable[[Image.Image], Image.Image]] = [m for _, m in named]
+    if geo_named:
+        methods.append(RandomOneOf(transforms=[m for _, m in geo_named], p_total=1.0))
 
     if not methods:
         return None
@@ -149,16 +212,89 @@ def _build_train_augment(augment_cfg: Any, *, fill: int = 255) -> Callable[[Imag
     if one_of:
         return RandomOneOf(transforms=methods, p_total=p_total)
 
-    def _apply_all(img: Image.Image) -> Image.Image:
-        import random
+    return RandomApplyAll(transforms=methods, p_total=p_total)
 
-        if random.random() > p_total:
-            return img
-        for m in methods:
-            img = m(img)
+
+@dataclass(frozen=True)
+class LineImageTransform:
+    """
+    convert("L") -> TightCrop -> [аугментации] -> ResizeToHeight -> [float tensor].
+
+    prepare() — детерминированная часть (без аугментаций её можно кэшировать вместе с resize),
+    finish() — всё остальное. __call__ == finish(prepare(img)).
+
+    backend="numpy": crop и resize на uint8-массивах (вход может быть сразу np.ndarray [H, W]),
+    результат тот же, что у backend="pil". В PIL переводим только для аугментаций.
+    """
+
+    crop: TightCrop
+    resize: ResizeToHeight
+    aug: Callable[[Image.Image], Image.Image] | None = None
+    to_float_tensor: bool = True
+    backend: str = "pil"
+    # тензор остаётся uint8 [1, H, W] (loader.collate.uint8), в [0,1] переводится на устройстве
+    uint8_tensor: bool = False
+
+    @property
+    def prepare_includes_resize(self) -> bool:
+        return self.aug is None
+
+    def cache_spec(self) -> dict[str, Any]:
+        """Всё, от чего зависит результат prepare(); используется как ключ кэша препроцессинга."""
+        return {
+            "height": int(self.resize.height),
+            "keep_aspect": bool(self.resize.keep_aspect),
+            "tight_crop": {
+                "enabled": bool(self.crop.enabled),
+                "threshold": int(self.crop.threshold),
+                "margin": int(self.crop.margin),
+            },
+            "stage": "crop_resize" if self.prepare_includes_resize else "crop",
+        }
+
+    @property
+    def accepts_array(self) -> bool:
+        return self.backend == "numpy"
+
+    def prepare(self, img: Image.Image | np.ndarray) -> Image.Image | np.ndarray:
+        if self.accepts_array:
+            arr = img if isinstance(img, np.ndarray) else decode_gray(img)
+            arr = self.crop.apply_array(arr)
+            if self.prepare_includes_resize:
+                arr = self.resize.apply_array(arr)
+            return arr
+
+        if isinstance(img, np.ndarray):
+            img = Image.fromarray(img)
+        img = img.convert("L")
+        img = self.crop(img)
+        if self.prepare_includes_resize:
+            img = self.resize(img)
         return img
 
-    return _apply_all
+    def finish(self, img: Image.Image | np.ndarray) -> Any:
+        if isinstance(img, np.ndarray):
+            if self.aug is None:
+                if not self.to_float_tensor:
+                    return Image.fromarray(img)
+                # картинка уже финальная (из кэша или numpy-бэкенда): только uint8 -> float
+                # memmap-view из шардов read-only: копия только в этом случае
+                t = torch.from_numpy(np.require(img, requirements=["C", "W"])).unsqueeze(0)
+                return t if self.uint8_tensor else t.to(dtype=torch.float32) / 255.0
+            img = Image.fromarray(img)
+
+        if self.aug is not None:
+            img = self.aug(img)
+            img = self.resize(img)
+
+        if not self.to_float_tensor:
+            return img
+
+        t = pil_to_tensor(img)  # uint8, [1,H,W]
+        return t if self.uint8_tensor else t.to(dtype=torch.float32) / 255.0
+
+    def __call__(self, img: Image.Image) -> Any:
+        return self.finish(self.prepare(img))
 
 
 def make_image_transform(
@@ -172,7 +308,16 @@ def make_image_transform(
     is_train: bool = False,
     to_float_tensor: bool = True,
     fill: int = 255,
-) -> Callable[[Image.Image], Any]:
+    backend: str = "pil",
+    uint8_tensor: bool = False,
+) -> LineImageTransform:
+    """
+    backend: pil | numpy (preprocess.backend), вывод у обоих одинаковый.
+    uint8_tensor: вместо float [0,1] отдавать uint8 тензор (для collate с loader.collate.uint8=true).
+    """
+    backend = str(backend).lower()
+    if backend not in ("pil", "numpy"):
+        raise ValueError(f"Unknown preprocess.backend={backend!r}. Expected one of: pil, numpy")
     
     crop = TightCrop(
         enabled=bool(tight_crop_enabled),
@@ -183,20 +328,11 @@ def make_image_transform(
 
     aug = _build_train_augment(augment_cfg, fill=int(fill)) if is_train else None
 
-    def _pil_only(img: Image.Image) -> Image.Image:
-        img = img.convert("L")
-        img = crop(img)
-        if aug is not None:
-            img = aug(img)
-        img = resize(img)
-        return img
-
-    if not to_float_tensor:
-        return _pil_only
-
-    def _to_tensor(img: Image.Image):
-        img = _pil_only(img)
-        t = pil_to_tensor(img)  # uint8, [1,H,W]
-        return t.to(dtype=torch.float32) / 255.0
-
-    return _to_tensor
+    return LineImageTransform(
+        crop=crop,
+        resize=resize,
+        aug=aug,
+        to_float_tensor=bool(to_float_tensor),
+        backend=backend,
+        uint8_tensor=bool(uint8_tensor),
+    )
@@ -1,37 +1,76 @@
+import time
 from pathlib import Path
 from typing import Any, Callable
 
-import pandas as pd
+import numpy as np
 import torch
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision.transforms.functional import to_pil_image
 
+from htr_ocr.data.np_preprocess import load_gray
+from htr_ocr.data.packed import PackedLineStore
+from htr_ocr.data.preprocess_cache import PreprocessCache, array_image_key, file_image_key
+from htr_ocr.data.split_store import SplitTable
+from htr_ocr.data.transforms import LineImageTransform
+from htr_ocr.utils.loader_stats import BATCH_STATS_KEY, batch_stats
+
 
 class TrOCRLineDataset(Dataset):
-    def __init__(self, csv_path: str | Path, transform: Callable[[Image.Image], Any] | None = None) -> None:
-        self.csv_path = Path(csv_path)
-        if not self.csv_path.exists():
-            raise FileNotFoundError(f"Split CSV not found: {self.csv_path}")
+    def __init__(
+        self,
+        csv_path: str | Path | None,
+        transform: Callable[[Image.Image], Any] | None = None,
+        packed_dir: str | Path | None = None,
+        preprocess_cache: PreprocessCache | None = None,
+    ) -> None:
+        self.store = PackedLineStore(packed_dir) if packed_dir is not None else None
+
+        if self.store is not None:
+            self.csv_path = Path(csv_path) if csv_path is not None else None
+            self.table = self.store.table
+        else:
+            if csv_path is None:
+                raise ValueError("Either csv_path or packed_dir is required")
+            self.csv_path = Path(csv_path)
+            if not self.csv_path.exists():
+                raise FileNotFoundError(f"Split CSV not found: {self.csv_path}")
+            self.table = SplitTable(self.csv_path)
 
-        self.df = pd.read_csv(self.csv_path)
         self.transform = transform
+        self.preprocess_cache = preprocess_cache if isinstance(transform, LineImageTransform) else None
+        self._array_input = isinstance(transform, LineImageTransform) and transform.accepts_array
 
     def __len__(self) -> int:
-        return len(self.df)
-
-    def __getitem__(self, idx: int) -> dict[str, Any]:
-        row = self.df.iloc[idx]
-        image_path = Path(row["image_path"])
-        text = str(row["text"])
+        return len(self.table)
 
+    def _load_image(self, idx: int, image_path: Path) -> Image.Image | np.ndarray:
+        if self.store is not None:
+            arr = self.store.image(idx)
+            return arr if self._array_input else Image.fromarray(arr)
         if not image_path.exists():
             raise FileNotFoundError(f"Image not found: {image_path}")
+        if self._array_input:
+            return load_gray(str(image_path))
+        return Image.open(image_path).convert("L")
 
-        image = Image.open(image_path).convert("L")
-
-        if self.transform is not None:
-            image = self.transform(image)
+    def __getitem__(self, idx: int) -> dict[str, Any]:
+        t0 = time.perf_counter()
+        idx = int(idx)
+        image_path = Path(str(self.table.value("image_path", idx)))
+        text = str(self.table.value("text", idx))
+
+        if self.preprocess_cache is not None:
+            if self.store is not None:
+                arr = self.store.image(idx)
+                key = array_image_key(arr)
+            else:
+                key = file_image_key(image_path)
+            image = self.preprocess_cache.apply(self.transform, key, lambda: self._load_image(idx, image_path))
+        else:
+            image = self._load_image(idx, image_path)
+            if self.transform is not None:
+                image = self.transform(image)
 
         if isinstance(image, torch.Tensor):
             image = to_pil_image(image)
@@ -42,11 +81,24 @@ class TrOCRLineDataset(Dataset):
             "image": image,
             "text": text,
             "image_path": str(image_path),
+            # чтение + препроцессинг строки, для LoaderStats
+            "load_s": time.perf_counter() - t0,
         }
 
 
-def build_trocr_collate(processor, max_target_length: int):
-    def _collate(batch: list[dict[str, Any]]) -> dict[str, Any]:
+class TrOCRCollator:
+    """
+    collate_fn для TrOCR: картинки через processor, тексты в labels (паддинг -> -100). Пиклится.
+    Статистика для LoaderStats — без пикселей: processor приводит всё к одному размеру, паддинга нет.
+    """
+
+    def __init__(self, processor, max_target_length: int) -> None:
+        self.processor = processor
+        self.max_target_length = int(max_target_length)
+
+    def __call__(self, batch: list[dict[str, Any]]) -> dict[str, Any]:
+        t0 = time.perf_counter()
+        processor = self.processor
         images = [x["image"] for x in batch]
         texts = [x["text"] for x in batch]
         image_paths = [x["image_path"] for x in batch]
@@ -57,7 +109,7 @@ def build_trocr_collate(processor, max_target_length: int):
             texts,
             padding=True,
             truncation=True,
-            max_length=int(max_target_length),
+            max_length=self.max_target_length,
             return_tensors="pt",
         )
         labels = tokenized.input_ids.clone()
@@ -68,6 +120,15 @@ def build_trocr_collate(processor, max_target_length: int):
             "labels": labels,
             "texts": texts,
             "image_paths": image_paths,
+            BATCH_STATS_KEY: batch_stats(
+                real_pixels=0,
+                padded_pixels=0,
+                samples=len(batch),
+                collate_s=time.perf_counter() - t0,
+                load_s=sum(float(x.get("load_s", 0.0)) for x in batch),
+            ),
         }
 
-    return _collate
\ No newline at end of file
+
+def build_trocr_collate(processor, max_target_length: int) -> TrOCRCollator:
+    return TrOCRCollator(processor=processor, max_target_length=max_target_length)
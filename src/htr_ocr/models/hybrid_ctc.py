@@ -1,20 +1,12 @@
 from __future__ import annotations
 
-import math
 from typing import Optional
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-
-def sinusoidal_positional_encoding_1d(length: int, dim: int, device: torch.device) -> torch.Tensor:
-    pe = torch.zeros(length, dim, device=device)
-    position = torch.arange(0, length, device=device, dtype=torch.float32).unsqueeze(1)
-    div_term = torch.exp(torch.arange(0, dim, 2, device=device, dtype=torch.float32) * (-math.log(10000.0) / dim))
-    pe[:, 0::2] = torch.sin(position * div_term)
-    pe[:, 1::2] = torch.cos(position * div_term)
-    return pe.unsqueeze(0)  # [1, T, D]
+from htr_ocr.models.positional import SinusoidalPositionalEncoding
 
 
 class ConvFeatureExtractor(nn.Module):
@@ -117,10 +109,13 @@ class HybridCTC(nn.Module):
             batch_first=True,
             norm_first=True,
         )
+        # с norm_first nested tensor недоступен; в eval без градиентов слои и так идут fused fast path
         self.transformer = nn.TransformerEncoder(
             encoder_layer=enc_layer,
             num_layers=int(transformer_layers),
+            enable_nested_tensor=False,
         )
+        self.pos_enc = SinusoidalPositionalEncoding(int(transformer_dim))
 
         self.dropout = nn.Dropout(float(dropout))
         self.head = nn.Linear(int(transformer_dim), self.vocab_size)
@@ -144,8 +139,7 @@ class HybridCTC(nn.Module):
 
         bsz, seq_len, dim = feat.shape
 
-        pos = sinusoidal_positional_encoding_1d(seq_len, dim, feat.device)
-        feat = feat + pos
+        feat = feat + self.pos_enc(seq_len)
         feat = self.dropout(feat)
 
         key_padding_mask = None
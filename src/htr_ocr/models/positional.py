@@ -0,0 +1,32 @@
+import math
+
+import torch
+import torch.nn as nn
+
+
+def sinusoidal_positional_encoding_1d(length: int, dim: int, device: torch.device) -> torch.Tensor:
+    pe = torch.zeros(length, dim, device=device)
+    position = torch.arange(0, length, device=device, dtype=torch.float32).unsqueeze(1)
+    div_term = torch.exp(torch.arange(0, dim, 2, device=device, dtype=torch.float32) * (-math.log(10000.0) / dim))
+    pe[:, 0::2] = torch.sin(position * div_term)
+    pe[:, 1::2] = torch.cos(position * div_term)
+    return pe.unsqueeze(0)  # [1, T, D]
+
+
+class SinusoidalPositionalEncoding(nn.Module):
+    """
+    sinusoidal_positional_encoding_1d с кэшем: таблица [1, L, D] хранится в буфере
+    и пересчитывается (с запасом x2) только когда приходит последовательность длиннее L.
+    Буфер не persistent — в state_dict не попадает, старые чекпоинты грузятся как есть.
+    """
+
+    def __init__(self, dim: int) -> None:
+        super().__init__()
+        self.dim = int(dim)
+        self.register_buffer("pe", torch.zeros(1, 0, self.dim), persistent=False)
+
+    def forward(self, length: int) -> torch.Tensor:
+        length = int(length)
+        if length > self.pe.shape[1]:
+            self.pe = sinusoidal_positional_encoding_1d(max(length, 2 * self.pe.shape[1]), self.dim, self.pe.device)
+        return self.pe[:, :length]
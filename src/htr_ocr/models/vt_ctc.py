@@ -1,4 +1,3 @@
-import math
 from dataclasses import dataclass
 from typing import Optional
 
@@ -7,18 +6,10 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.models import ResNet18_Weights, resnet18
 
+from htr_ocr.models.positional import SinusoidalPositionalEncoding
 from htr_ocr.regularization.span_mask import sample_span_mask
 
 
-def sinusoidal_positional_encoding_1d(length: int, dim: int, device: torch.device) -> torch.Tensor:
-    pe = torch.zeros(length, dim, device=device)
-    position = torch.arange(0, length, device=device, dtype=torch.float32).unsqueeze(1)
-    div_term = torch.exp(torch.arange(0, dim, 2, device=device, dtype=torch.float32) * (-math.log(10000.0) / dim))
-    pe[:, 0::2] = torch.sin(position * div_term)
-    pe[:, 1::2] = torch.cos(position * div_term)
-    return pe.unsqueeze(0)
-
-
 class ResNet18LineExtractor(nn.Module):
     def __init__(self, pretrained: bool = False) -> None:
         super().__init__()
@@ -43,6 +34,28 @@ class ResNet18LineExtractor(nn.Module):
 
         # убираем последний блок
 
+    @torch.no_grad()
+    def fold_grayscale_stem(self) -> None:
+        """
+        conv1 по трём одинаковым каналам == conv по одному каналу с суммой весов по каналам:
+        серый вход идёт в stem без x.repeat (в 3 раза меньше памяти и FLOPs у conv1).
+        """
+        conv = self.stem[0]
+        if conv.in_channels == 1:
+            return
+        gray = nn.Conv2d(
+            1,
+            conv.out_channels,
+            kernel_size=conv.kernel_size,
+            stride=conv.stride,
+            padding=conv.padding,
+            bias=conv.bias is not None,
+        ).to(device=conv.weight.device, dtype=conv.weight.dtype)
+        gray.weight.copy_(conv.weight.sum(dim=1, keepdim=True))
+        if conv.bias is not None:
+            gray.bias.copy_(conv.bias)
+        self.stem[0] = gray
+
     @staticmethod
     def _set_block_stride_hw(block: nn.Module, stride_h: int, stride_w: int) -> None:
         if hasattr(block, "conv1"):
@@ -52,7 +65,7 @@ class ResNet18LineExtractor(nn.Module):
                 block.downsample[0].stride = (stride_h, stride_w)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:  # x: [B,1,H,W] а реснет хочкт 3 канала, повторяем
-        if x.shape[1] == 1:
+        if x.shape[1] == 1 and self.stem[0].in_channels == 3:
             x = x.repeat(1, 3, 1, 1)
 
         x = self.stem(x)    # /4,/4
@@ -107,7 +120,9 @@ class HTRVTCTC(nn.Module):
             batch_first=True,
             norm_first=True,
         )
-        self.encoder = nn.TransformerEncoder(enc_layer, num_layers=int(n_layers))
+        # с norm_first nested tensor недоступен; в eval без градиентов слои и так идут fused fast path
+        self.encoder = nn.TransformerEncoder(enc_layer, num_layers=int(n_layers), enable_nested_tensor=False)
+        self.pos_enc = SinusoidalPositionalEncoding(self.embed_dim)
 
         self.head = nn.Linear(self.embed_dim, self.vocab_size)
 
@@ -118,6 +133,17 @@ class HTRVTCTC(nn.Module):
 
         # ширина уменьшится примерно в 4 раза (conv1+maxpool)
         self.time_downsample_factor = 4
+        # conv1 и maxpool с паддингом: хвост ширины даёт лишний кадр, T = ceil(width / 4)
+        self.frames_round_up = True
+
+    def optimize_for_inference(self) -> "HTRVTCTC":
+        """
+        Сборка для инференса: eval() и одноканальный conv1 (fold_grayscale_stem).
+        Форма весов conv1 меняется — такую модель не сохранять как обучаемый чекпоинт.
+        """
+        self.eval()
+        self.extractor.fold_grayscale_stem()
+        return self
 
     @torch.no_grad()
     def token_lengths_from_widths(self, widths: list[int] | torch.Tensor) -> torch.Tensor:
@@ -146,9 +172,8 @@ class HTRVTCTC(nn.Module):
         else:
             key_padding_mask = None
 
-        # positional encoding
-        pos = sinusoidal_positional_encoding_1d(T, D, feat.device)
-        feat = feat + pos
+        # positional encoding (кэш, пересчёт только для более длинных строк)
+        feat = feat + self.pos_enc(T)
 
         # span mask (только на трейне)
         if self.training and self.span_mask.enabled and token_lengths is not None:
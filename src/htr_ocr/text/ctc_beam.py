@@ -0,0 +1,270 @@
+import atexit
+import math
+import multiprocessing as mp
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Any
+
+import numpy as np
+
+
+def log_threshold(p: float | None) -> float | None:
+    """Порог вероятности -> порог log p (None или p <= 0 — без отсечения)."""
+    if p is None or float(p) <= 0:
+        return None
+    return math.log(float(p))
+
+
+def prefix_beam_search_batch(
+    lp: np.ndarray,
+    lengths: np.ndarray,
+    blank: int,
+    beam_width: int,
+    topk: int,
+    blank_skip_logp: float | None = None,
+    prune_logp: float | None = None,
+) -> list[list[int]]:
+    """
+    Prefix beam search сразу по всему батчу, lp: [T, B, C] float64 (log-softmax), lengths: [B].
+
+    Состояние — плотные массивы [B, beam_width] (узел префикса, последний символ, p_blank, p_nonblank),
+    пустые слоты — -inf. Префиксы — узлы общего дерева (parent, char); у каждой строки префиксов
+    один канонический узел: (родитель, символ) интернируются, поэтому префикс, выпавший из луча
+    и собранный заново, получает тот же узел и сливается с уже живыми продлениями.
+    На кадр: top-k символов всех кадров считается заранее одним argpartition, переходы (бланк, повтор,
+    продление) и слияние продлений с уже существующими префиксами — операции над массивами,
+    отбор beam_width лучей — argpartition по строкам, без полной сортировки.
+
+    blank_skip_logp: кадр, где log p(blank) >= порога, считается чистым бланком: у строки обновляется
+    только p_blank (p_b = p_total + log p(blank), p_nb = -inf), без продлений, слияния и отбора.
+    prune_logp: символы с log p < порога на кадре не рассматриваются (лучший символ кадра остаётся всегда).
+    Кадры после lengths[b] не декодируются. Без порогов результат совпадает с полным перебором top-k.
+    """
+    T, B, C = lp.shape
+    k = max(1, min(int(topk), int(C)))
+    width = max(1, int(beam_width))
+    neg_inf = -np.inf
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), T)
+
+    # кандидаты всех кадров: top-k [T, B, k] и их log p (бланк и отсечённые символы -> -inf)
+    if k < C:
+        top = np.argpartition(lp, C - k, axis=-1)[..., C - k :]
+    else:
+        top = np.broadcast_to(np.arange(C), (T, B, C))
+    top_lp = np.take_along_axis(lp, top, axis=-1)
+    valid = np.ones(top.shape, dtype=bool)
+    if prune_logp is not None:
+        valid = top_lp >= prune_logp
+        np.put_along_axis(valid, top_lp.argmax(axis=-1)[..., None], True, axis=-1)
+    is_blank = top == blank
+    blank_lp = np.where(is_blank.any(axis=-1), lp[..., blank], neg_inf)  # [T, B]
+    char_lp = np.where(valid & ~is_blank, top_lp, neg_inf)  # [T, B, k]
+    pure_blank = None if blank_skip_logp is None else lp[..., blank] >= blank_skip_logp  # [T, B]
+
+    # дерево префиксов, общее для батча: узлы 0..B-1 — пустые префиксы строк
+    parent = np.full((B * (width + 1),), -1, dtype=np.int64)
+    char = np.full_like(parent, -1)
+    n_nodes = B
+    # (родитель * C + символ) -> канонический узел; родитель задаёт и строку батча
+    children: dict[int, int] = {}
+
+    node = np.full((B, width), -1, dtype=np.int64)
+    node[:, 0] = np.arange(B)
+    last = np.full((B, width), -1, dtype=np.int64)
+    p_b = np.full((B, width), neg_inf)
+    p_b[:, 0] = 0.0
+    p_nb = np.full((B, width), neg_inf)
+
+    for t in range(int(lengths.max(initial=0))):
+        active = t < lengths  # [B]
+        if pure_blank is not None:
+            skip = active & pure_blank[t]
+            if skip.any():
+                # чистый бланк: префиксы не меняются, вся масса уходит в p_blank
+                s = np.flatnonzero(skip)
+                p_b[s] = np.logaddexp(p_b[s], p_nb[s]) + lp[t, s, blank][:, None]
+                p_nb[s] = neg_inf
+                active &= ~skip
+        full = np.flatnonzero(active)
+        if full.size == 0:
+            continue
+        # полный шаг — только для строк, которым он нужен (без копий, если это весь батч)
+        sub = slice(None) if full.size == B else full
+        n_rows = int(full.size)
+        rows = np.arange(n_rows)[:, None]
+        cur_node, cur_last, cur_b, cur_nb = node[sub], last[sub], p_b[sub], p_nb[sub]
+        top_t = top[t, sub]  # [b, k]
+
+        p_total = np.logaddexp(cur_b, cur_nb)
+        ch = top_t[:, None, :]  # [b, 1, k]
+        cv = char_lp[t, sub][:, None, :]
+
+        new_b = p_total + blank_lp[t, sub][:, None]
+        # повтор последнего символа без бланка между — тот же префикс
+        same = ch == cur_last[..., None]  # [b, W, k]
+        new_nb = cur_nb + np.where(same, cv, neg_inf).max(axis=-1)
+        # продления; тот же символ после себя — только из p_blank
+        ext = np.where(same, cur_b[..., None], p_total[..., None]) + cv
+
+        # продление может совпасть с префиксом другого луча той же строки: ключ (родитель, символ)
+        par = np.where(cur_node >= 0, parent[np.maximum(cur_node, 0)], -1)
+        beam_key = np.where(par >= 0, par * C + cur_last, -1).ravel()
+        ext_key = cur_node[..., None] * C + ch
+        order = np.argsort(beam_key)
+        sorted_key = beam_key[order]
+        pos = np.minimum(np.searchsorted(sorted_key, ext_key), sorted_key.size - 1)
+        hit = (sorted_key[pos] == ext_key) & (ext > neg_inf)
+        if hit.any():
+            j = order[pos[hit]]
+            flat_nb = new_nb.reshape(-1)
+            flat_nb[j] = np.logaddexp(flat_nb[j], ext[hit])
+            ext = np.where(hit, neg_inf, ext)
+
+        # отбор: [старые лучи | продления] -> beam_width лучших в каждой строке
+        pool = np.concatenate([np.logaddexp(new_b, new_nb), ext.reshape(n_rows, width * k)], axis=1)
+        sel = np.argpartition(pool, pool.shape[1] - width, axis=1)[:, pool.shape[1] - width :]
+        total = np.take_along_axis(pool, sel, axis=1)
+        alive = total > neg_inf
+        is_old = sel < width
+        src_w = np.where(is_old, sel, (sel - width) // k)
+        src_c = np.where(is_old, 0, (sel - width) % k)
+        fresh = ~is_old & alive
+
+        new_ids = np.zeros_like(sel)
+        new_char = top_t[rows, src_c]
+        n_new = int(fresh.sum())
+        if n_new:
+            if n_nodes + n_new > parent.size:
+                grow = max(parent.size, n_new)
+                parent = np.concatenate([parent, np.full((grow,), -1, dtype=np.int64)])
+                char = np.concatenate([char, np.full((grow,), -1, dtype=np.int64)])
+            fresh_par = cur_node[rows, src_w][fresh]
+            fresh_char = new_char[fresh]
+            cand = np.arange(n_nodes, n_nodes + n_new)
+            parent[cand] = fresh_par
+            char[cand] = fresh_char
+            n_nodes += n_new
+            # префикс, уже бывший в дереве, получает свой прежний узел (новый слот остаётся пустым)
+            keys = (fresh_par * C + fresh_char).tolist()
+            new_ids[fresh] = np.fromiter(
+                (children.setdefault(key, c) for key, c in zip(keys, cand.tolist())),
+                dtype=np.int64,
+                count=n_new,
+            )
+
+        kept = is_old & alive
+        node[sub] = np.where(fresh, new_ids, np.where(kept, cur_node[rows, src_w], -1))
+        last[sub] = np.where(fresh, new_char, np.where(kept, cur_last[rows, src_w], -1))
+        p_b[sub] = np.where(kept, new_b[rows, src_w], neg_inf)
+        p_nb[sub] = np.where(kept, new_nb[rows, src_w], np.where(fresh, total, neg_inf))
+
+    best = node[np.arange(B), np.argmax(np.logaddexp(p_b, p_nb), axis=1)]
+    out: list[list[int]] = []
+    for n in best.tolist():
+        ids: list[int] = []
+        while n >= 0 and parent[n] >= 0:
+            ids.append(int(char[n]))
+            n = int(parent[n])
+        out.append(ids[::-1])
+    return out
+
+
+# рабочие процессы BeamSearchPool: открытый блок shared memory (по имени) на процесс
+_worker_shm: shared_memory.SharedMemory | None = None
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    global _worker_shm
+    if _worker_shm is None or _worker_shm.name != name:
+        if _worker_shm is not None:
+            _worker_shm.close()
+        _worker_shm = shared_memory.SharedMemory(name=name)
+    return _worker_shm
+
+
+def _decode_shard(
+    name: str,
+    shape: tuple[int, int, int],
+    lo: int,
+    hi: int,
+    lengths: np.ndarray,
+    options: dict[str, Any],
+) -> list[list[int]]:
+    lp = np.ndarray(shape, dtype=np.float64, buffer=_attach(name).buf)
+    return prefix_beam_search_batch(lp[:, lo:hi], lengths, **options)
+
+
+class BeamSearchPool:
+    """
+    Постоянный пул процессов для prefix_beam_search_batch: батч [T, B, C] делится на
+    num_workers непрерывных кусков по B, каждый процесс декодирует свой кусок.
+
+    Log-probs не пиклятся: они копируются (сразу в float64) в блок shared memory,
+    процессы читают его по имени; блок переиспользуется между вызовами и растёт по необходимости.
+    Результаты собираются в порядке батча. Процессы стартуют через spawn
+    (в основном процессе работают потоки BatchPrefetcher и CUDA, fork небезопасен).
+    """
+
+    def __init__(self, num_workers: int) -> None:
+        self.num_workers = max(1, int(num_workers))
+        self._pool: ProcessPoolExecutor | None = None
+        self._shm: shared_memory.SharedMemory | None = None
+        self._lock = threading.Lock()
+
+    def _buffer(self, nbytes: int) -> shared_memory.SharedMemory:
+        if self._shm is None or self._shm.size < nbytes:
+            self._release_shm()
+            self._shm = shared_memory.SharedMemory(create=True, size=max(int(nbytes), 1))
+        return self._shm
+
+    def decode(self, lp: np.ndarray, lengths: np.ndarray, **options: Any) -> list[list[int]]:
+        """lp: [T, B, C] (любой float), lengths: [B]; options — аргументы prefix_beam_search_batch."""
+        T, B, C = lp.shape
+        lengths = np.asarray(lengths, dtype=np.int64)
+        n_shards = min(self.num_workers, int(B))
+        if n_shards <= 1:
+            return prefix_beam_search_batch(np.asarray(lp, dtype=np.float64), lengths, **options)
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=mp.get_context("spawn"))
+            shm = self._buffer(int(T) * int(B) * int(C) * 8)
+            np.ndarray((T, B, C), dtype=np.float64, buffer=shm.buf)[...] = lp
+            bounds = np.linspace(0, int(B), n_shards + 1).astype(int).tolist()
+            futures = [
+                self._pool.submit(_decode_shard, shm.name, (T, B, C), lo, hi, lengths[lo:hi], options)
+                for lo, hi in zip(bounds[:-1], bounds[1:])
+            ]
+            return [ids for f in futures for ids in f.result()]
+
+    def _release_shm(self) -> None:
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def close(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._pool = None
+            self._release_shm()
+
+
+_pools: dict[int, BeamSearchPool] = {}
+
+
+def beam_search_pool(num_workers: int) -> BeamSearchPool:
+    """Общий на процесс BeamSearchPool с num_workers процессами (закрывается при выходе)."""
+    n = int(num_workers)
+    if n not in _pools:
+        _pools[n] = BeamSearchPool(n)
+    return _pools[n]
+
+
+@atexit.register
+def _close_pools() -> None:
+    for pool in _pools.values():
+        pool.close()
+    _pools.clear()
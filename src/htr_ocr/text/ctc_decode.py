@@ -1,43 +1,45 @@
-import math
-from dataclasses import dataclass
-from typing import Iterable
-
+import numpy as np
 import torch
 
+from htr_ocr.text.ctc_beam import beam_search_pool, log_threshold, prefix_beam_search_batch
 from htr_ocr.text.ctc_tokenizer import CTCTokenizer
 
 
-def _log_add_exp(a: float, b: float) -> float:
-    if a == -math.inf:
-        return b
-    if b == -math.inf:
-        return a
-    if a > b:
-        return a + math.log1p(math.exp(b - a))
-    return b + math.log1p(math.exp(a - b))
-
-
-def ctc_greedy_decode_batch(log_probs: torch.Tensor, tokenizer: CTCTokenizer) -> list[str]:
-    """log_probs: [T, B, C]"""
+def ctc_greedy_decode_ids(
+    log_probs: torch.Tensor,
+    lengths: torch.Tensor | None = None,
+    blank: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    log_probs: [T, B, C], lengths: [B] (кадры после lengths[b] — паддинг, не декодируются).
+
+    Схлопывание повторов и удаление бланков — маской на устройстве того же log_probs,
+    на хост уходят только оставшиеся id: (ids [sum(L)], lengths [B]), как у encode_batch.
+    """
     with torch.no_grad():
-        ids = log_probs.argmax(dim=-1)  # [T, B]
-        ids = ids.cpu().numpy()
+        ids = log_probs.argmax(dim=-1).t()  # [B, T]
+        keep = ids != blank
+        keep[:, 1:] &= ids[:, 1:] != ids[:, :-1]
+        if lengths is not None:
+            t = torch.arange(ids.shape[1], device=ids.device)
+            keep &= t[None, :] < lengths.to(ids.device)[:, None]
+        counts = keep.sum(dim=1)
+        flat = ids[keep]  # построчно, т.е. по порядку батча
+    return flat.cpu().numpy(), counts.cpu().numpy()
+
+
+def ctc_greedy_decode_batch(
+    log_probs: torch.Tensor,
+    tokenizer: CTCTokenizer,
+    lengths: torch.Tensor | None = None,
+) -> list[str]:
+    """log_probs: [T, B, C], lengths: [B] длины выхода энкодера (None — все T кадров)"""
+    ids, counts = ctc_greedy_decode_ids(log_probs, lengths, blank=tokenizer.blank_id)
+    return tokenizer.decode_flat(ids, counts)
+
 
-    preds: list[str] = []
-    blank = tokenizer.blank_id
-    for b in range(ids.shape[1]):
-        seq = ids[:, b].tolist()
-        collapsed: list[int] = []
-        prev = None
-        for i in seq:
-            if i == prev:
-                continue
-            prev = i
-            if i == blank:
-                continue
-            collapsed.append(i)
-        preds.append(tokenizer.decode_greedy(collapsed))
-    return preds
+def _as_float64(log_probs: torch.Tensor) -> np.ndarray:
+    return log_probs.detach().to("cpu", torch.float64).numpy()
 
 
 def ctc_beam_search_decode(
@@ -46,60 +48,22 @@ def ctc_beam_search_decode(
     *,
     beam_width: int = 50,
     topk: int = 20,
+    blank_skip: float | None = None,
+    prune: float | None = None,
 ) -> str:
-    """log_probs_tc: [T, C]"""
-
-    blank = tokenizer.blank_id
-
-    beams: dict[tuple[int, ...], tuple[float, float]] = {(): (0.0, -math.inf)}
-
-    T, C = log_probs_tc.shape
-    k = max(1, min(int(topk), int(C)))
-
-    for t in range(int(T)):
-        lp = log_probs_tc[t]  # [C]
-        vals, idxs = torch.topk(lp, k=k)
-
-        next_beams: dict[tuple[int, ...], tuple[float, float]] = {}
-
-        for prefix, (p_b, p_nb) in beams.items():
-            p_total = _log_add_exp(p_b, p_nb)
-
-            for logp, c in zip(vals.tolist(), idxs.tolist(), strict=False):
-                c = int(c)
-
-                if c == blank:
-                    nb = next_beams.get(prefix, (-math.inf, -math.inf))
-                    new_p_b = _log_add_exp(nb[0], p_total + logp)
-                    next_beams[prefix] = (new_p_b, nb[1])
-                    continue
-
-                end = prefix[-1] if prefix else None
-                new_prefix = prefix + (c,)
-
-                if end == c:
-                    nb_new = next_beams.get(new_prefix, (-math.inf, -math.inf))
-                    new_p_nb = _log_add_exp(nb_new[1], p_b + logp)
-                    next_beams[new_prefix] = (nb_new[0], new_p_nb)
-
-                    nb_same = next_beams.get(prefix, (-math.inf, -math.inf))
-                    new_p_nb_same = _log_add_exp(nb_same[1], p_nb + logp)
-                    next_beams[prefix] = (nb_same[0], new_p_nb_same)
-                else:
-                    nb_new = next_beams.get(new_prefix, (-math.inf, -math.inf))
-                    new_p_nb = _log_add_exp(nb_new[1], p_total + logp)
-                    next_beams[new_prefix] = (nb_new[0], new_p_nb)
-
-        beams = dict(
-            sorted(
-                next_beams.items(),
-                key=lambda kv: _log_add_exp(kv[1][0], kv[1][1]),
-                reverse=True,
-            )[: max(1, int(beam_width))]
-        )
-
-    best_prefix = max(beams.items(), key=lambda kv: _log_add_exp(kv[1][0], kv[1][1]))[0]
-    return tokenizer.decode_greedy(list(best_prefix))
+    """
+    log_probs_tc: [T, C]
+    blank_skip: p(blank) на кадре, выше которой кадр считается чистым бланком (например 0.999);
+    prune: символы с p ниже порога на кадре не продлевают лучи. None — без отсечений.
+    """
+    return ctc_beam_search_batch(
+        log_probs_tc[:, None, :],
+        tokenizer,
+        beam_width=beam_width,
+        topk=topk,
+        blank_skip=blank_skip,
+        prune=prune,
+    )[0]
 
 
 def ctc_beam_search_batch(
@@ -108,17 +72,41 @@ def ctc_beam_search_batch(
     *,
     beam_width: int = 50,
     topk: int = 20,
+    lengths: torch.Tensor | None = None,
+    blank_skip: float | None = None,
+    prune: float | None = None,
+    num_workers: int = 0,
 ) -> list[str]:
-    """log_probs: [T, B, C]"""
+    """
+    log_probs: [T, B, C], lengths: [B] длины выхода энкодера (None — все T кадров)
+    num_workers > 1: строки батча декодируются параллельно в BeamSearchPool (порядок сохраняется).
+    """
     T, B, C = log_probs.shape
-    preds: list[str] = []
-    for b in range(int(B)):
-        preds.append(
-            ctc_beam_search_decode(
-                log_probs[:, b, :],
-                tokenizer,
-                beam_width=beam_width,
-                topk=topk,
-            )
-        )
-    return preds
\ No newline at end of file
+    lens = np.full((int(B),), int(T)) if lengths is None else lengths.detach().cpu().numpy()
+    options = {
+        "blank": tokenizer.blank_id,
+        "beam_width": beam_width,
+        "topk": topk,
+        "blank_skip_logp": log_threshold(blank_skip),
+        "prune_logp": log_threshold(prune),
+    }
+    # один перенос на хост (bf16 / fp16 из autocast сразу в float64), в процессы пула — через shared memory
+    lp = _as_float64(log_probs)
+    if int(num_workers) > 1 and int(B) > 1:
+        ids = beam_search_pool(num_workers).decode(lp, lens, **options)
+    else:
+        ids = prefix_beam_search_batch(lp, lens, **options)
+    return tokenizer.decode_batch(ids)
+
+
+def beam_search_options(decode_cfg) -> dict:
+    """Аргументы ctc_beam_search_batch из конфига decode: beam_width, topk, blank_skip, prune, num_workers."""
+    blank_skip = getattr(decode_cfg, "blank_skip", None)
+    prune = getattr(decode_cfg, "prune", None)
+    return {
+        "beam_width": int(getattr(decode_cfg, "beam_width", 50)),
+        "topk": int(getattr(decode_cfg, "topk", 20)),
+        "blank_skip": None if blank_skip is None else float(blank_skip),
+        "prune": None if prune is None else float(prune),
+        "num_workers": int(getattr(decode_cfg, "num_workers", 0)),
+    }
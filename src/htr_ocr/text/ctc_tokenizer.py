@@ -1,9 +1,11 @@
 import json
+import numpy as np
 import pandas as pd
 
 from dataclasses import dataclass
+from functools import cached_property
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Sequence
 
 
 @dataclass(frozen=True)
@@ -18,11 +20,28 @@ class CTCTokenizer:
     def vocab_size(self) -> int:
         return 1 + len(self.id2char)
 
-    def char2id(self) -> dict[str, int]:
+    # таблицы считаются один раз на экземпляр (cached_property пишет в __dict__ в обход frozen)
+    @cached_property
+    def _char2id(self) -> dict[str, int]:
         return {ch: i + 1 for i, ch in enumerate(self.id2char)}
 
+    @cached_property
+    def _code_table(self) -> tuple[np.ndarray, np.ndarray]:
+        """Отсортированные code point символов словаря и их id (для searchsorted)."""
+        codes = np.array([ord(ch) for ch in self.id2char], dtype=np.uint32)
+        order = np.argsort(codes, kind="stable")
+        return codes[order], (order + 1).astype(np.int32)
+
+    @cached_property
+    def _id_chars(self) -> np.ndarray:
+        # id -> символ; бланк и id вне словаря дают пустую строку
+        return np.array(["", *self.id2char, ""], dtype=object)
+
+    def char2id(self) -> dict[str, int]:
+        return self._char2id
+
     def encode(self, text: str) -> list[int]:
-        m = self.char2id()
+        m = self._char2id
         ids: list[int] = []
         for ch in text:
             if ch in m:
@@ -31,15 +50,48 @@ class CTCTokenizer:
                 raise ValueError(f"Unknown character {ch!r}")
         return ids
 
+    def encode_batch(self, texts: Sequence[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Все тексты сразу, без цикла по символам: (ids int32 [sum(L)], lengths int32 [B]).
+        ids[offsets[i]:offsets[i + 1]] — текст i, offsets = [0, *cumsum(lengths)].
+        """
+        lengths = np.fromiter((len(t) for t in texts), dtype=np.int32, count=len(texts))
+        cps = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+        codes, ids = self._code_table
+        if cps.size == 0:
+            return np.zeros((0,), dtype=np.int32), lengths
+        pos = np.minimum(np.searchsorted(codes, cps), max(0, len(codes) - 1))
+        known = codes[pos] == cps if len(codes) else np.zeros(cps.shape, dtype=bool)
+        if not known.all():
+            bad = int(np.flatnonzero(~known)[0])
+            text_idx = int(np.searchsorted(np.cumsum(lengths), bad, side="right"))
+            raise ValueError(f"Unknown character {chr(int(cps[bad]))!r} in text #{text_idx}: {texts[text_idx]!r}")
+        return ids[pos], lengths
+
     def decode_greedy(self, ids: Iterable[int]) -> str:
+        arr = np.fromiter((int(i) for i in ids), dtype=np.int64)
+        return "".join(self._id_chars[np.clip(arr, 0, len(self._id_chars) - 1)].tolist())
+
+    def decode_batch(self, seqs: Iterable[Iterable[int]]) -> list[str]:
+        """
+        decode_greedy для каждой последовательности (бланки и неизвестные id пропускаются):
+        последовательности склеиваются один раз, символы — один lookup через decode_flat.
+        """
+        seqs = [list(seq) for seq in seqs]
+        lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+        ids = np.fromiter((int(i) for seq in seqs for i in seq), dtype=np.int64, count=int(lengths.sum()))
+        return self.decode_flat(ids, lengths)
+
+    def decode_flat(self, ids: np.ndarray, lengths: np.ndarray) -> list[str]:
+        """Обратное к encode_batch: склеенные ids и длины -> строки (один lookup на весь батч)."""
+        table = self._id_chars
+        chars = table[np.clip(np.asarray(ids, dtype=np.int64), 0, len(table) - 1)].tolist()
         out: list[str] = []
-        for i in ids:
-            if i == self.blank_id:
-                continue
-            j = int(i) - 1
-            if 0 <= j < len(self.id2char):
-                out.append(self.id2char[j])
-        return "".join(out)
+        start = 0
+        for n in np.asarray(lengths, dtype=np.int64).tolist():
+            out.append("".join(chars[start : start + n]))
+            start += n
+        return out
 
     def save(self, path: str | Path) -> None:
         path = Path(path)
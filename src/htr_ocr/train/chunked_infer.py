@@ -0,0 +1,90 @@
+from typing import Any
+
+import torch
+import torch.nn.functional as F
+
+
+def _forward(model: torch.nn.Module, x: torch.Tensor, widths: list[int]) -> torch.Tensor:
+    # HybridCTC / HTRVTCTC маскируют паддинг внимания по token_lengths, CRNNCTC — нет
+    if hasattr(model, "token_lengths_from_widths"):
+        token_lengths = model.token_lengths_from_widths(widths).to(x.device)
+        return model(x, token_lengths=token_lengths)
+    return model(x)
+
+
+def _n_frames(model: torch.nn.Module, width: int) -> int:
+    # столько кадров, сколько даёт forward всей строки: свёртки HybridCTC / CRNNCTC отбрасывают хвост (floor),
+    # token_lengths_from_widths тут не годится — у HybridCTC он округляет вверх
+    ds = int(model.time_downsample_factor)
+    if bool(getattr(model, "frames_round_up", False)):
+        return -(-int(width) // ds)
+    return int(width) // ds
+
+
+@torch.no_grad()
+def chunked_log_probs(
+    model: torch.nn.Module,
+    x: torch.Tensor,
+    *,
+    window: int,
+    overlap: int,
+    batch_size: int = 8,
+    pad_value: float = 1.0,
+) -> torch.Tensor:
+    """
+    Log-probs [T, 1, V] строки x [1, 1, H, W] любой ширины окнами фиксированной ширины.
+
+    Окна шириной window пикселей идут с шагом window - overlap (кратны time_downsample_factor,
+    поэтому кадр окна — это кадр всей строки со сдвигом), последнее добивается pad_value.
+    Окна считаются батчами по batch_size, память на строку ограничена batch_size * window.
+    Склейка: кадры перекрытия делятся пополам — каждый берётся из окна, в котором он дальше от края
+    (меньше влияние обрезанного контекста). Строка не шире window — обычный forward.
+    """
+    if x.shape[0] != 1:
+        raise ValueError(f"chunked_log_probs expects one line, got batch of {x.shape[0]}")
+    ds = int(model.time_downsample_factor)
+    width = int(x.shape[-1])
+    window = max(ds, int(window) // ds * ds)
+    overlap = min(max(0, int(overlap) // ds * ds), window - ds)
+    if width <= window:
+        return _forward(model, x, [width])
+
+    stride = window - overlap
+    n_windows = -(-(width - window) // stride) + 1
+    starts = [i * stride for i in range(n_windows)]
+    x = F.pad(x, (0, starts[-1] + window - width), value=float(pad_value))
+
+    n_frames = _n_frames(model, width)
+    win_frames = window // ds
+    cut_left = (overlap // ds) // 2
+    cut_right = overlap // ds - cut_left
+
+    out: torch.Tensor | None = None
+    for lo in range(0, n_windows, max(1, int(batch_size))):
+        group = starts[lo : lo + max(1, int(batch_size))]
+        xb = torch.cat([x[..., s : s + window] for s in group], dim=0)  # [b, 1, H, window]
+        lp = _forward(model, xb, [min(window, width - s) for s in group])  # [win_frames, b, V]
+        if out is None:
+            out = lp.new_empty((n_frames, 1, int(lp.shape[-1])))
+        for j, s in enumerate(group):
+            i = lo + j
+            a = s // ds
+            f0 = 0 if i == 0 else cut_left
+            f1 = win_frames if i == n_windows - 1 else win_frames - cut_right
+            f1 = min(f1, int(lp.shape[0]), n_frames - a)
+            if f1 > f0:
+                out[a + f0 : a + f1, 0] = lp[f0:f1, j]
+    assert out is not None
+    return out
+
+
+def chunk_options(infer_cfg) -> dict[str, Any]:
+    """Аргументы infer_one из infer.chunk: chunk_width (0 — без окон), chunk_overlap, chunk_batch_size."""
+    chunk = getattr(infer_cfg, "chunk", None)
+    if chunk is None or not bool(getattr(chunk, "enabled", False)):
+        return {"chunk_width": 0}
+    return {
+        "chunk_width": int(getattr(chunk, "window", 1024)),
+        "chunk_overlap": int(getattr(chunk, "overlap", 128)),
+        "chunk_batch_size": int(getattr(chunk, "batch_size", 8)),
+    }
@@ -7,6 +7,7 @@ from htr_ocr.data.transforms import make_image_transform
 from htr_ocr.models.crnn_ctc import CRNNCTC
 from htr_ocr.text.ctc_decode import ctc_beam_search_batch, ctc_greedy_decode_batch
 from htr_ocr.text.ctc_tokenizer import CTCTokenizer
+from htr_ocr.train.chunked_infer import chunked_log_probs
 
 
 def load_checkpoint(checkpoint_path: str | Path, device: torch.device) -> tuple[CRNNCTC, CTCTokenizer]:
@@ -36,6 +37,9 @@ def infer_one(
     decode_method: str = "beam",
     beam_width: int = 50,
     topk: int = 20,
+    chunk_width: int = 0,
+    chunk_overlap: int = 128,
+    chunk_batch_size: int = 8,
 ) -> str:
     device = torch.device(device_str if torch.cuda.is_available() else "cpu")
     model, tok = load_checkpoint(checkpoint_path, device)
@@ -56,11 +60,27 @@ def infer_one(
     x = transform(img)  # [1, H, W] float in [0,1]
     x = x.unsqueeze(0).to(device)  # [B=1,1,H,W]
 
-    log_probs = model(x)  # [T,1,C]
+    if int(chunk_width) > 0:
+        # широкие строки — окнами, память не растёт с шириной
+        log_probs = chunked_log_probs(
+            model,
+            x,
+            window=int(chunk_width),
+            overlap=int(chunk_overlap),
+            batch_size=int(chunk_batch_size),
+            pad_value=float(pad_value) / 255.0,
+        )
+    else:
+        log_probs = model(x)  # [T,1,C]
 
     method = str(decode_method)
     if method == "beam":
-        pred = ctc_beam_search_batch(log_probs, tok, beam_width=int(beam_width), topk=int(topk))[0]
+        pred = ctc_beam_search_batch(
+            log_probs,
+            tok,
+            beam_width=int(beam_width),
+            topk=int(topk),
+        )[0]
     else:
         pred = ctc_greedy_decode_batch(log_probs, tok)[0]
 
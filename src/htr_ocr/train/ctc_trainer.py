@@ -1,5 +1,6 @@
 import math
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
 
 import pandas as pd
@@ -10,14 +11,16 @@ from tqdm import tqdm
 
 import mlflow
 
-from htr_ocr.data.collate import collate_line_batch
-from htr_ocr.data.dataset import IamLineDataset
-from htr_ocr.data.samplers import BucketBatchSampler
-from htr_ocr.data.transforms import make_image_transform
+from htr_ocr.data.batch_augment import make_batch_augment
+from htr_ocr.data.loader import make_line_dataloader
+from htr_ocr.data.prefetch import BatchPrefetcher, CTCBatchTargets, device_prefetch
 from htr_ocr.models.crnn_ctc import CRNNCTC
-from htr_ocr.text.ctc_decode import ctc_beam_search_batch, ctc_greedy_decode_batch
+from htr_ocr.text.ctc_decode import beam_search_options, ctc_beam_search_batch, ctc_greedy_decode_batch
 from htr_ocr.text.ctc_tokenizer import CTCTokenizer, build_or_load_vocab
-from htr_ocr.utils.metrics import AverageMeter, cer, wer
+from htr_ocr.utils.loader_stats import LoaderStats
+from htr_ocr.utils.eval_pipeline import AsyncEvalMetrics, metric_workers
+from htr_ocr.utils.metrics import AverageMeter
+from htr_ocr.utils.mlflow_utils import log_metrics
 from htr_ocr.utils.repro import seed_everything
 
 
@@ -28,86 +31,36 @@ class TrainResult:
     best_val_wer: float
 
 
-def _ctc_prepare_targets(tokenizer: CTCTokenizer, texts: list[str]) -> tuple[torch.Tensor, torch.Tensor]:
-    targets: list[int] = []
-    lengths: list[int] = []
-    for t in texts:
-        ids = tokenizer.encode(t)
-        targets.extend(ids)
-        lengths.append(len(ids))
-    return torch.tensor(targets, dtype=torch.long), torch.tensor(lengths, dtype=torch.long)
-
-
 def _input_lengths_from_widths(widths: list[int], downsample: int) -> torch.Tensor:
     lens = [max(1, int(w) // downsample) for w in widths]
     return torch.tensor(lens, dtype=torch.long)
 
 
-def _decode_batch(log_probs: torch.Tensor, tokenizer: CTCTokenizer, decode_cfg) -> list[str]:
+def _decode_batch(
+    log_probs: torch.Tensor,
+    tokenizer: CTCTokenizer,
+    decode_cfg,
+    lengths: torch.Tensor | None = None,
+) -> list[str]:
     method = str(getattr(decode_cfg, "method", "greedy"))
     if method == "beam":
         return ctc_beam_search_batch(
             log_probs,
             tokenizer,
-            beam_width=int(getattr(decode_cfg, "beam_width", 50)),
-            topk=int(getattr(decode_cfg, "topk", 20)),
+            lengths=lengths,
+            **beam_search_options(decode_cfg),
         )
-    return ctc_greedy_decode_batch(log_probs, tokenizer)
+    return ctc_greedy_decode_batch(log_probs, tokenizer, lengths=lengths)
 
 
 def make_dataloader(
     cfg,
     split_name: str,
+    tokenizer: CTCTokenizer | None = None,
 ) -> DataLoader:
-    processed_dir = Path(cfg.data.processed_dir)
-    csv_path = processed_dir / f"{split_name}.csv"
-    if not csv_path.exists():
-        raise FileNotFoundError(f"CSV not found: {csv_path}")
-    
-    is_train = split_name == "train"
-    transform = make_image_transform(
-        height=int(cfg.preprocess.height),
-        keep_aspect=bool(cfg.preprocess.keep_aspect),
-        tight_crop_enabled=bool(cfg.preprocess.tight_crop.enabled),
-        tight_crop_threshold=int(cfg.preprocess.tight_crop.threshold),
-        tight_crop_margin=int(cfg.preprocess.tight_crop.margin),
-        augment_cfg=getattr(cfg, "augment", None) if is_train else None,
-        is_train=is_train,
-        fill=int(cfg.preprocess.pad_value),
-        to_float_tensor=True,
-    )
-
-    ds = IamLineDataset(csv_path=csv_path, transform=transform, target_height=int(cfg.preprocess.height))
-
-    bucket_enabled = bool(getattr(cfg.loader.bucket, "enabled", False))
-    batch_size = int(cfg.loader.batch_size)
-
-    if bucket_enabled:
-        lengths = [ds.approx_resized_width(i) for i in range(len(ds))]
-        lengths_i = [int(v) for v in lengths if v is not None]
-        sampler = BucketBatchSampler(
-            lengths=lengths_i,
-            batch_size=batch_size,
-            shuffle_batches=bool(cfg.loader.shuffle),
-            seed=int(cfg.loader.bucket.seed),
-            drop_last=bool(cfg.loader.bucket.drop_last),
-        )
-        return DataLoader(
-            ds,
-            batch_sampler=sampler,
-            num_workers=int(cfg.loader.num_workers),
-            pin_memory=bool(cfg.loader.pin_memory),
-            collate_fn=lambda b: collate_line_batch(b, pad_value=float(cfg.preprocess.pad_value) / 255.0),
-        )
+    # валидация тоже по бакетам (при loader.bucket.enabled): меньше паддинга
+    return make_line_dataloader(cfg, split_name, eval_buckets=True, tokenizer=tokenizer)
 
-    return DataLoader(
-        ds,
-        batch_size=batch_size,
-        shuffle=bool(cfg.loader.shuffle),
-        num_workers=int(cfg.loader.num_workers),
-        pin_memory=bool(cfg.loader.pin_memory),
-        collate_fn=lambda b: collate_line_batch(b, pad_value=float(cfg.preprocess.pad_value) / 255.0),
-    )
 
 def evaluate(
     model: CRNNCTC,
@@ -116,36 +69,26 @@ def evaluate(
     device: torch.device,
     decode_cfg,
     blank_id: int = 0,
+    prefetch: int = 2,
+    metric_workers: int = 1,
 ) -> dict[str, float]:
     model.eval()
     ctc_loss = nn.CTCLoss(blank=blank_id, zero_infinity=True)
 
-    loss_m = AverageMeter()
-    cer_m = AverageMeter()
-    wer_m = AverageMeter()
-
-    for batch in tqdm(dl, desc="eval", leave=False):
-        x = batch["pixel_values"].to(device)
-        widths = batch["widths"]
-        texts = batch["texts"]
-
-        with torch.no_grad():
-            log_probs = model(x)  # [T,B,C]
-            input_lengths = _input_lengths_from_widths(widths, model.time_downsample_factor).to(device)
-            targets, target_lengths = _ctc_prepare_targets(tokenizer, texts)
-            targets = targets.to(device)
-            target_lengths = target_lengths.to(device)
-
-            loss = ctc_loss(log_probs, targets, input_lengths, target_lengths)
+    prep = CTCBatchTargets(tokenizer, partial(_input_lengths_from_widths, downsample=model.time_downsample_factor))
+    # декодирование, CER / WER и loss.item() — в фоне, пока идёт forward следующего батча
+    decode = partial(_decode_batch, tokenizer=tokenizer, decode_cfg=decode_cfg)
+    with AsyncEvalMetrics(decode, workers=metric_workers) as metrics:
+        for batch in tqdm(BatchPrefetcher(dl, device, prepare=prep, depth=prefetch), desc="eval", leave=False):
+            x = batch["pixel_values"]
 
-        preds = _decode_batch(log_probs, tokenizer, decode_cfg)
+            with torch.no_grad():
+                log_probs = model(x)  # [T,B,C]
+                loss = ctc_loss(log_probs, batch["targets"], batch["token_lengths"], batch["target_lengths"])
 
-        loss_m.update(float(loss.item()), n=len(texts))
-        for p, t in zip(preds, texts, strict=False):
-            cer_m.update(cer(p, t))
-            wer_m.update(wer(p, t))
+            metrics.submit(batch["texts"], loss, log_probs, lengths=batch["token_lengths"])
 
-    return {"loss": loss_m.avg, "cer": cer_m.avg, "wer": wer_m.avg}
+    return metrics.summary()
 
 
 def train_crnn_ctc(cfg) -> TrainResult:
@@ -155,8 +98,11 @@ def train_crnn_ctc(cfg) -> TrainResult:
 
     tokenizer = build_or_load_vocab(cfg)
 
-    train_dl = make_dataloader(cfg, "train")
-    val_dl = make_dataloader(cfg, "val")
+    train_dl = make_dataloader(cfg, "train", tokenizer)
+    device_aug = make_batch_augment(cfg)
+    if device_aug is not None and not device_aug.on_device:
+        device_aug = None
+    val_dl = make_dataloader(cfg, "val", tokenizer)
 
     model = CRNNCTC(
         num_classes=tokenizer.vocab_size,
@@ -188,24 +134,29 @@ def train_crnn_ctc(cfg) -> TrainResult:
 
     max_epochs = int(cfg.train.epochs)
 
+    loader_stats = LoaderStats()
+    # таргеты и перенос на устройство готовятся в фоне, пока идёт шаг
+    prefetch = device_prefetch(cfg)
+    prep = CTCBatchTargets(tokenizer, partial(_input_lengths_from_widths, downsample=model.time_downsample_factor))
+
     for epoch in range(1, max_epochs + 1):
+        if hasattr(train_dl.dataset, "set_epoch"):
+            train_dl.dataset.set_epoch(epoch)
+        if hasattr(train_dl.batch_sampler, "set_epoch"):
+            train_dl.batch_sampler.set_epoch(epoch)
         model.train()
         loss_m = AverageMeter()
 
-        pbar = tqdm(train_dl, desc=f"train epoch {epoch}", leave=False)
+        batches = BatchPrefetcher(train_dl, device, prepare=prep, depth=prefetch)
+        pbar = tqdm(loader_stats.track(batches), desc=f"train epoch {epoch}", leave=False)
         for batch in pbar:
-            x = batch["pixel_values"].to(device)
-            widths = batch["widths"]
+            if device_aug is not None:
+                batch = prep.refresh_token_lengths(device_aug(batch, device=device), device)
+            x = batch["pixel_values"]
             texts = batch["texts"]
 
             log_probs = model(x)  # [T,B,C]
-            input_lengths = _input_lengths_from_widths(widths, model.time_downsample_factor).to(device)
-
-            targets, target_lengths = _ctc_prepare_targets(tokenizer, texts)
-            targets = targets.to(device)
-            target_lengths = target_lengths.to(device)
-
-            loss = ctc_loss(log_probs, targets, input_lengths, target_lengths)
+            loss = ctc_loss(log_probs, batch["targets"], batch["token_lengths"], batch["target_lengths"])
 
             optimizer.zero_grad(set_to_none=True)
             loss.backward()
@@ -216,12 +167,23 @@ def train_crnn_ctc(cfg) -> TrainResult:
             loss_m.update(float(loss.item()), n=len(texts))
             pbar.set_postfix(loss=f"{loss_m.avg:.4f}")
 
-        val_metrics = evaluate(model, val_dl, tokenizer, device, decode_cfg=cfg.decode)
+        val_metrics = evaluate(
+            model,
+            val_dl,
+            tokenizer,
+            device,
+            decode_cfg=cfg.decode,
+            prefetch=prefetch,
+            metric_workers=metric_workers(cfg),
+        )
 
         mlflow.log_metric("train_loss", loss_m.avg, step=epoch)
+        log_metrics(loader_stats.summary(), step=epoch)
         mlflow.log_metric("val_loss", val_metrics["loss"], step=epoch)
         mlflow.log_metric("val_cer", val_metrics["cer"], step=epoch)
         mlflow.log_metric("val_wer", val_metrics["wer"], step=epoch)
+        mlflow.log_metric("val_cer_corpus", val_metrics["cer_corpus"], step=epoch)
+        mlflow.log_metric("val_wer_corpus", val_metrics["wer_corpus"], step=epoch)
 
         improved = val_metrics["cer"] < best_val_cer
         if improved:
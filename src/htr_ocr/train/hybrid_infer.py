@@ -8,6 +8,7 @@ from htr_ocr.data.transforms import make_image_transform
 from htr_ocr.models.hybrid_ctc import HybridCTC
 from htr_ocr.text.ctc_decode import ctc_beam_search_batch, ctc_greedy_decode_batch
 from htr_ocr.text.ctc_tokenizer import CTCTokenizer
+from htr_ocr.train.chunked_infer import chunked_log_probs
 
 
 def load_checkpoint(path: Path, device: torch.device) -> Tuple[HybridCTC, CTCTokenizer]:
@@ -52,6 +53,9 @@ def infer_one(
     decode_method: str = "beam",
     beam_width: int = 50,
     topk: int = 20,
+    chunk_width: int = 0,
+    chunk_overlap: int = 128,
+    chunk_batch_size: int = 8,
 ) -> str:
     device = torch.device(device_str if torch.cuda.is_available() else "cpu")
     model, tok = load_checkpoint(checkpoint_path, device)
@@ -71,10 +75,20 @@ def infer_one(
     img = Image.open(image_path).convert("L")
     x = tf(img).unsqueeze(0).to(device)
 
-    widths = torch.tensor([x.shape[-1]], dtype=torch.long, device=device)
-    token_lengths = model.token_lengths_from_widths(widths).to(device)
-
-    log_probs = model(x, token_lengths=token_lengths)
+    if int(chunk_width) > 0:
+        # широкие строки — окнами: внимание внутри окна, память не растёт с шириной
+        log_probs = chunked_log_probs(
+            model,
+            x,
+            window=int(chunk_width),
+            overlap=int(chunk_overlap),
+            batch_size=int(chunk_batch_size),
+            pad_value=float(pad_value) / 255.0,
+        )
+    else:
+        widths = torch.tensor([x.shape[-1]], dtype=torch.long, device=device)
+        token_lengths = model.token_lengths_from_widths(widths).to(device)
+        log_probs = model(x, token_lengths=token_lengths)
 
     method = str(decode_method).lower()
     if method == "greedy":
@@ -1,5 +1,6 @@
 import math
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
 
 import mlflow
@@ -11,15 +12,16 @@ from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from htr_ocr.data.collate import collate_line_batch
-from htr_ocr.data.dataset import IamLineDataset
-from htr_ocr.data.samplers import BucketBatchSampler
-from htr_ocr.data.transforms import make_image_transform
+from htr_ocr.data.batch_augment import make_batch_augment
+from htr_ocr.data.loader import make_line_dataloader
+from htr_ocr.data.prefetch import BatchPrefetcher, CTCBatchTargets, device_prefetch
 from htr_ocr.models.hybrid_ctc import HybridCTC
-from htr_ocr.text.ctc_decode import ctc_beam_search_batch, ctc_greedy_decode_batch
+from htr_ocr.text.ctc_decode import beam_search_options, ctc_beam_search_batch, ctc_greedy_decode_batch
 from htr_ocr.text.ctc_tokenizer import CTCTokenizer, build_or_load_vocab
 from htr_ocr.utils.io import ensure_dir
-from htr_ocr.utils.metrics import cer, wer
+from htr_ocr.utils.loader_stats import LoaderStats
+from htr_ocr.utils.eval_pipeline import AsyncEvalMetrics, metric_workers
+from htr_ocr.utils.mlflow_utils import log_metrics
 
 
 @dataclass
@@ -29,88 +31,30 @@ class TrainResult:
     best_val_wer: float
 
 
-def _ctc_prepare_targets(tokenizer: CTCTokenizer, texts: list[str]) -> tuple[torch.Tensor, torch.Tensor]:
-    ids = [torch.tensor(tokenizer.encode(t), dtype=torch.long) for t in texts]
-    lengths = torch.tensor([len(x) for x in ids], dtype=torch.long)
-    targets = torch.cat(ids, dim=0) if ids else torch.empty((0,), dtype=torch.long)
-    return targets, lengths
-
-
-def _decode_batch(log_probs: torch.Tensor, tokenizer: CTCTokenizer, decode_cfg) -> list[str]:
+def _decode_batch(
+    log_probs: torch.Tensor,
+    tokenizer: CTCTokenizer,
+    decode_cfg,
+    lengths: torch.Tensor | None = None,
+) -> list[str]:
     method = str(getattr(decode_cfg, "method", "greedy")).lower()
 
     if method == "greedy":
-        return ctc_greedy_decode_batch(log_probs, tokenizer)
+        return ctc_greedy_decode_batch(log_probs, tokenizer, lengths=lengths)
 
     if method == "beam":
         return ctc_beam_search_batch(
             log_probs,
             tokenizer,
-            beam_width=int(getattr(decode_cfg, "beam_width", 50)),
-            topk=int(getattr(decode_cfg, "topk", 20)),
+            lengths=lengths,
+            **beam_search_options(decode_cfg),
         )
 
     raise ValueError(f"Unknown decode method: {method}")
 
 
-def _build_transform(cfg, is_train: bool):
-    return make_image_transform(
-        height=int(cfg.preprocess.height),
-        keep_aspect=bool(cfg.preprocess.keep_aspect),
-        tight_crop_enabled=bool(cfg.preprocess.tight_crop.enabled),
-        tight_crop_threshold=int(cfg.preprocess.tight_crop.threshold),
-        tight_crop_margin=int(cfg.preprocess.tight_crop.margin),
-        augment_cfg=(cfg.augment if is_train and bool(cfg.augment.enabled) else None),
-        is_train=is_train,
-        fill=int(cfg.preprocess.pad_value),
-        to_float_tensor=True,
-    )
-
-
-def make_dataloader(cfg, split: str) -> DataLoader:
-    processed_dir = Path(cfg.data.processed_dir)
-    csv_path = processed_dir / f"{split}.csv"
-    if not csv_path.exists():
-        raise FileNotFoundError(f"Split CSV not found: {csv_path}")
-
-    is_train = split == "train"
-    transform = _build_transform(cfg, is_train=is_train)
-
-    ds = IamLineDataset(
-        csv_path=csv_path,
-        transform=transform,
-        target_height=int(cfg.preprocess.height),
-    )
-
-    bucket_enabled = bool(cfg.loader.bucket.enabled) and is_train
-    batch_size = int(cfg.loader.batch_size)
-
-    if bucket_enabled:
-        lengths = [ds.approx_resized_width(i) for i in range(len(ds))]
-        lengths_i = [int(v) for v in lengths if v is not None]
-        sampler = BucketBatchSampler(
-            lengths=lengths_i,
-            batch_size=batch_size,
-            shuffle_batches=bool(cfg.loader.shuffle),
-            seed=int(cfg.loader.bucket.seed),
-            drop_last=bool(cfg.loader.bucket.drop_last),
-        )
-        return DataLoader(
-            ds,
-            batch_sampler=sampler,
-            num_workers=int(cfg.loader.num_workers),
-            pin_memory=bool(cfg.loader.pin_memory),
-            collate_fn=lambda b: collate_line_batch(b, pad_value=float(cfg.preprocess.pad_value) / 255.0),
-        )
-
-    return DataLoader(
-        ds,
-        batch_size=batch_size,
-        shuffle=bool(cfg.loader.shuffle) if is_train else False,
-        num_workers=int(cfg.loader.num_workers),
-        pin_memory=bool(cfg.loader.pin_memory),
-        collate_fn=lambda b: collate_line_batch(b, pad_value=float(cfg.preprocess.pad_value) / 255.0),
-    )
+def make_dataloader(cfg, split: str, tokenizer: CTCTokenizer | None = None) -> DataLoader:
+    return make_line_dataloader(cfg, split, tokenizer=tokenizer)
 
 
 def _make_scheduler(optimizer, cfg, total_steps: int):
@@ -155,44 +99,34 @@ def _build_checkpoint_payload(model: HybridCTC, tokenizer: CTCTokenizer, cfg) ->
 
 
 @torch.inference_mode()
-def evaluate(model: HybridCTC, dl: DataLoader, tokenizer: CTCTokenizer, device: torch.device, decode_cfg) -> dict[str, float]:
+def evaluate(
+    model: HybridCTC,
+    dl: DataLoader,
+    tokenizer: CTCTokenizer,
+    device: torch.device,
+    decode_cfg,
+    prefetch: int = 2,
+    metric_workers: int = 1,
+) -> dict[str, float]:
     model.eval()
     ctc_loss = nn.CTCLoss(blank=tokenizer.blank_id, zero_infinity=True)
 
-    total_loss = 0.0
-    total_cer = 0.0
-    total_wer = 0.0
-    n = 0
-
-    for batch in tqdm(dl, desc="eval", leave=False):
-        x = batch["pixel_values"].to(device)
-        widths = batch["widths"]
-        texts = batch["texts"]
-
-        token_lengths = model.token_lengths_from_widths(widths).to(device)
+    prep = CTCBatchTargets(tokenizer, model.token_lengths_from_widths)
+    # декодирование, CER / WER и loss.item() — в фоне, пока идёт forward следующего батча
+    decode = partial(_decode_batch, tokenizer=tokenizer, decode_cfg=decode_cfg)
+    with AsyncEvalMetrics(decode, workers=metric_workers) as metrics:
+        for batch in tqdm(BatchPrefetcher(dl, device, prepare=prep, depth=prefetch), desc="eval", leave=False):
+            x = batch["pixel_values"]
+            token_lengths = batch["token_lengths"]
 
-        log_probs = model(x, token_lengths=token_lengths)  # [T, B, V]
-        t_steps = int(log_probs.shape[0])
-        input_lengths = torch.clamp(token_lengths, max=t_steps)
+            log_probs = model(x, token_lengths=token_lengths)  # [T, B, V]
+            t_steps = int(log_probs.shape[0])
+            input_lengths = torch.clamp(token_lengths, max=t_steps)
 
-        targets, target_lengths = _ctc_prepare_targets(tokenizer, texts)
-        targets = targets.to(device)
-        target_lengths = target_lengths.to(device)
+            loss = ctc_loss(log_probs, batch["targets"], input_lengths, batch["target_lengths"])
+            metrics.submit(batch["texts"], loss, log_probs, lengths=input_lengths)
 
-        loss = ctc_loss(log_probs, targets, input_lengths, target_lengths)
-        preds = _decode_batch(log_probs, tokenizer, decode_cfg)
-
-        bs = len(texts)
-        total_loss += float(loss.item()) * bs
-        total_cer += sum(cer(p, t) for p, t in zip(preds, texts))
-        total_wer += sum(wer(p, t) for p, t in zip(preds, texts))
-        n += bs
-
-    return {
-        "loss": total_loss / max(1, n),
-        "cer": total_cer / max(1, n),
-        "wer": total_wer / max(1, n),
-    }
+    return metrics.summary()
 
 
 def train_hybrid_ctc(cfg) -> TrainResult:
@@ -211,8 +145,11 @@ def train_hybrid_ctc(cfg) -> TrainResult:
         dropout=float(cfg.model.dropout),
     ).to(device)
 
-    train_dl = make_dataloader(cfg, "train")
-    val_dl = make_dataloader(cfg, "val")
+    train_dl = make_dataloader(cfg, "train", tokenizer)
+    device_aug = make_batch_augment(cfg)
+    if device_aug is not None and not device_aug.on_device:
+        device_aug = None
+    val_dl = make_dataloader(cfg, "val", tokenizer)
 
     optimizer = torch.optim.AdamW(
         model.parameters(),
@@ -243,24 +180,31 @@ def train_hybrid_ctc(cfg) -> TrainResult:
     log_ckpt_to_mlflow = bool(getattr(cfg.train, "log_checkpoint_to_mlflow", True))
     log_last_ckpt_to_mlflow = bool(getattr(cfg.train, "log_last_checkpoint_to_mlflow", False))
 
+    loader_stats = LoaderStats()
+    # таргеты и перенос на устройство готовятся в фоне, пока идёт шаг
+    prefetch = device_prefetch(cfg)
+    prep = CTCBatchTargets(tokenizer, model.token_lengths_from_widths)
+
     for epoch in range(1, int(cfg.train.max_epochs) + 1):
+        if hasattr(train_dl.dataset, "set_epoch"):
+            train_dl.dataset.set_epoch(epoch)
+        if hasattr(train_dl.batch_sampler, "set_epoch"):
+            train_dl.batch_sampler.set_epoch(epoch)
         model.train()
         optimizer.zero_grad(set_to_none=True)
 
         epoch_loss = 0.0
         seen = 0
 
-        pbar = tqdm(train_dl, desc=f"train e{epoch}", leave=False)
+        batches = BatchPrefetcher(train_dl, device, prepare=prep, depth=prefetch)
+        pbar = tqdm(loader_stats.track(batches), desc=f"train e{epoch}", leave=False)
         for step, batch in enumerate(pbar, start=1):
-            x = batch["pixel_values"].to(device)
-            widths = batch["widths"]
+            if device_aug is not None:
+                batch = prep.refresh_token_lengths(device_aug(batch, device=device), device)
+            x = batch["pixel_values"]
             texts = batch["texts"]
-
-            token_lengths = model.token_lengths_from_widths(widths).to(device)
-
-            targets, target_lengths = _ctc_prepare_targets(tokenizer, texts)
-            targets = targets.to(device)
-            target_lengths = target_lengths.to(device)
+            token_lengths = batch["token_lengths"]
+            targets, target_lengths = batch["targets"], batch["target_lengths"]
 
             with torch.cuda.amp.autocast(enabled=use_amp):
                 log_probs = model(x, token_lengths=token_lengths)
@@ -289,12 +233,23 @@ def train_hybrid_ctc(cfg) -> TrainResult:
             pbar.set_postfix(loss=float(loss.item()))
 
         train_loss = epoch_loss / max(1, seen)
-        val_metrics = evaluate(model, val_dl, tokenizer, device, decode_cfg=cfg.decode)
+        val_metrics = evaluate(
+            model,
+            val_dl,
+            tokenizer,
+            device,
+            decode_cfg=cfg.decode,
+            prefetch=prefetch,
+            metric_workers=metric_workers(cfg),
+        )
 
         mlflow.log_metric("train_loss", train_loss, step=epoch)
+        log_metrics(loader_stats.summary(), step=epoch)
         mlflow.log_metric("val_loss", val_metrics["loss"], step=epoch)
         mlflow.log_metric("val_cer", val_metrics["cer"], step=epoch)
         mlflow.log_metric("val_wer", val_metrics["wer"], step=epoch)
+        mlflow.log_metric("val_cer_corpus", val_metrics["cer_corpus"], step=epoch)
+        mlflow.log_metric("val_wer_corpus", val_metrics["wer_corpus"], step=epoch)
         mlflow.log_metric("lr", float(optimizer.param_groups[0]["lr"]), step=epoch)
 
         last_payload = _build_checkpoint_payload(model, tokenizer, cfg)
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
 
 import mlflow
@@ -13,11 +14,18 @@ from transformers import (
     get_scheduler,
 )
 
-from htr_ocr.data.trocr_dataset import TrOCRLineDataset, build_trocr_collate
+from htr_ocr.data.loader import build_dataloader
+from htr_ocr.data.prefetch import BatchPrefetcher, device_prefetch
+from htr_ocr.data.trocr_dataset import TrOCRCollator, TrOCRLineDataset
+from htr_ocr.data.packed import resolve_packed_dir
+from htr_ocr.data.preprocess_cache import make_preprocess_cache
+from htr_ocr.data.split_store import resolve_split_path
 from htr_ocr.data.transforms import make_image_transform
 from htr_ocr.train.trocr_common import fix_trocr_sinusoidal_positional_weights
 from htr_ocr.utils.io import ensure_dir
-from htr_ocr.utils.metrics import cer, wer
+from htr_ocr.utils.eval_pipeline import AsyncEvalMetrics, metric_workers
+from htr_ocr.utils.loader_stats import LoaderStats
+from htr_ocr.utils.mlflow_utils import log_metrics
 from htr_ocr.utils.repro import seed_everything
 
 
@@ -38,6 +46,7 @@ def _build_transform(cfg, is_train: bool):
         augment_cfg=(cfg.augment if is_train and bool(cfg.augment.enabled) else None),
         is_train=is_train,
         fill=int(cfg.preprocess.pad_value),
+        backend=str(getattr(cfg.preprocess, "backend", "pil")),
         to_float_tensor=False,
     )
 
@@ -90,9 +99,7 @@ def _build_scheduler(
 
 def make_dataloader(cfg, split: str, processor: TrOCRProcessor) -> DataLoader:
     processed_dir = Path(cfg.data.processed_dir)
-    csv_path = processed_dir / f"{split}.csv"
-    if not csv_path.exists():
-        raise FileNotFoundError(f"Split CSV not found: {csv_path}")
+    csv_path = resolve_split_path(processed_dir, split)
 
     is_train = split == "train"
     transform = _build_transform(cfg, is_train=is_train)
@@ -100,60 +107,47 @@ def make_dataloader(cfg, split: str, processor: TrOCRProcessor) -> DataLoader:
     ds = TrOCRLineDataset(
         csv_path=csv_path,
         transform=transform,
+        packed_dir=resolve_packed_dir(cfg, split),
+        preprocess_cache=make_preprocess_cache(cfg),
     )
 
-    dl = DataLoader(
-        ds,
-        batch_size=int(cfg.loader.batch_size),
-        shuffle=bool(cfg.loader.shuffle) if is_train else False,
-        num_workers=int(cfg.loader.num_workers),
-        pin_memory=bool(cfg.loader.pin_memory),
-        collate_fn=build_trocr_collate(
-            processor=processor,
-            max_target_length=int(cfg.model.max_target_length),
-        ),
-    )
+    collate_fn = TrOCRCollator(processor=processor, max_target_length=int(cfg.model.max_target_length))
+    dl = build_dataloader(cfg, ds, collate_fn, shuffle=bool(cfg.loader.shuffle) and is_train)
     return dl
 
 
 @torch.inference_mode()
-def evaluate(model, processor, dl, device: torch.device, generate_cfg) -> dict[str, float]:
+def evaluate(
+    model,
+    processor,
+    dl,
+    device: torch.device,
+    generate_cfg,
+    prefetch: int = 2,
+    metric_workers: int = 1,
+) -> dict[str, float]:
     model.eval()
 
-    total_loss = 0.0
-    total_cer = 0.0
-    total_wer = 0.0
-    n = 0
-
-    for batch in tqdm(dl, desc="eval", leave=False):
-        pixel_values = batch["pixel_values"].to(device)
-        labels = batch["labels"].to(device)
-        texts = batch["texts"]
-
-        outputs = model(pixel_values=pixel_values, labels=labels)
-        loss = outputs.loss
-
-        generated_ids = model.generate(
-            pixel_values,
-            num_beams=int(generate_cfg.num_beams),
-            max_new_tokens=int(generate_cfg.max_new_tokens),
-            length_penalty=float(generate_cfg.length_penalty),
-            early_stopping=bool(generate_cfg.early_stopping),
-            no_repeat_ngram_size=int(generate_cfg.no_repeat_ngram_size),
-        )
-        preds = processor.batch_decode(generated_ids, skip_special_tokens=True)
-
-        bs = len(texts)
-        total_loss += float(loss.item()) * bs
-        total_cer += sum(cer(pred, gt) for pred, gt in zip(preds, texts))
-        total_wer += sum(wer(pred, gt) for pred, gt in zip(preds, texts))
-        n += bs
+    # batch_decode, CER / WER и loss.item() — в фоне, пока идёт generate следующего батча
+    decode = partial(processor.batch_decode, skip_special_tokens=True)
+    with AsyncEvalMetrics(decode, workers=metric_workers) as metrics:
+        for batch in tqdm(BatchPrefetcher(dl, device, depth=prefetch), desc="eval", leave=False):
+            pixel_values = batch["pixel_values"]
+            labels = batch["labels"]
+
+            outputs = model(pixel_values=pixel_values, labels=labels)
+
+            generated_ids = model.generate(
+                pixel_values,
+                num_beams=int(generate_cfg.num_beams),
+                max_new_tokens=int(generate_cfg.max_new_tokens),
+                length_penalty=float(generate_cfg.length_penalty),
+                early_stopping=bool(generate_cfg.early_stopping),
+                no_repeat_ngram_size=int(generate_cfg.no_repeat_ngram_size),
+            )
+            metrics.submit(batch["texts"], outputs.loss, generated_ids)
 
-    return {
-        "loss": total_loss / max(1, n),
-        "cer": total_cer / max(1, n),
-        "wer": total_wer / max(1, n),
-    }
+    return metrics.summary()
 
 
 def train_trocr(cfg) -> TrainResult:
@@ -212,6 +206,7 @@ def train_trocr(cfg) -> TrainResult:
     best_val_cer = float("inf")
     best_val_wer = float("inf")
     bad_epochs = 0
+    loader_stats = LoaderStats()
 
     for epoch in range(1, int(cfg.train.max_epochs) + 1):
         if freeze_epochs > 0 and epoch == freeze_epochs + 1:
@@ -237,10 +232,12 @@ def train_trocr(cfg) -> TrainResult:
         epoch_loss = 0.0
         seen = 0
 
-        pbar = tqdm(train_dl, desc=f"train e{epoch}", leave=False)
+        # перенос на устройство следующих батчей идёт в фоне, пока считается шаг
+        batches = BatchPrefetcher(train_dl, device, depth=device_prefetch(cfg))
+        pbar = tqdm(loader_stats.track(batches), desc=f"train e{epoch}", leave=False)
         for step, batch in enumerate(pbar, start=1):
-            pixel_values = batch["pixel_values"].to(device)
-            labels = batch["labels"].to(device)
+            pixel_values = batch["pixel_values"]
+            labels = batch["labels"]
             bs = int(pixel_values.shape[0])
 
             with torch.cuda.amp.autocast(enabled=use_amp):
@@ -265,13 +262,24 @@ def train_trocr(cfg) -> TrainResult:
             pbar.set_postfix(loss=float(loss.item()))
 
         train_loss = epoch_loss / max(1, seen)
-        val_metrics = evaluate(model, processor, val_dl, device, generate_cfg=cfg.generate)
+        val_metrics = evaluate(
+            model,
+            processor,
+            val_dl,
+            device,
+            generate_cfg=cfg.generate,
+            prefetch=device_prefetch(cfg),
+            metric_workers=metric_workers(cfg),
+        )
 
         mlflow.log_metric("train_loss", train_loss, step=epoch)
         mlflow.log_metric("val_loss", val_metrics["loss"], step=epoch)
         mlflow.log_metric("val_cer", val_metrics["cer"], step=epoch)
         mlflow.log_metric("val_wer", val_metrics["wer"], step=epoch)
+        mlflow.log_metric("val_cer_corpus", val_metrics["cer_corpus"], step=epoch)
+        mlflow.log_metric("val_wer_corpus", val_metrics["wer_corpus"], step=epoch)
         mlflow.log_metric("lr", float(optimizer.param_groups[0]["lr"]), step=epoch)
+        log_metrics(loader_stats.summary(), step=epoch)
 
         if scheduler is not None and scheduler_step_mode == "epoch":
             scheduler.step()
@@ -7,10 +7,12 @@ from PIL import Image
 from htr_ocr.data.transforms import make_image_transform
 from htr_ocr.models.vt_ctc import HTRVTCTC, SpanMaskCfg
 from htr_ocr.text.ctc_tokenizer import CTCTokenizer
+from htr_ocr.train.chunked_infer import chunked_log_probs
 from htr_ocr.text.ctc_decode import ctc_beam_search_batch, ctc_greedy_decode_batch
 
 
-def load_checkpoint(path: Path, device: torch.device) -> Tuple[HTRVTCTC, CTCTokenizer]:
+def load_checkpoint(path: Path, device: torch.device, fast_path: bool = False) -> Tuple[HTRVTCTC, CTCTokenizer]:
+    """fast_path=True — сборка для инференса (HTRVTCTC.optimize_for_inference): одноканальный conv1."""
     ckpt = torch.load(path, map_location=device)
     tok = CTCTokenizer.from_dict(ckpt["tokenizer"])
     model_cfg = ckpt.get("cfg", {}).get("model", {})
@@ -28,6 +30,8 @@ def load_checkpoint(path: Path, device: torch.device) -> Tuple[HTRVTCTC, CTCToke
         span_mask=SpanMaskCfg(enabled=False),
     ).to(device)
     model.load_state_dict(state, strict=True)
+    if fast_path:
+        return model.optimize_for_inference(), tok
     model.eval()
     return model, tok
 
@@ -43,9 +47,13 @@ def infer_one(
     decode_method: str = "beam",
     beam_width: int = 50,
     topk: int = 20,
+    chunk_width: int = 0,
+    chunk_overlap: int = 128,
+    chunk_batch_size: int = 8,
+    fast_path: bool = False,
 ) -> str:
     device = torch.device(device_str if torch.cuda.is_available() else "cpu")
-    model, tok = load_checkpoint(checkpoint_path, device)
+    model, tok = load_checkpoint(checkpoint_path, device, fast_path=fast_path)
 
     tf = make_image_transform(
         height=int(height),
@@ -61,10 +69,20 @@ def infer_one(
 
     img = Image.open(image_path).convert("L")
     x = tf(img).unsqueeze(0).to(device)  # [1,1,H,W]
-    widths = torch.tensor([x.shape[-1]], dtype=torch.long, device=device)
-    token_lengths = model.token_lengths_from_widths(widths).to(device)
-
-    log_probs = model(x, token_lengths=token_lengths)  # [T,1,V]
+    if int(chunk_width) > 0:
+        # широкие строки — окнами: внимание внутри окна, память не растёт с шириной
+        log_probs = chunked_log_probs(
+            model,
+            x,
+            window=int(chunk_width),
+            overlap=int(chunk_overlap),
+            batch_size=int(chunk_batch_size),
+            pad_value=float(pad_value) / 255.0,
+        )
+    else:
+        widths = torch.tensor([x.shape[-1]], dtype=torch.long, device=device)
+        token_lengths = model.token_lengths_from_widths(widths).to(device)
+        log_probs = model(x, token_lengths=token_lengths)  # [T,1,V]
     if str(decode_method) == "beam":
         pred = ctc_beam_search_batch(
             log_probs,
@@ -0,0 +1,10 @@
+import os
+
+import torch
+
+
+def rank_world() -> tuple[int, int]:
+    """(rank, world_size) из torch.distributed, если он поднят, иначе из RANK/WORLD_SIZE (torchrun)."""
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return int(torch.distributed.get_rank()), int(torch.distributed.get_world_size())
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
@@ -0,0 +1,82 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Sequence
+
+from htr_ocr.utils.metrics import AverageMeter, ErrorRateAccumulator
+
+
+class AsyncEvalMetrics:
+    """
+    Метрики оценки вне критического пути: декодирование батча (decode), CER / WER и loss.item()
+    считаются в фоновых потоках, пока основной поток уже делает forward следующего батча.
+
+        with AsyncEvalMetrics(partial(_decode_batch, tokenizer=tok, decode_cfg=cfg.decode)) as metrics:
+            for batch in batches:
+                log_probs = model(x)
+                metrics.submit(batch["texts"], loss, log_probs, lengths=lengths)
+        return metrics.summary()
+
+    В полёте не больше max_pending батчей (их log-probs держатся на устройстве).
+    workers=0 — всё синхронно в submit, как раньше.
+    """
+
+    def __init__(self, decode: Callable[..., list[str]], workers: int = 1, max_pending: int = 4) -> None:
+        self.decode = decode
+        self.max_pending = max(1, int(max_pending))
+        self.errors = ErrorRateAccumulator()
+        self.loss = AverageMeter()
+        self._lock = threading.Lock()
+        self._pending: deque[Future] = deque()
+        self._pool = (
+            ThreadPoolExecutor(max_workers=int(workers), thread_name_prefix="eval-metrics") if int(workers) > 0 else None
+        )
+
+    def __enter__(self) -> "AsyncEvalMetrics":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.close()
+
+    def _run(self, texts: list[str], loss: Any, args: tuple, kwargs: dict[str, Any]) -> None:
+        preds = self.decode(*args, **kwargs)
+        loss_value = None if loss is None else float(loss)  # синхронизация с устройством — здесь, не в цикле
+        with self._lock:
+            self.errors.update(preds, texts)
+            if loss_value is not None:
+                self.loss.update(loss_value, n=len(texts))
+
+    def submit(self, texts: Sequence[str], loss: Any, *args: Any, **kwargs: Any) -> None:
+        """texts — эталоны батча, loss — скаляр (тензор) или None, args / kwargs — аргументы decode."""
+        if self._pool is None:
+            self._run(list(texts), loss, args, kwargs)
+            return
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+        self._pending.append(self._pool.submit(self._run, list(texts), loss, args, kwargs))
+
+    def wait(self) -> None:
+        """Дождаться всех отправленных батчей (ошибки из потоков поднимаются здесь)."""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+        self._pending.clear()
+
+    def summary(self) -> dict[str, float]:
+        """loss и метрики ErrorRateAccumulator (cer, wer, cer_corpus, wer_corpus)."""
+        self.wait()
+        with self._lock:
+            return {"loss": self.loss.avg, **self.errors.summary()}
+
+
+def metric_workers(cfg) -> int:
+    """loader.metric_workers: фоновые потоки для декодирования и метрик оценки (0 — синхронно)."""
+    return int(getattr(cfg.loader, "metric_workers", 1))
@@ -0,0 +1,131 @@
+import time
+from collections import defaultdict
+from typing import Any, Iterable, Iterator
+
+from torch.utils.data import get_worker_info
+
+# ключ, под которым collate_line_batch кладёт статистику батча
+BATCH_STATS_KEY = "stats"
+
+
+def batch_stats(
+    real_pixels: int,
+    padded_pixels: int,
+    samples: int,
+    collate_s: float,
+    load_s: float,
+) -> dict[str, float]:
+    """Статистика одного батча; считается в воркере DataLoader, поэтому только числа."""
+    info = get_worker_info()
+    return {
+        "real_pixels": float(real_pixels),
+        "padded_pixels": float(padded_pixels),
+        "samples": float(samples),
+        "collate_s": float(collate_s),
+        "load_s": float(load_s),
+        # -1 — основной процесс (num_workers=0)
+        "worker_id": float(info.id if info is not None else -1),
+    }
+
+
+class LoaderStats:
+    """
+    Накопитель за эпоху: эффективность паддинга, сборка батчей, ожидание DataLoader и
+    пропускная способность воркеров.
+
+        stats = LoaderStats()
+        for batch in tqdm(stats.track(train_dl)): ...
+        log_metrics(stats.summary(), step=epoch)
+
+    data_wait — сколько цикл обучения простоял в next(loader); остальное время эпохи — шаги модели.
+    worker_*_samples_per_sec — строк в секунду занятого времени воркера (__getitem__ + collate),
+    т.е. сколько один воркер может отдать, если его не ждать.
+    """
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.batches = 0
+        self.samples = 0
+        self.real_pixels = 0.0
+        self.padded_pixels = 0.0
+        self.collate_s = 0.0
+        self.load_s = 0.0
+        self.wait_s = 0.0
+        self.wall_s = 0.0
+        self.worker_samples: dict[int, float] = defaultdict(float)
+        self.worker_busy_s: dict[int, float] = defaultdict(float)
+
+    def update(self, batch: dict[str, Any], wait_s: float) -> None:
+        self.batches += 1
+        self.wait_s += float(wait_s)
+        st = batch.get(BATCH_STATS_KEY) if isinstance(batch, dict) else None
+        if not st:
+            self.samples += len(batch.get("texts", [])) if isinstance(batch, dict) else 0
+            return
+        wid = int(st["worker_id"])
+        self.samples += int(st["samples"])
+        self.real_pixels += st["real_pixels"]
+        self.padded_pixels += st["padded_pixels"]
+        self.collate_s += st["collate_s"]
+        self.load_s += st["load_s"]
+        self.worker_samples[wid] += st["samples"]
+        self.worker_busy_s[wid] += st["load_s"] + st["collate_s"]
+
+    def track(self, loader: Iterable[dict[str, Any]]) -> "_Tracked":
+        """Обёртка над loader: сбрасывает счётчики и меряет ожидание каждого батча."""
+        return _Tracked(self, loader)
+
+    def summary(self, prefix: str = "loader_") -> dict[str, float]:
+        out: dict[str, float] = {
+            "batches": float(self.batches),
+            "samples_per_sec": self.samples / self.wall_s if self.wall_s > 0 else 0.0,
+            "data_wait_s": self.wait_s,
+            "data_wait_frac": self.wait_s / self.wall_s if self.wall_s > 0 else 0.0,
+        }
+        if self.padded_pixels > 0:
+            out["pad_efficiency"] = self.real_pixels / self.padded_pixels
+        if self.batches and self.worker_busy_s:
+            out["collate_ms_per_batch"] = 1000.0 * self.collate_s / self.batches
+        if self.samples and self.worker_busy_s:
+            out["load_ms_per_sample"] = 1000.0 * self.load_s / self.samples
+
+        rates = []
+        for wid in sorted(self.worker_busy_s):
+            busy = self.worker_busy_s[wid]
+            if busy <= 0:
+                continue
+            rate = self.worker_samples[wid] / busy
+            rates.append(rate)
+            name = "main" if wid < 0 else str(wid)
+            out[f"worker_{name}_samples_per_sec"] = rate
+        if rates:
+            out["worker_samples_per_sec"] = sum(rates) / len(rates)
+
+        return {f"{prefix}{k}": float(v) for k, v in out.items()}
+
+
+class _Tracked:
+    def __init__(self, stats: LoaderStats, loader: Iterable[dict[str, Any]]) -> None:
+        self.stats = stats
+        self.loader = loader
+
+    def __len__(self) -> int:
+        return len(self.loader)  # type: ignore[arg-type]
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        stats = self.stats
+        stats.reset()
+        t_start = time.perf_counter()
+        it = iter(self.loader)
+        while True:
+            t0 = time.perf_counter()
+            try:
+                batch = next(it)
+            except StopIteration:
+                break
+            stats.update(batch, time.perf_counter() - t0)
+            yield batch
+            stats.wall_s = time.perf_counter() - t_start
+        stats.wall_s = time.perf_counter() - t_start
@@ -1,45 +1,194 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Hashable, Sequence
 
+import numpy as np
 
-def levenshtein_distance(a: list[str], b: list[str]) -> int:
-    """Стандартный алгоритм с dp"""
+
+def levenshtein_distance(a: Sequence[Hashable], b: Sequence[Hashable]) -> int:
+    """
+    Расстояние Левенштейна, bit-parallel алгоритм Майерса / Хюрё: столбец DP по a — битовые
+    векторы (int Python любой длины), на каждый элемент b — несколько битовых операций.
+    a, b — строки (по символам) или списки слов.
+    """
     n, m = len(a), len(b)
     if n == 0:
         return m
     if m == 0:
         return n
 
-    prev = list(range(m + 1))
-    cur = [0] * (m + 1)
+    peq: dict[Hashable, int] = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+
+    mask = (1 << n) - 1
+    last = 1 << (n - 1)
+    vp, vn, dist = mask, 0, n
+    for c in b:
+        x = peq.get(c, 0) | vn
+        d0 = ((((x & vp) + vp) ^ vp) | x) & mask
+        hp = vn | (~(d0 | vp) & mask)
+        hn = d0 & vp
+        if hp & last:
+            dist += 1
+        elif hn & last:
+            dist -= 1
+        hp = ((hp << 1) | 1) & mask
+        hn = (hn << 1) & mask
+        vp = hn | (~(d0 | hp) & mask)
+        vn = hp & d0
+    return dist
+
+
+def _as_codes(seqs: Sequence[Sequence[Hashable]], vocab: dict[Hashable, int], pad: int) -> tuple[np.ndarray, np.ndarray]:
+    """Последовательности -> int64 [B, max len] (символы — кодпоинты, слова — id из vocab) и длины [B]."""
+    lens = np.fromiter((len(s) for s in seqs), dtype=np.int64, count=len(seqs))
+    codes = np.full((len(seqs), int(lens.max(initial=0))), pad, dtype=np.int64)
+    for i, s in enumerate(seqs):
+        if isinstance(s, str):
+            codes[i, : len(s)] = np.frombuffer(s.encode("utf-32-le"), dtype="<u4")
+        else:
+            codes[i, : len(s)] = [vocab.setdefault(t, len(vocab) + 0x110000) for t in s]
+    return codes, lens
+
+
+def levenshtein_batch(hyps: Sequence[Sequence[Hashable]], refs: Sequence[Sequence[Hashable]]) -> np.ndarray:
+    """
+    Расстояния Левенштейна для пар (hyps[i], refs[i]) разом: тот же алгоритм Майерса / Хюрё,
+    битовые векторы по refs — uint64 [B, ceil(max len(ref) / 64)] (перенос сложения между словами),
+    один шаг по очередному элементу всех hyps — операции над массивами. Возвращает int64 [B].
+    """
+    if len(hyps) != len(refs):
+        raise ValueError(f"len(hyps)={len(hyps)} != len(refs)={len(refs)}")
+    vocab: dict[Hashable, int] = {}
+    h_codes, h_lens = _as_codes(hyps, vocab, pad=-2)
+    r_codes, r_lens = _as_codes(refs, vocab, pad=-1)
+    B = len(refs)
+    k = max(1, -(-r_codes.shape[1] // 64))
+    r_pad = np.full((B, 64 * k), -1, dtype=np.int64)
+    r_pad[:, : r_codes.shape[1]] = r_codes
+
+    one, top = np.uint64(1), np.uint64(63)
+    vp = np.full((B, k), np.iinfo(np.uint64).max, dtype=np.uint64)
+    vn = np.zeros((B, k), dtype=np.uint64)
+    hp = np.empty_like(vp)
+    hn = np.empty_like(vp)
+    rows = np.arange(B)
+    last_word = np.maximum(r_lens - 1, 0) // 64
+    last_bit = np.left_shift(one, (np.maximum(r_lens - 1, 0) % 64).astype(np.uint64))
+    dist = r_lens.copy()
 
-    for i in range(1, n + 1):
-        cur[0] = i
-        ai = a[i - 1]
-        for j in range(1, m + 1):
-            cost = 0 if ai == b[j - 1] else 1
-            cur[j] = min(
-                prev[j] + 1,
-                cur[j - 1] + 1,
-                prev[j - 1] + cost,
-            )
-        prev, cur = cur, prev
-    return prev[m]
+    for j in range(h_codes.shape[1]):
+        eq = np.packbits(r_pad == h_codes[:, j : j + 1], axis=1, bitorder="little").view("<u8")
+        carry = np.zeros((B,), dtype=np.uint64)
+        hp_in = np.ones((B,), dtype=np.uint64)  # глобальное выравнивание: верхняя строка DP растёт на 1
+        hn_in = np.zeros((B,), dtype=np.uint64)
+        for w in range(k):
+            pv, mv = vp[:, w], vn[:, w]
+            x = eq[:, w] | mv
+            a = x & pv
+            s1 = a + pv
+            s2 = s1 + carry
+            carry = ((s1 < a) | (s2 < s1)).astype(np.uint64)
+            d0 = (s2 ^ pv) | x
+            hp[:, w] = mv | ~(d0 | pv)
+            hn[:, w] = d0 & pv
+            hp_s = (hp[:, w] << one) | hp_in
+            hn_s = (hn[:, w] << one) | hn_in
+            hp_in, hn_in = hp[:, w] >> top, hn[:, w] >> top
+            vp[:, w] = hn_s | ~(d0 | hp_s)
+            vn[:, w] = hp_s & d0
+        active = j < h_lens
+        dist += active & ((hp[rows, last_word] & last_bit) != 0)
+        dist -= active & ((hn[rows, last_word] & last_bit) != 0)
+    return np.where(r_lens == 0, h_lens, dist)
+
+
+def _ratio(edits: int, ref_len: int, hyp_len: int) -> float:
+    if ref_len == 0:
+        return 0 if hyp_len == 0 else 1.0
+    return edits / ref_len
 
 
 def cer(pred: str, truth: str) -> float:
-    ref = list(truth)
-    hyp = list(pred)
-    if len(ref) == 0:
-        return 0 if len(hyp) == 0 else 1.0
-    return levenshtein_distance(hyp, ref) / len(ref)
+    return _ratio(levenshtein_distance(pred, truth), len(truth), len(pred))
 
 
 def wer(pred: str, truth: str) -> float:
     ref = truth.split()
     hyp = pred.split()
-    if len(ref) == 0:
-        return 0 if len(hyp) == 0 else 1.0
-    return levenshtein_distance(hyp, ref) / len(ref)
+    return _ratio(levenshtein_distance(hyp, ref), len(ref), len(hyp))
+
+
+@dataclass
+class ErrorRateAccumulator:
+    """
+    CER / WER по потоку батчей (pred, truth):
+    cer / wer — среднее отношений по строкам (как cer() и wer() раньше в циклах оценки),
+    corpus_cer / corpus_wer — сумма правок / сумма длин эталонов по всему сплиту.
+
+    Пары копятся до chunk штук и считаются одним levenshtein_batch (на маленьких батчах
+    фиксированная цена numpy-шага больше, чем у levenshtein_distance на каждую пару).
+    """
+
+    chunk: int = 1024
+    char_edits: int = 0
+    char_ref: int = 0
+    word_edits: int = 0
+    word_ref: int = 0
+    cer_sum: float = 0.0
+    wer_sum: float = 0.0
+    count: int = 0
+    _preds: list[str] = field(default_factory=list, repr=False)
+    _truths: list[str] = field(default_factory=list, repr=False)
+
+    def update(self, preds: Sequence[str], truths: Sequence[str]) -> None:
+        if len(preds) != len(truths):
+            raise ValueError(f"len(preds)={len(preds)} != len(truths)={len(truths)}")
+        self._preds.extend(preds)
+        self._truths.extend(truths)
+        if len(self._truths) >= self.chunk:
+            self.flush()
+
+    def flush(self) -> None:
+        preds, truths = self._preds, self._truths
+        if not truths:
+            return
+        self._preds, self._truths = [], []
+        hyp_w = [p.split() for p in preds]
+        ref_w = [t.split() for t in truths]
+        char_edits = levenshtein_batch(preds, truths).tolist()
+        word_edits = levenshtein_batch(hyp_w, ref_w).tolist()
+        for ce, we, p, t, hw, rw in zip(char_edits, word_edits, preds, truths, hyp_w, ref_w):
+            self.char_edits += ce
+            self.char_ref += len(t)
+            self.word_edits += we
+            self.word_ref += len(rw)
+            self.cer_sum += _ratio(ce, len(t), len(p))
+            self.wer_sum += _ratio(we, len(rw), len(hw))
+        self.count += len(truths)
+
+    @property
+    def cer(self) -> float:
+        self.flush()
+        return self.cer_sum / self.count if self.count else 0.0
+
+    @property
+    def wer(self) -> float:
+        self.flush()
+        return self.wer_sum / self.count if self.count else 0.0
+
+    @property
+    def corpus_cer(self) -> float:
+        self.flush()
+        return self.char_edits / self.char_ref if self.char_ref else 0.0
+
+    @property
+    def corpus_wer(self) -> float:
+        self.flush()
+        return self.word_edits / self.word_ref if self.word_ref else 0.0
+
+    def summary(self) -> dict[str, float]:
+        return {"cer": self.cer, "wer": self.wer, "cer_corpus": self.corpus_cer, "wer_corpus": self.corpus_wer}
 
 
 @dataclass
@@ -66,6 +66,13 @@ def mlflow_run(run_name: str, cfg, extra_tags: dict[str, str] | None = None) ->
         yield
 
 
+def log_metrics(metrics: dict[str, float], step: int | None = None) -> None:
+    """Логирует метрики в текущий run; без активного run (mlflow.enabled=false) ничего не делает."""
+    if mlflow.active_run() is None or not metrics:
+        return
+    mlflow.log_metrics({k: float(v) for k, v in metrics.items()}, step=step)
+
+
 def _flatten_for_mlflow(d: dict, prefix: str = "") -> dict[str, str]:
     out: dict[str, str] = {}
     for k, v in d.items():
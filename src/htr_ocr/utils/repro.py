@@ -19,3 +19,38 @@ def seed_everything(seed: int, deterministic: bool = True) -> None:
         torch.backends.cudnn.deterministic = True
         torch.backends.cudnn.benchmark = False
         torch.use_deterministic_algorithms(True, warn_only=True)
+
+
+def seed_worker(worker_id: int) -> None:
+    """
+    worker_init_fn для DataLoader: random и numpy от torch-сида воркера (base_seed + worker_id).
+
+    DataLoader (torch >= 1.9) и сам разводит random / torch / numpy по воркерам, но numpy —
+    своим хэшем base_seed. Хук сводит глобальные random и numpy к одному числу — torch.initial_seed()
+    воркера (его же видно в get_worker_info().seed), так что аугментации воркера воспроизводятся
+    по нему и не зависят от того, как это делает конкретная версия torch.
+    Объекты-генераторы, созданные в датасете до старта воркеров (random.Random, np.random.Generator),
+    хук не трогает: у всех воркеров они были бы одинаковыми, поэтому такие генераторы
+    сидируются от эпохи / номера воркера (как в streaming и samplers), а не полагаются на этот хук.
+    """
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+class SharedEpoch:
+    """
+    Номер эпохи в shared memory. Датасет копируется в воркеры DataLoader один раз
+    (persistent_workers, spawn), поэтому обычное поле после set_epoch в основном процессе
+    воркеры бы не увидели; тензор из share_memory_() общий для всех копий.
+    """
+
+    def __init__(self, epoch: int = 0) -> None:
+        self._value = torch.zeros((), dtype=torch.int64).share_memory_()
+        self.set(epoch)
+
+    def set(self, epoch: int) -> None:
+        self._value.fill_(int(epoch))
+
+    def get(self) -> int:
+        return int(self._value.item())
@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from htr_ocr.models.crnn_ctc import CRNNCTC
+from htr_ocr.models.hybrid_ctc import HybridCTC
+from htr_ocr.models.vt_ctc import HTRVTCTC
+from htr_ocr.train.chunked_infer import _forward, chunked_log_probs
+
+
+def _models() -> dict[str, torch.nn.Module]:
+    return {
+        "crnn": CRNNCTC(num_classes=10, rnn_hidden=8, rnn_layers=1, fc_hidden=8),
+        "hybrid": HybridCTC(
+            vocab_size=10,
+            cnn_out_channels=16,
+            lstm_hidden=8,
+            lstm_layers=1,
+            transformer_dim=16,
+            transformer_layers=1,
+            n_heads=2,
+            ffn_dim=32,
+        ),
+        "vt": HTRVTCTC(vocab_size=10, embed_dim=16, n_heads=2, n_layers=1, ffn_dim=32),
+    }
+
+
+@pytest.mark.parametrize("name", ["crnn", "hybrid", "vt"])
+def test_chunked_matches_full_length(name: str) -> None:
+    torch.manual_seed(0)
+    model = _models()[name].eval()
+    for width in (830, 833, 512, 515, 1001):
+        x = torch.rand(1, 1, 32, width)
+        with torch.no_grad():
+            full = _forward(model, x, [width])
+        chunked = chunked_log_probs(model, x, window=256, overlap=64)
+        assert chunked.shape == full.shape
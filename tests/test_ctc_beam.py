@@ -0,0 +1,111 @@
+import math
+
+import numpy as np
+import pytest
+import torch
+
+from htr_ocr.text.ctc_beam import log_threshold, prefix_beam_search_batch
+from htr_ocr.text.ctc_decode import ctc_beam_search_batch, ctc_beam_search_decode
+from htr_ocr.text.ctc_tokenizer import CTCTokenizer
+
+
+def _reference_beam_search(
+    lp: np.ndarray,
+    blank: int,
+    beam_width: int,
+    topk: int,
+    blank_skip_logp: float | None = None,
+) -> list[int]:
+    """Прежний prefix beam search на словаре префиксов (строка за строкой), lp: [T, C]."""
+
+    def add(a: float, b: float) -> float:
+        return float(np.logaddexp(a, b))
+
+    beams: dict[tuple[int, ...], tuple[float, float]] = {(): (0.0, -math.inf)}
+    k = max(1, min(int(topk), lp.shape[1]))
+    for frame in lp:
+        if blank_skip_logp is not None and frame[blank] >= blank_skip_logp:
+            candidates = [blank]
+        else:
+            candidates = np.argsort(-frame, kind="stable")[:k].tolist()
+        next_beams: dict[tuple[int, ...], tuple[float, float]] = {}
+        for prefix, (p_b, p_nb) in beams.items():
+            p_total = add(p_b, p_nb)
+            for c in candidates:
+                logp = float(frame[c])
+                if c == blank:
+                    nb = next_beams.get(prefix, (-math.inf, -math.inf))
+                    next_beams[prefix] = (add(nb[0], p_total + logp), nb[1])
+                    continue
+                new_prefix = prefix + (c,)
+                if prefix and prefix[-1] == c:
+                    nb_new = next_beams.get(new_prefix, (-math.inf, -math.inf))
+                    next_beams[new_prefix] = (nb_new[0], add(nb_new[1], p_b + logp))
+                    nb_same = next_beams.get(prefix, (-math.inf, -math.inf))
+                    next_beams[prefix] = (nb_same[0], add(nb_same[1], p_nb + logp))
+                else:
+                    nb_new = next_beams.get(new_prefix, (-math.inf, -math.inf))
+                    next_beams[new_prefix] = (nb_new[0], add(nb_new[1], p_total + logp))
+        ranked = sorted(next_beams.items(), key=lambda kv: add(*kv[1]), reverse=True)
+        beams = dict(ranked[: max(1, int(beam_width))])
+    return list(max(beams.items(), key=lambda kv: add(*kv[1]))[0])
+
+
+def _random_log_probs(rng: np.random.Generator, T: int, B: int, C: int, scale: float = 1.0) -> np.ndarray:
+    logits = rng.normal(scale=scale, size=(T, B, C))
+    return logits - np.logaddexp.reduce(logits, axis=-1, keepdims=True)
+
+
+@pytest.mark.parametrize(
+    "C, beam_width, topk",
+    [(4, 5, 4), (4, 3, 2), (6, 8, 6), (6, 4, 3), (10, 10, 5)],
+)
+def test_batch_matches_reference(C: int, beam_width: int, topk: int) -> None:
+    # близкие вероятности: префиксы часто выпадают из луча и собираются заново
+    rng = np.random.default_rng(C * 100 + beam_width * 10 + topk)
+    for _ in range(150):
+        T, B = int(rng.integers(1, 26)), int(rng.integers(1, 9))
+        lp = _random_log_probs(rng, T, B, C)
+        lengths = rng.integers(1, T + 1, size=B)
+        got = prefix_beam_search_batch(lp, lengths, blank=0, beam_width=beam_width, topk=topk)
+        want = [_reference_beam_search(lp[: lengths[b], b], 0, beam_width, topk) for b in range(B)]
+        assert got == want
+
+
+def test_blank_skip_matches_reference() -> None:
+    rng = np.random.default_rng(7)
+    threshold = log_threshold(0.6)
+    for _ in range(40):
+        T, B, C = int(rng.integers(1, 26)), int(rng.integers(1, 9)), 5
+        lp = _random_log_probs(rng, T, B, C)
+        # часть кадров — почти чистый бланк
+        blank_frames = rng.random((T, B)) < 0.4
+        lp[..., 0] = np.where(blank_frames, 3.0, lp[..., 0])
+        lp = lp - np.logaddexp.reduce(lp, axis=-1, keepdims=True)
+        lengths = np.full((B,), T)
+        got = prefix_beam_search_batch(lp, lengths, blank=0, beam_width=4, topk=3, blank_skip_logp=threshold)
+        want = [_reference_beam_search(lp[:, b], 0, 4, 3, blank_skip_logp=threshold) for b in range(B)]
+        assert got == want
+
+
+def test_decode_wrappers_agree() -> None:
+    tok = CTCTokenizer(id2char=list("abcde"))
+    rng = np.random.default_rng(3)
+    lp = torch.from_numpy(_random_log_probs(rng, 20, 4, tok.vocab_size)).float()
+    batch = ctc_beam_search_batch(lp, tok, beam_width=5, topk=4)
+    single = [ctc_beam_search_decode(lp[:, b], tok, beam_width=5, topk=4) for b in range(lp.shape[1])]
+    assert batch == single
+    want = [
+        tok.decode_greedy(_reference_beam_search(lp[:, b].double().numpy(), tok.blank_id, 5, 4))
+        for b in range(lp.shape[1])
+    ]
+    assert batch == want
+
+
+def test_pool_accepts_autocast_dtypes() -> None:
+    tok = CTCTokenizer(id2char=list("abcde"))
+    rng = np.random.default_rng(5)
+    lp = torch.from_numpy(_random_log_probs(rng, 20, 6, tok.vocab_size)).to(torch.bfloat16)
+    lengths = torch.tensor([20, 18, 15, 20, 7, 1])
+    want = ctc_beam_search_batch(lp, tok, beam_width=5, topk=4, lengths=lengths)
+    assert ctc_beam_search_batch(lp, tok, beam_width=5, topk=4, lengths=lengths, num_workers=2) == want
@@ -0,0 +1,16 @@
+from htr_ocr.text.ctc_tokenizer import CTCTokenizer
+
+
+def test_decode_batch_matches_decode_greedy() -> None:
+    tok = CTCTokenizer(id2char=list("abcdef"))
+    # бланк, id вне словаря и отрицательные id пропускаются
+    seqs = [[1, 2, 0, 5, 99, -1, 6], [], [3], [4, 4]]
+    assert tok.decode_batch(seqs) == [tok.decode_greedy(seq) for seq in seqs] == ["abef", "", "c", "dd"]
+    assert tok.decode_batch([]) == []
+
+
+def test_encode_batch_roundtrip() -> None:
+    tok = CTCTokenizer(id2char=list("abc d"))
+    texts = ["abc", "", "d a", "cc"]
+    ids, lengths = tok.encode_batch(texts)
+    assert tok.decode_flat(ids, lengths) == texts
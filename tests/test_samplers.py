@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+from htr_ocr.data.samplers import PixelBudgetBatchSampler
+
+
+@pytest.mark.parametrize("width_multiple", [1, 32])
+def test_pixel_budget_holds_after_collate_padding(width_multiple: int) -> None:
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(40, 900, size=500)
+    max_pixels, height = 60000, 32
+    sampler = PixelBudgetBatchSampler(
+        lengths=lengths.tolist(),
+        max_pixels=max_pixels,
+        height=height,
+        width_multiple=width_multiple,
+        num_replicas=1,
+        rank=0,
+    )
+    seen = []
+    for batch in sampler:
+        # ширина батча — как у collate_line_batch: W_max, округлённая вверх до кратного
+        w = -(-int(lengths[batch].max()) // width_multiple) * width_multiple
+        assert len(batch) == 1 or len(batch) * w * height <= max_pixels
+        seen += batch
+    assert sorted(seen) == list(range(len(lengths)))